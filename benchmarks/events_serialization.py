@@ -0,0 +1,71 @@
+"""
+Microbenchmark of calendar event serialization for a year-long range:
+the DRF serializer + JSONRenderer path vs. FullDayEvent.to_dict + encode_events.
+
+usage (from the repository root):
+    python benchmarks/events_serialization.py [--days 365] [--repeat 20]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+from datetime import date, timedelta
+
+import django
+
+
+def _setup():
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "test_project.settings")
+    django.setup()
+
+
+def serializer_path(days, max_calories):
+    from rest_framework.renderers import JSONRenderer
+
+    from django_nutrition import api
+
+    events = [
+        api.FullDayEvent(
+            d,
+            max_calories=max_calories,
+            warning_threshold=api.CALORIES_WARNING_THRESHOLD,
+        )
+        for d in days
+    ]
+    return JSONRenderer().render(api.FullDayEventSerializer(events, many=True).data)
+
+
+def fast_path(days, max_calories):
+    from django_nutrition import api
+
+    return api.encode_events(api.serialize_events(days, max_calories))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    _setup()
+    from django_nutrition import api  # (once set up)
+
+    first = date(2024, 1, 1)
+    days = [
+        api.DailyCalories(first + timedelta(days=i), 1500 + (i * 37) % 1000)
+        for i in range(args.days)
+    ]
+    assert serializer_path(days, 2000) == fast_path(days, 2000)
+
+    for name, func in [("serializer", serializer_path), ("fast", fast_path)]:
+        seconds = min(
+            timeit.repeat(
+                lambda func=func: func(days, 2000), number=1, repeat=args.repeat
+            )
+        )
+        print(f"{name:>10}: {args.days / seconds:12,.0f} events/sec")
+
+
+if __name__ == "__main__":
+    main()
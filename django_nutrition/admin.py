@@ -1,13 +1,35 @@
 from django.contrib import admin
-from .models import Food, Meal, Portion, Preferences
+from .models import (
+    DailyTotal,
+    DataVersion,
+    Food,
+    FoodUsage,
+    Meal,
+    MealTemplate,
+    MealSummary,
+    MealTemplateItem,
+    MealUsage,
+    Portion,
+    PortionArchive,
+    Preferences,
+)
 
 
 class PortionAdmin(admin.ModelAdmin):
     list_display = ("date", "food", "quantity", "meal", "user")
     list_filter = ["date"]
+    list_select_related = ("food", "meal", "user")
 
 
 admin.site.register(Food)
 admin.site.register(Meal)
 admin.site.register(Portion, PortionAdmin)
 admin.site.register(Preferences)
+admin.site.register(DailyTotal)
+admin.site.register(DataVersion)
+admin.site.register(FoodUsage)
+admin.site.register(MealUsage)
+admin.site.register(MealTemplate)
+admin.site.register(MealTemplateItem)
+admin.site.register(MealSummary)
+admin.site.register(PortionArchive)
@@ -0,0 +1,284 @@
+"""
+Rolling averages, under-target streaks and the trend of a user's daily
+calories, over their whole history.
+
+The daily totals are kept as compact arrays, one entry per calendar day
+since the first logged day, with running sums: the average of any
+window, and the least squares line through it, are a few lookups, and
+the streaks are extended one day at a time.
+
+The arrays are cached per user with the generation of each month they
+cover (the calendar events' month generations, bumped whenever the
+portions of a day in the month change).  A request reloads the days
+from the earliest changed month on, in one query, and otherwise only
+appends the days since the last request: years of history aren't
+recomputed unless they changed.  Portions logged before the first day
+drop the cached arrays (caching.invalidate_analytics).
+"""
+
+from array import array
+from datetime import date, timedelta
+from typing import TYPE_CHECKING
+
+from django.db.models import Min
+from django.utils import timezone
+
+from . import api, caching, models, rollup, timing
+
+if TYPE_CHECKING:
+    from django.contrib.auth.models import User
+
+WINDOWS = [7, 30, 90]  # days, of the rolling averages
+SERIES_DAYS = 90  # of the rolling averages series
+TREND_DAYS = 90  # fitted by the trend
+PROJECTION_DAYS = 30  # ahead of the last day
+
+
+class History:
+    """
+    A user's daily calories from first to last (inclusive), indexed by
+    day.  The running sums have one more entry than the days: sum_y[i] is
+    the sum of the calories of the days before index i, sum_n, sum_x,
+    sum_xx and sum_xy the sums of 1, i, i * i and i * calories over the
+    logged ones.
+    """
+
+    __slots__ = (
+        "calories",
+        "first",
+        "generations",
+        "last",
+        "logged",
+        "longest",
+        "max_calories",
+        "streaks",
+        "sum_n",
+        "sum_x",
+        "sum_xx",
+        "sum_xy",
+        "sum_y",
+    )
+
+    def __init__(self, first: date, max_calories: float):
+        self.first = first
+        self.last = first - timedelta(days=1)
+        self.calories = array("d")
+        self.logged = bytearray()
+        self.sum_n = array("d", [0])
+        self.sum_x = array("d", [0])
+        self.sum_xx = array("d", [0])
+        self.sum_y = array("d", [0])
+        self.sum_xy = array("d", [0])
+        # consecutive logged days under target ending on each day, and
+        # the longest such streak up to each day
+        self.streaks = array("l")
+        self.longest = array("l")
+        self.max_calories = max_calories
+        # month ("YYYY-MM") -> events month generation the days were loaded at
+        self.generations: dict[str, str] = {}
+
+    def index(self, day: date) -> int:
+        return (day - self.first).days
+
+    def truncate(self, day: date):
+        """
+        Drop the days from day on.
+        """
+        i = min(max(0, self.index(day)), len(self.calories))
+        for values in [self.calories, self.logged, self.streaks, self.longest]:
+            del values[i:]
+        for sums in [self.sum_n, self.sum_x, self.sum_xx, self.sum_y, self.sum_xy]:
+            del sums[i + 1 :]
+        self.last = self.first + timedelta(days=i - 1)
+
+    def _streak(self, i: int) -> int:
+        under = self.logged[i] and self.calories[i] <= self.max_calories
+        previous = self.streaks[i - 1] if i else 0
+        return previous + 1 if under else 0
+
+    def extend(self, last: date, days: dict[date, float]):
+        """
+        Append the days after the last one up to last, with the totals
+        of those logged.
+        """
+        for i in range(len(self.calories), self.index(last) + 1):
+            calories = days.get(self.first + timedelta(days=i))
+            logged = calories is not None
+            y = calories or 0.0
+            n = 1 if logged else 0
+            self.calories.append(y)
+            self.logged.append(n)
+            self.sum_n.append(self.sum_n[-1] + n)
+            self.sum_x.append(self.sum_x[-1] + n * i)
+            self.sum_xx.append(self.sum_xx[-1] + n * i * i)
+            self.sum_y.append(self.sum_y[-1] + y)
+            self.sum_xy.append(self.sum_xy[-1] + i * y)
+            self.streaks.append(self._streak(i))
+            self.longest.append(max(self.streaks[i], self.longest[-1] if i else 0))
+        self.last = max(self.last, last)
+
+    def retarget(self, max_calories: float):
+        """
+        Recompute the streaks for another target.
+        """
+        self.max_calories = max_calories
+        for i in range(len(self.calories)):
+            self.streaks[i] = self._streak(i)
+            self.longest[i] = max(self.streaks[i], self.longest[i - 1] if i else 0)
+
+    def _window(self, end: int, days: int, sums: array) -> float:
+        return sums[end + 1] - sums[max(0, end - days + 1)]
+
+    def average(self, end: int, days: int) -> float | None:
+        """
+        The mean of the logged days in the window of days days up to index
+        end (inclusive).
+        """
+        n = self._window(end, days, self.sum_n)
+        if not n:
+            return None
+        return api.round_01(self._window(end, days, self.sum_y) / n)
+
+    def trend(self, end: int, days: int) -> dict | None:
+        """
+        The least squares line through the logged days in the window of
+        days days up to index end: its slope (calories per day) and its
+        value PROJECTION_DAYS after end.
+        """
+        n = self._window(end, days, self.sum_n)
+        # x relative to end, to keep the sums small
+        sx = self._window(end, days, self.sum_x) - end * n
+        sy = self._window(end, days, self.sum_y)
+        sxx = (
+            self._window(end, days, self.sum_xx)
+            - 2 * end * self._window(end, days, self.sum_x)
+            + end * end * n
+        )
+        sxy = self._window(end, days, self.sum_xy) - end * sy
+        denominator = n * sxx - sx * sx
+        if n < 2 or denominator <= 0:
+            return None
+        slope = (n * sxy - sx * sy) / denominator
+        intercept = (sy - slope * sx) / n
+        return {
+            "slope": api.round_01(slope),
+            "projection": api.round_01(intercept + slope * PROJECTION_DAYS),
+        }
+
+    def current_streak(self, end: int) -> int:
+        # today counts once logged
+        if self.logged[end] or not end:
+            return self.streaks[end]
+        return self.streaks[end - 1]
+
+    def to_dict(self, end_date: date) -> dict:
+        end = self.index(end_date)
+        series = []
+        for i in range(max(0, end - SERIES_DAYS + 1), end + 1):
+            series.append(
+                {
+                    "date": self.first + timedelta(days=i),
+                    "calories": self.calories[i] if self.logged[i] else None,
+                    "averages": {str(w): self.average(i, w) for w in WINDOWS},
+                }
+            )
+        return {
+            "first": self.first,
+            "last": end_date,
+            "max_calories": self.max_calories,
+            "averages": {str(w): self.average(end, w) for w in WINDOWS},
+            "series": series,
+            "streaks": {
+                "current": self.current_streak(end),
+                "longest": self.longest[end],
+            },
+            "trend": self.trend(end, TREND_DAYS),
+        }
+
+
+def _first_day(user: "User") -> date | None:
+    if rollup.enabled():
+        return models.DailyTotal.objects.filter(user=user).aggregate(first=Min("date"))[
+            "first"
+        ]
+    firsts = [
+        model.objects.filter(user=user).aggregate(first=Min("date"))["first"]
+        for model in [models.Portion, models.MealSummary]
+    ]
+    return min((f for f in firsts if f is not None), default=None)
+
+
+def _generations(user: "User", first: date, last: date) -> dict[str, str]:
+    months = [caching.month_of(m) for m in api._month_starts(first, last)]
+    keys = {m: caching.events_month_generation_key(user.pk, m) for m in months}
+    generations = caching.get_generations(caching.get_events_cache(), keys.values())
+    return {m: generations[key] for m, key in keys.items()}
+
+
+def _load(history: History, user: "User", start_date: date, end_date: date):
+    # (one query from start_date on, whatever the length of the history)
+    rows = api.daily_calories(user, start_date, end_date)
+    history.truncate(start_date)
+    history.extend(end_date, {row.date: row.calories for row in rows})
+
+
+def history(
+    user: "User", max_calories: float, end_date: date | None = None
+) -> History | None:
+    """
+    The user's history up to end_date (default: today) at least, None if
+    they never logged anything.  Cached, see the module documentation.
+    """
+    end_date = end_date or timezone.localdate()
+    _cache = caching.get_cache()
+    _key = caching.analytics_key(user.pk)
+    _history: History | None = _cache.get(_key)
+
+    if _history is None:
+        first = _first_day(user)
+        if first is None or first > end_date:
+            return None
+        _history = History(first, max_calories)
+        # generations first: a change during the load is reloaded next time
+        _history.generations = _generations(user, first, end_date)
+        _load(_history, user, first, end_date)
+    else:
+        if end_date < _history.first:
+            return None
+        generations = _generations(user, _history.first, end_date)
+        changed = [
+            m for m, g in generations.items() if _history.generations.get(m) != g
+        ]
+        # (months after the last day are new, hence changed: loaded at most
+        # once a month, the days after the last one in an unchanged month
+        # are empty)
+        _history.generations = generations
+        # (an earlier end_date reads the days up to it, the cached ones after
+        # it are kept for later requests)
+        if changed:
+            start_date = max(_history.first, date.fromisoformat(f"{min(changed)}-01"))
+            _load(_history, user, start_date, max(end_date, _history.last))
+        else:
+            _history.extend(end_date, {})
+    if _history.max_calories != max_calories:
+        _history.retarget(max_calories)
+
+    _cache.set(_key, _history)
+    return _history
+
+
+def analytics(
+    user: "User", max_calories: float, end_date: date | None = None
+) -> dict | None:
+    """
+    Averages over the last WINDOWS days, their series over SERIES_DAYS
+    days, the current and longest streaks of logged days under
+    max_calories, and the trend over TREND_DAYS days, up to end_date
+    (default: today).  None if the user never logged anything.
+    """
+    end_date = end_date or timezone.localdate()
+    with timing.measure("agg"):
+        _history = history(user, max_calories, end_date)
+        if _history is None:
+            return None
+        return _history.to_dict(end_date)
@@ -1,18 +1,44 @@
+import io
+import json
 from enum import Enum
-from functools import partial
-from datetime import datetime
-from typing import Iterable, List, TYPE_CHECKING
+from datetime import date, datetime
+from typing import (
+    Iterable,
+    List,
+    NamedTuple,
+    TYPE_CHECKING,
+)
+from django.db.models import F, Q, Sum
+from django.http import HttpResponse
 from django.utils import timezone
-from . import models
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated
+from django.views.decorators.http import condition
+from . import (
+    analytics,
+    bulk,
+    caching,
+    conditional,
+    importing,
+    models,
+    rollup,
+    search,
+    stats,
+    timing,
+    usage,
+)
+from rest_framework.compat import LONG_SEPARATORS, SHORT_SEPARATORS
+from rest_framework.decorators import api_view, parser_classes, permission_classes
+from rest_framework.parsers import MultiPartParser
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework import serializers
 
 if TYPE_CHECKING:
+    from django.contrib.auth.models import User
     from django.http import HttpRequest
 
 CALORIES_WARNING_THRESHOLD = 0.1  # cutoff for "slightly over"
+MAX_EVENT_RANGES = 12  # per batched calendar events request
 
 
 def round_01(value: float) -> float:
@@ -27,10 +53,17 @@ class DailyTotalRange(Enum):
 
 
 class MealTotal:
-    def __init__(self, name: str, portions: Iterable[models.Portion]):
+    def __init__(
+        self,
+        name: str,
+        portions: Iterable[models.Portion],
+        calories: float | None = None,
+    ):
         self.name = name
         self.portions = portions
-        self.calories = round_01(sum(p.calories() for p in portions))
+        if calories is None:
+            calories = sum(p.calories() for p in portions)
+        self.calories = round_01(calories)
 
     def to_dict(self):
         return {"name": self.name, "calories": self.calories, "portions": self.portions}
@@ -45,10 +78,35 @@ class MealTotal:
 
 
 class DayTotal:
-    def __init__(self, date: timezone, portions: Iterable[models.Portion]):
+    def __init__(
+        self,
+        date: timezone,
+        portions: Iterable[models.Portion],
+        calories: float | None = None,
+        meals: list[MealTotal] | None = None,
+    ):
         self.date = date
-        self.calories = sum(p.calories() for p in portions)
-        self.meals = MealTotal.split_portions(portions)
+        if calories is None:
+            calories = sum(p.calories() for p in portions)
+        self.calories = calories
+        if meals is None:
+            meals = MealTotal.split_portions(portions)
+        self.meals = meals
+
+    @staticmethod
+    def from_rollup(total: models.DailyTotal) -> "DayTotal":
+        """
+        Build a DayTotal (without portions) from a rollup row.
+        """
+        return DayTotal(
+            total.date,
+            portions=[],
+            calories=total.calories,
+            meals=[
+                MealTotal(_name, portions=[], calories=_calories)
+                for _name, _calories in total.meal_calories.items()
+            ],
+        )
 
     @staticmethod
     def split_days(portions: Iterable[models.Portion]) -> List["DayTotal"]:
@@ -59,7 +117,77 @@ class DayTotal:
         return [DayTotal(date, portions) for date, portions in portions_per_day.items()]
 
 
+class DailyCalories(NamedTuple):
+    """
+    Per-day calorie total computed by the database, usable
+    anywhere a DayTotal is only read for its date and calories.
+    """
+
+    date: "date"
+    calories: float
+
+
+def _daily_calories_query(user: "User", spans: list[tuple["date", "date"]]):
+    # the (inclusive) date spans are combined in one query
+    dates = Q()
+    for start_date, end_date in spans:
+        dates |= Q(date__gte=start_date, date__lte=end_date)
+    if rollup.enabled():
+        # (which includes the compacted portions)
+        return (
+            models.DailyTotal.objects.filter(dates, user=user)
+            .values_list("date", "calories")
+            .order_by("date")
+        )
+    portions = (
+        models.Portion.objects.filter(dates, user=user)
+        .values_list("date")
+        .annotate(calories=Sum(F("calories_per_unit") * F("quantity")))
+        .order_by("date")
+    )
+    # compacted portions (compaction.py); a compacted day with new portions gets two rows (see _merge_days)
+    summaries = (
+        models.MealSummary.objects.filter(dates, user=user)
+        .values_list("date")
+        .annotate(calories=Sum("calories"))
+    )
+    return portions.order_by().union(summaries.order_by(), all=True).order_by("date")
+
+
+def _merge_days(rows: Iterable[tuple]) -> list["DailyCalories"]:
+    days = []
+    for _date, calories in rows:
+        if days and days[-1].date == _date:
+            days[-1] = DailyCalories(_date, days[-1].calories + calories)
+        else:
+            days.append(DailyCalories(_date, calories))
+    return days
+
+
+def daily_calories(
+    user: "User", start_date: "date", end_date: "date"
+) -> list[DailyCalories]:
+    """
+    Sum the calories of each day in the (inclusive) range with a single
+    GROUP BY query, without loading the individual portions.
+    """
+    return _merge_days(_daily_calories_query(user, [(start_date, end_date)]))
+
+
 class FullDayEvent:
+    # no per-instance __dict__ (one event is built per calendar day)
+    __slots__ = (
+        "allDay",
+        "backgroundColor",
+        "description",
+        "display",
+        "end",
+        "start",
+        "textColor",
+        "title",
+        "url",
+    )
+
     CALORIE_RANGE_STYLES = {
         DailyTotalRange.UNDER: {
             "backgroundColor": "green",
@@ -88,7 +216,10 @@ class FullDayEvent:
             return DailyTotalRange.SLIGHTLY_OVER
 
     def __init__(
-        self, day: DayTotal, max_calories: float, warning_threshold: float = 0
+        self,
+        day: DayTotal | DailyCalories,
+        max_calories: float,
+        warning_threshold: float = 0,
     ):
         self.title = str(int(day.calories + 0.5))
         self.start = day.date
@@ -104,6 +235,23 @@ class FullDayEvent:
         self.backgroundColor = style["backgroundColor"]
         self.textColor = style["textColor"]
 
+    def to_dict(self) -> dict:
+        """
+        Same as FullDayEventSerializer(self).data, without running
+        the serializer fields.
+        """
+        return {
+            "title": self.title,
+            "start": self.start.isoformat(),
+            "end": self.end.isoformat(),
+            "description": self.description,
+            "allDay": self.allDay,
+            "display": self.display,
+            "backgroundColor": self.backgroundColor,
+            "textColor": self.textColor,
+            "url": self.url,
+        }
+
 
 class FullDayEventSerializer(serializers.Serializer):
     title = serializers.CharField(max_length=200)
@@ -117,35 +265,400 @@ class FullDayEventSerializer(serializers.Serializer):
     url = serializers.CharField(max_length=200)
 
 
-@api_view(["GET"])
-@permission_classes([IsAuthenticated])
-def days(request: "HttpRequest"):
-    start = request.query_params.get("start", None)
+def _to_date(value) -> "date":
+    # same conversion as the Portion.date lookups (aware datetimes are
+    # converted to the current time zone)
+    return models.Portion._meta.get_field("date").to_python(value)
+
+
+def serialize_events(
+    days: Iterable[DayTotal | DailyCalories], max_calories: float
+) -> list[dict]:
+    return [
+        FullDayEvent(
+            _day,
+            max_calories=max_calories,
+            warning_threshold=CALORIES_WARNING_THRESHOLD,
+        ).to_dict()
+        for _day in days
+    ]
+
+
+def encode_events(events: list[dict]) -> bytes:
+    """
+    The same bytes as rendering the events with rest_framework's
+    JSONRenderer (given the same REST_FRAMEWORK json settings).
+    """
+    content = json.dumps(
+        events,
+        ensure_ascii=not api_settings.UNICODE_JSON,
+        allow_nan=not api_settings.STRICT_JSON,
+        separators=SHORT_SEPARATORS if api_settings.COMPACT_JSON else LONG_SEPARATORS,
+    )
+    return content.replace("\u2028", "\\u2028").replace("\u2029", "\\u2029").encode()
+
+
+def _month_starts(start_date: "date", end_date: "date") -> list["date"]:
+    months = []
+    month = start_date.replace(day=1)
+    while month <= end_date:
+        months.append(month)
+        month = (month + timezone.timedelta(days=32)).replace(day=1)
+    return months
+
+
+def _next_month(month: "date") -> "date":
+    return (month + timezone.timedelta(days=32)).replace(day=1)
+
+
+def _month_spans(months: list["date"]) -> list[tuple["date", "date"]]:
+    """
+    (first day, last day) of each run of consecutive months
+    """
+    spans = []
+    for month in sorted(months):
+        if spans and _next_month(spans[-1][1]) == month:
+            spans[-1][1] = month
+        else:
+            spans.append([month, month])
+    return [
+        (first, _next_month(last) - timezone.timedelta(days=1)) for first, last in spans
+    ]
+
+
+def _split_months(
+    months: list["date"], days: list[DailyCalories], max_calories: float
+) -> dict[str, list[dict]]:
+    events = {caching.month_of(m): [] for m in months}
+    for _event in serialize_events(days, max_calories):
+        _month = _event["start"][:7]  # "YYYY-MM"
+        if _month in events:
+            events[_month].append(_event)
+    return events
+
+
+def _compute_months(
+    user: "User", months: list["date"], max_calories: float
+) -> dict[str, list[dict]]:
+    with timing.measure("agg"):
+        rows = _daily_calories_query(user, _month_spans(months))
+        return _split_months(months, _merge_days(rows), max_calories)
+
+
+async def _acompute_months(
+    user: "User", months: list["date"], max_calories: float
+) -> dict[str, list[dict]]:
+    with timing.measure("agg"):
+        rows = _daily_calories_query(user, _month_spans(months))
+        return _split_months(
+            months, _merge_days([row async for row in rows]), max_calories
+        )
+
+
+def _range_months(
+    ranges: list[tuple["date", "date"]], prefetch: bool
+) -> dict[str, "date"]:
+    months = {m for start, end in ranges for m in _month_starts(start, end)}
+    if prefetch and months:
+        # the months before and after, where the calendar navigates next
+        first = min(months)
+        months.add((first - timezone.timedelta(days=1)).replace(day=1))
+        months.add(_next_month(max(months)))
+    return {caching.month_of(m): m for m in sorted(months)}
+
+
+def _bucket_keys(
+    user: "User", months: dict[str, "date"], generations, max_calories: float
+) -> dict[str, str]:
+    return {
+        _month: caching.events_month_key(
+            user.pk,
+            _month,
+            generations[caching.events_month_generation_key(user.pk, _month)],
+            max_calories,
+        )
+        for _month in months
+    }
+
+
+def _stitch(
+    keys: dict[str, str], buckets: dict, start_date: "date", end_date: "date"
+) -> list[dict]:
+    start, end = start_date.isoformat(), end_date.isoformat()
+    return [
+        _event
+        for _month in _month_starts(start_date, end_date)
+        for _event in buckets[keys[caching.month_of(_month)]]
+        if start <= _event["start"] <= end
+    ]
+
+
+def range_events(
+    user: "User",
+    ranges: list[tuple["date", "date"]],
+    max_calories: float,
+    prefetch: bool = False,
+) -> list[list[dict]]:
+    """
+    Serialized events of each (inclusive) range, stitched together from
+    per-month buckets in the events cache.  The missing months of all
+    ranges are computed with a single query; with prefetch, so are the
+    months just before and after them.  Buckets are dropped when the
+    portions of any day in their month change (see signals.py).
+    """
+    _cache = caching.get_events_cache()
+    months = _range_months(ranges, prefetch)
+    generations = caching.get_generations(
+        _cache, [caching.events_month_generation_key(user.pk, m) for m in months]
+    )
+    keys = _bucket_keys(user, months, generations, max_calories)
+    buckets = _cache.get_many(keys.values())
+
+    missing = [months[_month] for _month, _key in keys.items() if _key not in buckets]
+    if missing:
+        computed = {
+            keys[_month]: _events
+            for _month, _events in _compute_months(user, missing, max_calories).items()
+        }
+        _cache.set_many(computed)
+        buckets.update(computed)
+    return [_stitch(keys, buckets, start, end) for start, end in ranges]
+
+
+async def arange_events(
+    user: "User",
+    ranges: list[tuple["date", "date"]],
+    max_calories: float,
+    prefetch: bool = False,
+) -> list[list[dict]]:
+    """
+    Async range_events()
+    """
+    _cache = caching.get_events_cache()
+    months = _range_months(ranges, prefetch)
+    generations = await caching.aget_generations(
+        _cache, [caching.events_month_generation_key(user.pk, m) for m in months]
+    )
+    keys = _bucket_keys(user, months, generations, max_calories)
+    buckets = await _cache.aget_many(keys.values())
+
+    missing = [months[_month] for _month, _key in keys.items() if _key not in buckets]
+    if missing:
+        computed = {
+            keys[_month]: _events
+            for _month, _events in (
+                await _acompute_months(user, missing, max_calories)
+            ).items()
+        }
+        await _cache.aset_many(computed)
+        buckets.update(computed)
+    return [_stitch(keys, buckets, start, end) for start, end in ranges]
+
+
+def month_events(
+    user: "User", start_date: "date", end_date: "date", max_calories: float
+) -> list[dict]:
+    """
+    Serialized events of the (inclusive) range (see range_events)
+    """
+    return range_events(user, [(start_date, end_date)], max_calories)[0]
+
+
+def event_range(query_params) -> tuple["date", "date"]:
+    """
+    The (inclusive) date range of a calendar events request, by default
+    the last four weeks.
+    """
+    start = query_params.get("start", None)
     if start:
         # FullCalendar doesn't send timezone info
         start_date = datetime.fromisoformat(start)
     else:
         start_date = timezone.now() - timezone.timedelta(weeks=4)
 
-    end = request.query_params.get("end", None)
+    end = query_params.get("end", None)
     if end:
         # FullCalendar doesn't send timezone info
         end_date = datetime.fromisoformat(end)
     else:
         end_date = timezone.now()
+    return _to_date(start_date), _to_date(end_date)
+
 
-    _days = DayTotal.split_days(
-        models.Portion.objects.filter(
-            date__gte=start_date, date__lte=end_date, user=request.user
+def event_ranges(query_params) -> list[tuple["date", "date"]]:
+    """
+    The ranges of a batched calendar events request, "ranges" as comma
+    separated start/end pairs, e.g. ranges=2024-01-29/2024-03-11,...
+
+    :raises ValueError: for invalid or too many ranges
+    """
+    ranges = []
+    for _range in query_params["ranges"].split(","):
+        start, _, end = _range.partition("/")
+        ranges.append(
+            (
+                _to_date(datetime.fromisoformat(start)),
+                _to_date(datetime.fromisoformat(end)),
+            )
         )
-    )
+    if len(ranges) > MAX_EVENT_RANGES:
+        raise ValueError(f"at most {MAX_EVENT_RANGES} ranges")
+    return ranges
+
+
+@condition(
+    etag_func=conditional.range_etag,
+    last_modified_func=conditional.range_last_modified,
+)
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def days(request: "HttpRequest"):
+    """
+    Calendar events between "start" and "end", or with "ranges" a list
+    of the events of each range.  With "prefetch", the events of the
+    adjacent months are computed (and cached) in the same query.
+    """
+    batched = "ranges" in request.query_params
+    try:
+        if batched:
+            ranges = event_ranges(request.query_params)
+        else:
+            ranges = [event_range(request.query_params)]
+    except ValueError as e:
+        return Response({"detail": str(e)}, status=400)
+    prefetch = request.query_params.get("prefetch") in ["1", "true"]
 
     _prefs = models.Preferences.current_preferences(request)
+    events = range_events(request.user, ranges, _prefs["max_calories"], prefetch)
+    return HttpResponse(
+        encode_events(events if batched else events[0]),
+        content_type="application/json",
+    )
+
+
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+@parser_classes([MultiPartParser])
+def import_data(request: "HttpRequest"):
+    """
+    Import an uploaded CSV/JSON lines "file" of foods or portions
+    (see importing.py), given "kind" and optionally "format".
+    """
+    upload = request.FILES.get("file")
+    if upload is None:
+        return Response({"detail": 'missing "file"'}, status=400)
+    kind = request.data.get("kind")
+    if kind not in importing.KINDS:
+        return Response(
+            {"detail": f'"kind" must be one of {importing.KINDS}'}, status=400
+        )
+    file_format = request.data.get("format") or importing.guess_format(upload.name)
+    if file_format not in importing.FORMATS:
+        return Response(
+            {"detail": f'"format" must be one of {importing.FORMATS}'}, status=400
+        )
+
+    # uploads bigger than FILE_UPLOAD_MAX_MEMORY_SIZE are spooled to disk,
+    # and the rows are read from there one at a time
+    stream = io.TextIOWrapper(upload.file, encoding="utf-8-sig", newline="")
+    result = importing.import_stream(request.user, stream, kind, file_format)
+    return Response(result.to_dict())
+
 
-    _make_event = partial(
-        FullDayEvent,
-        max_calories=_prefs["max_calories"],
-        warning_threshold=CALORIES_WARNING_THRESHOLD,
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def bulk_portions(request: "HttpRequest"):
+    """
+    Create and update many portions at once: a JSON list of portions,
+    those with an "id" are updated (see bulk.py).  All or nothing.
+    """
+    try:
+        result = bulk.save_portions(request.user, request.data)
+    except bulk.InvalidPortions as e:
+        return Response({"detail": str(e), "errors": e.errors}, status=400)
+    return Response(result)
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def food_search(request: "HttpRequest"):
+    """
+    Autocompletion: the user's best matching foods for "q" (at most "limit")
+    """
+    try:
+        limit = int(request.GET.get("limit", search.DEFAULT_LIMIT))
+    except ValueError:
+        return Response({"detail": '"limit" must be an integer'}, status=400)
+    foods = search.search_foods(request.user, request.GET.get("q", ""), limit)
+    return Response(
+        [{"id": f.pk, "name": f.name, "calories": f.calories} for f in foods]
     )
-    serializer = FullDayEventSerializer(map(_make_event, _days), many=True)
-    return Response(serializer.data)
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def suggestions(request: "HttpRequest"):
+    """
+    The user's most frequent and most recent foods and meals
+    """
+    return Response(usage.suggestions(request.user.pk))
+
+
+@condition(
+    etag_func=conditional.range_etag,
+    last_modified_func=conditional.range_last_modified,
+)
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def summaries(request: "HttpRequest"):
+    """
+    Per-"period" (week or month) calorie summaries between "start" and
+    "end" (default: the whole periods of the last year)
+    """
+    period = request.query_params.get("period", "week")
+    if period not in stats.PERIODS:
+        return Response(
+            {"detail": f'"period" must be one of {stats.PERIODS}'}, status=400
+        )
+    try:
+        end = request.query_params.get("end")
+        end_date = date.fromisoformat(end) if end else timezone.localdate()
+        start = request.query_params.get("start")
+        start_date = (
+            date.fromisoformat(start)
+            if start
+            else stats.period_start(end_date - timezone.timedelta(days=365), period)
+        )
+    except ValueError:
+        return Response(
+            {"detail": '"start"/"end" must be YYYY-MM-DD dates'}, status=400
+        )
+
+    _prefs = models.Preferences.current_preferences(request)
+    with timing.measure("agg"):
+        _summaries = stats.summaries(
+            request.user, start_date, end_date, period, _prefs["max_calories"]
+        )
+    return Response(_summaries)
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def analytics_view(request: "HttpRequest"):
+    """
+    Rolling averages, streaks under the target calories and trend of
+    the user's daily calories up to today (see analytics.py), {} if
+    nothing was logged yet
+    """
+    _prefs = models.Preferences.current_preferences(request)
+    return Response(analytics.analytics(request.user, _prefs["max_calories"]) or {})
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def timings(request: "HttpRequest"):
+    """
+    p50/p95 of the timings recorded by timing.ServerTimingMiddleware in
+    this process, per url name
+    """
+    return Response(timing.summary())
@@ -1,6 +1,14 @@
 from django.apps import AppConfig
+from django.core import checks
+from django.db.models.signals import post_migrate
 
 
 class NutritionConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "django_nutrition"
+
+    def ready(self):
+        from . import caching, search, signals, timing  # noqa: F401 (connects the signal receivers)
+
+        post_migrate.connect(search.install_index, sender=self)
+        checks.register(caching.check_shared_caches, checks.Tags.caches)
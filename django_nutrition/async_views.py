@@ -0,0 +1,152 @@
+"""
+Native async versions of the read-only views (the calendar events api,
+the days list and the day page), using the async ORM and cache api.
+
+Under ASGI these don't hold a thread for the duration of the request.
+Use them by including django_nutrition.urls_async instead of
+django_nutrition.urls (same paths and url names).
+"""
+
+from functools import wraps
+
+from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import render
+from django.utils import timezone
+from django.views import View
+from django.views.decorators.http import condition, require_GET
+
+from . import api, compaction, conditional, fragments, models, rollup, timing, views
+
+
+def _with_data_version(view):
+    """
+    Resolve the user and memoize the data version before condition()
+    calls the (sync) conditional.py functions.
+    """
+
+    @wraps(view)
+    async def inner(request, *args, **kwargs):
+        request.user = await request.auser()
+        await models.DataVersion.acurrent(request)
+        return await view(request, *args, **kwargs)
+
+    return inner
+
+
+async def _alist(queryset) -> list:
+    return [row async for row in queryset.aiterator()]
+
+
+async def _afetch(queryset) -> list:
+    # for values_list() querysets, which aiterator() can't stream
+    return [row async for row in queryset]
+
+
+@require_GET
+@_with_data_version
+@condition(
+    etag_func=conditional.range_etag,
+    last_modified_func=conditional.range_last_modified,
+)
+async def days(request):
+    """
+    api.days
+    """
+    if not request.user.is_authenticated:
+        # (as rest_framework's IsAuthenticated with session authentication)
+        return JsonResponse(
+            {"detail": "Authentication credentials were not provided."}, status=403
+        )
+    batched = "ranges" in request.GET
+    try:
+        if batched:
+            ranges = api.event_ranges(request.GET)
+        else:
+            ranges = [api.event_range(request.GET)]
+    except ValueError as e:
+        return JsonResponse({"detail": str(e)}, status=400)
+    prefetch = request.GET.get("prefetch") in ["1", "true"]
+
+    _prefs = await models.Preferences.acurrent_preferences(request)
+    events = await api.arange_events(
+        request.user, ranges, _prefs["max_calories"], prefetch
+    )
+    return HttpResponse(
+        api.encode_events(events if batched else events[0]),
+        content_type="application/json",
+    )
+
+
+@login_required
+@_with_data_version
+@condition(
+    etag_func=conditional.page_etag,
+    last_modified_func=conditional.data_version_last_modified,
+)
+async def day(request, day_str):
+    """
+    views.day
+    """
+    await models.Preferences.acurrent_preferences(request)  # for the template
+    user = request.user
+    portions = await _alist(views.day_portions(user, day_str))
+    meals = api.MealTotal.split_portions(portions)
+    summaries = await _alist(views.day_summaries(user, day_str))
+    if summaries:
+        archives = await _alist(compaction.archives(user.pk, [summaries[0].date]))
+        meals = compaction.add_summary_meals(meals, summaries, archives)
+    meals_table = await fragments.aday_table(request.user.pk, day_str, meals)
+    return views.render_day(request, day_str, meals, meals_table)
+
+
+class DaysView(View):
+    """
+    views.DaysView
+    """
+
+    template_name = "django_nutrition/days.html"
+
+    async def get(self, request, *args, **kwargs):
+        request.user = await request.auser()
+        if not request.user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+
+        before = views.before_date(request)
+        if before:
+            _days, next_before = await self._days_before(request.user, before)
+        else:
+            start_date = timezone.now() - timezone.timedelta(weeks=4)
+            next_before = timezone.localdate(start_date)
+            summaries = views.days_summaries(request.user, next_before, None)
+            _days = views.to_days(
+                await _alist(views.recent_days_query(request.user, start_date)),
+                await _alist(summaries),
+            )
+
+        await fragments.aadd_meal_tables(request.user.pk, _days)
+        await models.Preferences.acurrent_preferences(request)  # for the template
+        context = {
+            "view": self,
+            "days": _days,
+            "object_list": _days,
+            "next_before": next_before,
+        }
+        with timing.measure("render"):
+            return render(request, self.template_name, context)
+
+    async def _days_before(self, user, before):
+        rows = await _afetch(views.page_query(user, before))
+        has_more = len(rows) > views.DaysView.PAGE_SIZE
+        rows = rows[: views.DaysView.PAGE_SIZE]
+        summaries = []
+        if rows and not rollup.enabled():
+            summaries = await _alist(
+                views.days_summaries(
+                    user, rows[-1], before - timezone.timedelta(days=1)
+                )
+            )
+            rows = await _alist(views.page_portions_query(user, before, rows[-1]))
+        _days = views.to_days(rows, summaries)
+        return _days, _days[-1].date if has_more else None
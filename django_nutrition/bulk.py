@@ -0,0 +1,190 @@
+"""
+Creation and update of many portions at once (e.g. a whole day, or a
+client's offline queue), for the api/portions/ endpoint.
+
+A request is a list of portions:
+
+    {"id": 12, ...}  update portion 12 with the given fields
+    {...}            create a portion: date (YYYY-MM-DD) and food (id)
+                     required, quantity (default 1), meal (id or null),
+                     note (optional)
+
+The whole list is validated against the user's foods, meals and portions
+with a constant number of queries and written in one transaction (all
+or nothing), then the affected days are refreshed at once.
+"""
+
+import math
+from datetime import date
+from typing import TYPE_CHECKING
+
+from django.db import transaction
+
+from . import models, signals, usage
+
+if TYPE_CHECKING:
+    from django.contrib.auth.models import User
+
+MAX_PORTIONS = 1000  # per request
+BATCH_SIZE = 1000
+FIELDS = ["date", "food", "meal", "quantity", "note"]
+# (the snapshot follows the food, see _clean)
+UPDATE_FIELDS = [*FIELDS, "calories_per_unit"]
+
+
+class InvalidPortions(ValueError):
+    """
+    Raised with the errors of all invalid portions, as
+    [{"index": <position in the list>, "error": <message>}, ...]
+    """
+
+    def __init__(self, errors: list[dict]):
+        super().__init__("invalid portions")
+        self.errors = errors
+
+
+def _is_id(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _referenced_ids(items: list, field: str) -> set[int]:
+    return {
+        item[field]
+        for item in items
+        if isinstance(item, dict) and _is_id(item.get(field))
+    }
+
+
+def _clean(
+    item: dict, foods: dict[int, float], meals: set[int], create: bool
+) -> dict[str, object]:
+    """
+    The model field values of the item's given fields.
+
+    :raises ValueError: for invalid or unknown values
+    """
+    unknown = set(item) - set(FIELDS) - {"id"}
+    if unknown:
+        raise ValueError(f"unknown fields: {sorted(unknown)}")
+    if create:
+        missing = [f for f in ["date", "food"] if f not in item]
+        if missing:
+            raise ValueError(f"missing fields: {missing}")
+
+    values = {}
+    if "date" in item:
+        if not isinstance(item["date"], str):
+            raise ValueError('"date" must be a YYYY-MM-DD date')
+        values["date"] = date.fromisoformat(item["date"])
+    if "food" in item:
+        if not _is_id(item["food"]) or item["food"] not in foods:
+            raise ValueError(f"unknown food {item['food']!r}")
+        values["food_id"] = item["food"]
+        # a new food is a new calorie snapshot (as in Portion.save)
+        values["calories_per_unit"] = foods[item["food"]]
+    if "meal" in item:
+        if item["meal"] is not None and (
+            not _is_id(item["meal"]) or item["meal"] not in meals
+        ):
+            raise ValueError(f"unknown meal {item['meal']!r}")
+        values["meal_id"] = item["meal"]
+    if "quantity" in item:
+        quantity = item["quantity"]
+        if not isinstance(quantity, (int, float)) or isinstance(quantity, bool):
+            raise ValueError('"quantity" must be a number')
+        if not math.isfinite(quantity):
+            raise ValueError('"quantity" must be finite')
+        values["quantity"] = float(quantity)
+    if "note" in item:
+        note = item["note"]
+        max_length = models.Portion._meta.get_field("note").max_length
+        if not isinstance(note, str) or len(note) > max_length:
+            raise ValueError(f'"note" must be a string of at most {max_length}')
+        values["note"] = note
+    return values
+
+
+def _build(
+    user: "User", items: list
+) -> tuple[list[models.Portion], list[models.Portion], dict[int, tuple]]:
+    """
+    :return: (new portions, updated portions, (date, food id, meal id)
+              of each updated portion before the update)
+    :raises InvalidPortions:
+    """
+    foods = dict(
+        models.Food.objects.filter(
+            user=user, pk__in=_referenced_ids(items, "food")
+        ).values_list("id", "calories")
+    )
+    meals = set(
+        models.Meal.objects.filter(
+            user=user, pk__in=_referenced_ids(items, "meal")
+        ).values_list("id", flat=True)
+    )
+    existing = models.Portion.objects.filter(user=user).in_bulk(
+        _referenced_ids(items, "id")
+    )
+
+    created, updated, before, errors = [], [], {}, []
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise TypeError("must be an object")
+            portion_id: int | None = item.get("id")
+            if portion_id is not None:
+                if not _is_id(portion_id) or portion_id not in existing:
+                    raise ValueError(f"unknown portion {portion_id!r}")
+                if portion_id in before:
+                    raise ValueError(f"portion {portion_id} given twice")
+            values = _clean(item, foods, meals, create=portion_id is None)
+        except (TypeError, ValueError) as e:
+            errors.append({"index": index, "error": str(e)})
+            continue
+
+        if portion_id is None:
+            created.append(models.Portion(user=user, **values))
+            continue
+        portion = existing[portion_id]
+        before[portion_id] = (portion.date, portion.food_id, portion.meal_id)
+        for field, value in values.items():
+            setattr(portion, field, value)
+        updated.append(portion)
+    if errors:
+        raise InvalidPortions(errors)
+    return created, updated, before
+
+
+def save_portions(user: "User", items: list) -> dict:
+    """
+    Create and update the portions (see the module documentation).
+
+    :return: {"created": [new portion ids], "updated": [updated ids]}
+    :raises InvalidPortions: if any portion is invalid (nothing is written)
+    """
+    if not isinstance(items, list):
+        raise InvalidPortions([{"index": None, "error": "expected a list"}])
+    if len(items) > MAX_PORTIONS:
+        raise InvalidPortions(
+            [{"index": None, "error": f"at most {MAX_PORTIONS} portions"}]
+        )
+    created, updated, before = _build(user, items)
+
+    with transaction.atomic():
+        models.Portion.objects.bulk_create(created, batch_size=BATCH_SIZE)
+        models.Portion.objects.bulk_update(
+            updated, UPDATE_FIELDS, batch_size=BATCH_SIZE
+        )
+
+    # bulk writes send no signals: refresh all the affected days at once
+    portions = created + updated
+    signals.send_portions_changed(
+        user.pk,
+        {p.date for p in portions} | {_date for _date, _, _ in before.values()},
+    )
+    usage.refresh(
+        user.pk,
+        food_ids={p.food_id for p in portions} | {f for _, f, _ in before.values()},
+        meal_ids={p.meal_id for p in portions} | {m for _, _, m in before.values()},
+    )
+    return {"created": [p.pk for p in created], "updated": [p.pk for p in updated]}
@@ -0,0 +1,181 @@
+import uuid
+from collections.abc import Iterable
+from typing import TYPE_CHECKING
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+if TYPE_CHECKING:
+    from datetime import date
+
+KEY_PREFIX = "django_nutrition"
+
+
+def get_cache():
+    """
+    The cache used by this app, settings.NUTRITION_CACHE (default: "default")
+    """
+    return caches[getattr(settings, "NUTRITION_CACHE", "default")]
+
+
+def _single_process() -> bool:
+    return getattr(settings, "NUTRITION_SINGLE_PROCESS", False)
+
+
+def get_events_cache():
+    """
+    The cache for calendar event month buckets, settings.NUTRITION_EVENTS_CACHE
+    (default: the NUTRITION_CACHE cache).  Configure its TIMEOUT (or
+    eviction policy) to bound it.
+
+    A LocMemCache is only used with settings.NUTRITION_SINGLE_PROCESS:
+    a bucket another process wrote to would stay stale in it while the
+    ETag (from the database) is fresh, so buckets aren't cached at all.
+    """
+    alias = getattr(settings, "NUTRITION_EVENTS_CACHE", None)
+    _cache = caches[alias] if alias else get_cache()
+    if isinstance(_cache, LocMemCache) and not _single_process():
+        return DummyCache("", {})
+    return _cache
+
+
+def get_fragments_cache():
+    """
+    The cache for rendered per-day fragments, settings.NUTRITION_FRAGMENTS_CACHE
+    (default: the NUTRITION_CACHE cache).  A DummyCache disables them.
+    """
+    alias = getattr(settings, "NUTRITION_FRAGMENTS_CACHE", None)
+    return caches[alias] if alias else get_cache()
+
+
+def check_shared_caches(app_configs=None, **kwargs):
+    """
+    System check: the generations invalidating cached fragments and
+    analytics are bumped by whichever process writes (a web worker,
+    nutrition_import, nutrition_compact, ...), so the caches holding them
+    must be shared by all processes (unless there is only one).
+    """
+    errors = []
+    if _single_process():
+        return errors
+    for setting, _cache in [
+        ("NUTRITION_CACHE", get_cache()),
+        ("NUTRITION_FRAGMENTS_CACHE", get_fragments_cache()),
+    ]:
+        if isinstance(_cache, LocMemCache):
+            errors.append(
+                checks.Warning(
+                    f"the {setting} cache is local to each process: writes by "
+                    "other processes (server workers, management commands) "
+                    "don't invalidate what it holds",
+                    hint="use a shared cache backend (e.g. Redis or Memcached)",
+                    id="django_nutrition.W001",
+                )
+            )
+    return errors
+
+
+def preferences_key(user_id: int) -> str:
+    return f"{KEY_PREFIX}:preferences:{user_id}"
+
+
+def invalidate_preferences(user_id: int):
+    get_cache().delete(preferences_key(user_id))
+
+
+def suggestions_key(user_id: int) -> str:
+    return f"{KEY_PREFIX}:suggestions:{user_id}"
+
+
+def get_generations(cache, keys: Iterable[str]) -> dict[str, str]:
+    """
+    Current generation token of each key, creating missing ones.
+
+    Cached values derived from some data are stored under a key that
+    includes the data's generation.  Bumping the generation orphans them,
+    even if a reader that loaded the old data stores its result after
+    the bump.
+    """
+    keys = list(keys)
+    generations = cache.get_many(keys)
+    missing = {k: uuid.uuid4().hex for k in keys if k not in generations}
+    if missing:
+        cache.set_many(missing, timeout=None)
+        generations.update(missing)
+    return generations
+
+
+async def aget_generations(cache, keys: Iterable[str]) -> dict[str, str]:
+    """
+    Async get_generations()
+    """
+    keys = list(keys)
+    generations = await cache.aget_many(keys)
+    missing = {k: uuid.uuid4().hex for k in keys if k not in generations}
+    if missing:
+        await cache.aset_many(missing, timeout=None)
+        generations.update(missing)
+    return generations
+
+
+def bump_generations(cache, keys: Iterable[str]):
+    cache.set_many({k: uuid.uuid4().hex for k in keys}, timeout=None)
+
+
+def month_of(day: "date") -> str:
+    return f"{day.year:04d}-{day.month:02d}"
+
+
+def events_month_generation_key(user_id: int, month: str) -> str:
+    return f"{KEY_PREFIX}:events-generation:{user_id}:{month}"
+
+
+def events_month_key(
+    user_id: int, month: str, generation: str, max_calories: float
+) -> str:
+    return f"{KEY_PREFIX}:events:{user_id}:{month}:{generation}:{max_calories}"
+
+
+def invalidate_event_months(user_id: int, dates: Iterable["date"]):
+    months = {month_of(d) for d in dates}
+    bump_generations(
+        get_events_cache(),
+        [events_month_generation_key(user_id, m) for m in months],
+    )
+
+
+def day_of(day: "date") -> str:
+    return f"{month_of(day)}-{day.day:02d}"
+
+
+def day_generation_key(user_id: int, day: "date") -> str:
+    return f"{KEY_PREFIX}:day-generation:{user_id}:{day_of(day)}"
+
+
+def fragment_key(name: str, user_id: int, day: "date", generation: str) -> str:
+    return f"{KEY_PREFIX}:fragment:{name}:{user_id}:{day_of(day)}:{generation}"
+
+
+def invalidate_days(user_id: int, dates: Iterable["date"]):
+    bump_generations(
+        get_fragments_cache(),
+        {day_generation_key(user_id, d) for d in dates},
+    )
+
+
+def analytics_key(user_id: int) -> str:
+    return f"{KEY_PREFIX}:analytics:{user_id}"
+
+
+def invalidate_analytics(user_id: int, dates: Iterable["date"]):
+    """
+    Drop the user's cached analytics.History if some dates are before its
+    first day (later days are reloaded by month generation).
+    """
+    _cache = get_cache()
+    _history = _cache.get(analytics_key(user_id))
+    if _history is not None and min(dates) < _history.first:
+        _cache.delete(analytics_key(user_id))
@@ -0,0 +1,278 @@
+"""
+Compaction of old portions into per-day, per-meal summary rows
+(models.MealSummary), so that the Portion table of long-time users
+stops growing with their history.
+
+compact() replaces the portions older than a date by the calories and
+count of each meal of their day, optionally keeping their detail in a
+compressed archive (models.PortionArchive, one row per day).  The
+totals don't change: the calendar events, the days list, the day page,
+the summaries and the rollup read the summary rows along with the live
+portions (a compacted day can get new portions later), in the same
+query where they aggregate: the summary rows are found through their
+(user, date) index, which costs little when there are none.
+"""
+
+import json
+import zlib
+from collections import defaultdict
+from collections.abc import Callable, Iterable
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import api, models, rollup, signals, usage
+
+DAYS_PER_CHUNK = 31  # compacted per transaction
+BATCH_SIZE = 1000
+DELETE_BATCH_SIZE = 500  # ids per DELETE (under SQLite's parameter limit)
+
+
+def policy_age() -> timedelta | None:
+    """
+    Age of the portions to compact, settings.NUTRITION_COMPACT_AFTER_DAYS
+    (default None: no compaction unless asked for one).
+    """
+    days = getattr(settings, "NUTRITION_COMPACT_AFTER_DAYS", None)
+    return None if days is None else timedelta(days=days)
+
+
+def archive_enabled() -> bool:
+    """
+    True if compaction keeps the portions' detail in PortionArchive,
+    settings.NUTRITION_COMPACT_ARCHIVE (default True).
+    """
+    return getattr(settings, "NUTRITION_COMPACT_ARCHIVE", True)
+
+
+def summaries(user_id: int, start_date: date | None, end_date: date | None):
+    """
+    The user's summary rows between the (inclusive, optional) dates, as
+    a lazy queryset.
+    """
+    rows = models.MealSummary.objects.filter(user_id=user_id)
+    if start_date is not None:
+        rows = rows.filter(date__gte=start_date)
+    if end_date is not None:
+        rows = rows.filter(date__lte=end_date)
+    return rows.select_related("meal").order_by("date", "id")
+
+
+def archives(user_id: int, dates: Iterable[date]):
+    return models.PortionArchive.objects.filter(user_id=user_id, date__in=set(dates))
+
+
+def _meal_name(summary: models.MealSummary) -> str:
+    return summary.meal.name if summary.meal else rollup.UNASSIGNED_MEAL
+
+
+def add_summary_meals(
+    meals: list["api.MealTotal"],
+    summaries: Iterable[models.MealSummary],
+    archives: Iterable[models.PortionArchive] = (),
+) -> list["api.MealTotal"]:
+    """
+    The meals of a day (from api.MealTotal.split_portions) with the
+    compacted ones added, listing their archived portions if given the
+    day's archive.
+    """
+    summaries = list(summaries)
+    meal_ids = {s.meal_id for s in summaries}
+    by_name = {m.name: m for m in meals}
+    archived_by_meal = defaultdict(list)
+    for p in (p for _archive in archives for p in archived_portions(_archive)):
+        # (the meal may have been deleted since)
+        archived_by_meal[p.meal_id if p.meal_id in meal_ids else None].append(p)
+    for summary in summaries:
+        name = _meal_name(summary)
+        _portions = archived_by_meal.pop(summary.meal_id, [])
+        meal = by_name.get(name)
+        if meal is None:
+            by_name[name] = api.MealTotal(name, _portions, calories=summary.calories)
+            continue
+        meal.portions = list(meal.portions) + _portions
+        meal.calories = api.round_01(meal.calories + summary.calories)
+    return list(by_name.values())
+
+
+def add_summary_days(
+    days: list["api.DayTotal"], summaries: Iterable[models.MealSummary]
+) -> list["api.DayTotal"]:
+    """
+    The days (from api.DayTotal.split_days) with the compacted ones
+    added, their compacted meals without portions.
+    """
+    by_date = {d.date: d for d in days}
+    per_day = defaultdict(list)
+    for summary in summaries:
+        per_day[summary.date].append(summary)
+    for _date, _summaries in per_day.items():
+        day = by_date.get(_date)
+        if day is None:
+            day = by_date[_date] = api.DayTotal(_date, [], calories=0, meals=[])
+        day.calories += sum(s.calories for s in _summaries)
+        day.meals = add_summary_meals(day.meals, _summaries)
+    return list(by_date.values())
+
+
+def archived_portions(archive: models.PortionArchive) -> list[models.Portion]:
+    """
+    The compacted portions of an archive, as unsaved Portion instances
+    (their foods only holding the name they had).
+    """
+    return [
+        models.Portion(
+            user_id=archive.user_id,
+            date=archive.date,
+            food=models.Food(id=item["food"], name=item["food_name"]),
+            meal_id=item["meal"],
+            quantity=item["quantity"],
+            note=item["note"],
+            calories_per_unit=item["calories_per_unit"],
+        )
+        for item in json.loads(zlib.decompress(archive.data))
+    ]
+
+
+def _archive_data(items: list[dict]) -> bytes:
+    return zlib.compress(json.dumps(items, separators=(",", ":")).encode())
+
+
+def _archive_item(portion: dict) -> dict:
+    return {
+        "food": portion["food_id"],
+        "food_name": portion["food__name"],
+        "meal": portion["meal_id"],
+        "quantity": portion["quantity"],
+        "note": portion["note"],
+        "calories_per_unit": portion["calories_per_unit"],
+    }
+
+
+def _compact_days(user_id: int, dates: list[date], archive: bool) -> int:
+    portions = list(
+        models.Portion.objects.filter(user_id=user_id, date__in=dates)
+        .order_by("id")
+        .values(
+            "id",
+            "date",
+            "food_id",
+            "food__name",
+            "meal_id",
+            "quantity",
+            "note",
+            "calories_per_unit",
+        )
+    )
+    if not portions:
+        return 0
+
+    # merged into the summary rows of days compacted before
+    rows: dict[tuple[date, int | None], models.MealSummary] = {
+        (s.date, s.meal_id): s
+        for s in models.MealSummary.objects.filter(user_id=user_id, date__in=dates)
+    }
+    existing = set(rows)
+    for p in portions:
+        key = (p["date"], p["meal_id"])
+        if key not in rows:
+            rows[key] = models.MealSummary(
+                user_id=user_id, date=p["date"], meal_id=p["meal_id"]
+            )
+        rows[key].calories += p["calories_per_unit"] * p["quantity"]
+        rows[key].portion_count += 1
+
+    with transaction.atomic():
+        models.MealSummary.objects.bulk_create(
+            [s for key, s in rows.items() if key not in existing],
+            batch_size=BATCH_SIZE,
+        )
+        models.MealSummary.objects.bulk_update(
+            [rows[key] for key in existing],
+            ["calories", "portion_count"],
+            batch_size=BATCH_SIZE,
+        )
+        if archive:
+            _archive(user_id, portions)
+        _delete([p["id"] for p in portions])
+    signals.send_portions_changed(user_id, {p["date"] for p in portions})
+    # the statistics count the live portions (as usage.rebuild does)
+    usage.refresh(
+        user_id,
+        food_ids={p["food_id"] for p in portions},
+        meal_ids={p["meal_id"] for p in portions},
+    )
+    return len(portions)
+
+
+def _delete(portion_ids: list[int]):
+    # plain DELETEs: Model.delete() would send the signals refreshing the
+    # totals and usage statistics once per portion, not once per chunk
+    table = connection.ops.quote_name(models.Portion._meta.db_table)
+    with connection.cursor() as cursor:
+        for i in range(0, len(portion_ids), DELETE_BATCH_SIZE):
+            ids = portion_ids[i : i + DELETE_BATCH_SIZE]
+            cursor.execute(
+                f"DELETE FROM {table} WHERE id IN ({', '.join(['%s'] * len(ids))})",
+                ids,
+            )
+
+
+def _archive(user_id: int, portions: list[dict]):
+    items = defaultdict(list)
+    for p in portions:
+        items[p["date"]].append(_archive_item(p))
+    _archives = {a.date: a for a in archives(user_id, items)}
+    for _date, _items in items.items():
+        _archive = _archives.get(_date)
+        if _archive is None:
+            _archives[_date] = models.PortionArchive(
+                user_id=user_id, date=_date, data=_archive_data(_items)
+            )
+        else:
+            _previous = json.loads(zlib.decompress(_archive.data))
+            _archive.data = _archive_data(_previous + _items)
+    models.PortionArchive.objects.bulk_create(
+        [a for a in _archives.values() if a.pk is None], batch_size=BATCH_SIZE
+    )
+    models.PortionArchive.objects.bulk_update(
+        [a for a in _archives.values() if a.pk is not None],
+        ["data"],
+        batch_size=BATCH_SIZE,
+    )
+
+
+def compact(
+    before: date,
+    user_ids: Iterable[int] | None = None,
+    archive: bool | None = None,
+    progress: Callable[[int], None] | None = None,
+) -> tuple[int, int]:
+    """
+    Compact the portions of the given users (default: everyone) dated
+    before the given date, DAYS_PER_CHUNK days per transaction.
+
+    :param archive: keep the portions' detail (default: archive_enabled())
+    :param progress: called with the number of portions done after each chunk
+    :return: (number of portions, number of days) compacted
+    """
+    if archive is None:
+        archive = archive_enabled()
+    portions = models.Portion.objects.filter(date__lt=before)
+    if user_ids is not None:
+        portions = portions.filter(user_id__in=list(user_ids))
+    user_dates = defaultdict(list)
+    for user_id, _date in (
+        portions.values_list("user_id", "date").distinct().order_by("user_id", "date")
+    ):
+        user_dates[user_id].append(_date)
+
+    done = days = 0
+    for user_id, dates in user_dates.items():
+        for i in range(0, len(dates), DAYS_PER_CHUNK):
+            done += _compact_days(user_id, dates[i : i + DAYS_PER_CHUNK], archive)
+            if progress:
+                progress(done)
+        days += len(dates)
+    return done, days
@@ -0,0 +1,75 @@
+"""
+ETag/Last-Modified functions for django.views.decorators.http.condition,
+derived from the per-user models.DataVersion.
+"""
+
+import hashlib
+from typing import TYPE_CHECKING, Optional
+
+from django.utils import timezone
+
+from . import models
+
+if TYPE_CHECKING:
+    from datetime import datetime
+
+    from django.http import HttpRequest
+
+
+def data_version_etag(request: "HttpRequest", *args, **kwargs) -> str | None:
+    if not request.user.is_authenticated:
+        return None
+    _version = models.DataVersion.current(request)
+    return f"{request.user.pk}-{_version.version if _version else 0}"
+
+
+def page_etag(request: "HttpRequest", *args, **kwargs) -> str | None:
+    """
+    Like data_version_etag, but also changes with the CSRF secret, since
+    rendered pages embed a CSRF token (e.g. in the logout form).
+    """
+    _etag = data_version_etag(request)
+    if _etag is None:
+        return None
+    _csrf = request.META.get("CSRF_COOKIE", "")
+    return f"{_etag}-{hashlib.sha256(_csrf.encode()).hexdigest()[:8]}"
+
+
+def data_version_last_modified(
+    request: "HttpRequest", *args, **kwargs
+) -> Optional["datetime"]:
+    _version = models.DataVersion.current(request)
+    return _version.modified if _version else None
+
+
+def _default_range(request: "HttpRequest") -> bool:
+    # without an explicit "start" and "end" the range ends (or starts)
+    # today, so the response changes at midnight without any write
+    if "ranges" in request.GET:
+        return False
+    return not (request.GET.get("start") and request.GET.get("end"))
+
+
+def range_etag(request: "HttpRequest", *args, **kwargs) -> str | None:
+    """
+    Like data_version_etag, but also changes with the day when the
+    request's range defaults to one relative to today.
+    """
+    _etag = data_version_etag(request)
+    if _etag is None or not _default_range(request):
+        return _etag
+    return f"{_etag}-{timezone.localdate().isoformat()}"
+
+
+def range_last_modified(
+    request: "HttpRequest", *args, **kwargs
+) -> Optional["datetime"]:
+    """
+    Like data_version_last_modified, but no earlier than today's (local)
+    midnight when the request's range defaults to one relative to today.
+    """
+    _modified = data_version_last_modified(request)
+    if _modified is None or not _default_range(request):
+        return _modified
+    _midnight = timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0)
+    return max(_modified, _midnight)
@@ -0,0 +1,165 @@
+"""
+Copying the portions of a day, or of one meal of a day, to other days,
+and meal templates: portions saved under a name to log them again later.
+
+The units are those of the day page (api.MealTotal.split_portions): a
+whole day, or the portions with one meal name ("other" for portions
+without a meal).  Logging them on any number of days is a single
+bulk_create, followed by one refresh of the affected days.
+"""
+
+from collections.abc import Iterable
+from typing import TYPE_CHECKING, Optional
+
+from django.db import transaction
+from django.db.models import Q
+
+from . import models, rollup, signals, usage
+
+if TYPE_CHECKING:
+    from datetime import date
+
+    from django.contrib.auth.models import User
+
+MAX_TARGET_DATES = 62  # per copy
+BATCH_SIZE = 1000
+
+
+def source_portions(user: "User", day: "date", meal_name: str | None = None):
+    """
+    The portions of the day, or of one of its meals (by name).
+    """
+    portions = models.Portion.objects.filter(user=user, date=day)
+    if meal_name is None:
+        return portions
+    condition = Q(meal__name=meal_name)
+    if meal_name == rollup.UNASSIGNED_MEAL:
+        condition |= Q(meal__isnull=True)
+    return portions.filter(condition)
+
+
+def meal_names(user: "User", day: "date") -> list[str]:
+    """
+    The day's meal names, as grouped on the day page.
+    """
+    names = (
+        source_portions(user, day).order_by("id").values_list("meal__name", flat=True)
+    )
+    return list(dict.fromkeys(name or rollup.UNASSIGNED_MEAL for name in names))
+
+
+def _log(user_id: int, portions: list["models.Portion"]) -> list["models.Portion"]:
+    if not portions:
+        return portions
+    with transaction.atomic():
+        models.Portion.objects.bulk_create(portions, batch_size=BATCH_SIZE)
+    # bulk_create sends no signals: refresh the target days at once
+    signals.send_portions_changed(user_id, {p.date for p in portions})
+    usage.refresh_portions(user_id, portions)
+    return portions
+
+
+def _dates(target_dates: Iterable["date"]) -> list["date"]:
+    target_dates = sorted(set(target_dates))
+    if len(target_dates) > MAX_TARGET_DATES:
+        raise ValueError(f"at most {MAX_TARGET_DATES} dates")
+    return target_dates
+
+
+def copy_portions(
+    user: "User",
+    day: "date",
+    target_dates: Iterable["date"],
+    meal_name: str | None = None,
+) -> list["models.Portion"]:
+    """
+    Copy the portions of the day (or of one of its meals) to each of the
+    target dates.
+
+    :return: the new portions (none if there was nothing to copy)
+    :raises ValueError: for too many target dates
+    """
+    target_dates = _dates(target_dates)
+    sources = list(
+        source_portions(user, day, meal_name).select_related("food").order_by("id")
+    )
+    return _log(
+        user.pk,
+        [
+            models.Portion(
+                user=user,
+                date=target_date,
+                food_id=p.food_id,
+                meal_id=p.meal_id,
+                quantity=p.quantity,
+                note=p.note,
+                # logged now: the food's current calories
+                calories_per_unit=p.food.calories,
+            )
+            for target_date in target_dates
+            for p in sources
+        ],
+    )
+
+
+def save_template(
+    user: "User", name: str, day: "date", meal_name: str | None = None
+) -> Optional["models.MealTemplate"]:
+    """
+    Save the portions of the day (or of one of its meals) as the user's
+    template with that name, replacing the portions of an existing one.
+
+    :return: the template, None if there was nothing to save
+    """
+    sources = list(source_portions(user, day, meal_name).order_by("id"))
+    if not sources:
+        return None
+    with transaction.atomic():
+        template, created = models.MealTemplate.objects.get_or_create(
+            user=user, name=name
+        )
+        if not created:
+            template.items.all().delete()
+        models.MealTemplateItem.objects.bulk_create(
+            [
+                models.MealTemplateItem(
+                    template=template,
+                    food_id=p.food_id,
+                    meal_id=p.meal_id,
+                    quantity=p.quantity,
+                    note=p.note,
+                )
+                for p in sources
+            ],
+            batch_size=BATCH_SIZE,
+        )
+    return template
+
+
+def apply_template(
+    template: "models.MealTemplate", target_dates: Iterable["date"]
+) -> list["models.Portion"]:
+    """
+    Log the template's portions on each of the target dates.
+
+    :return: the new portions
+    :raises ValueError: for too many target dates
+    """
+    target_dates = _dates(target_dates)
+    items = list(template.items.select_related("food").order_by("id"))
+    return _log(
+        template.user_id,
+        [
+            models.Portion(
+                user_id=template.user_id,
+                date=target_date,
+                food_id=item.food_id,
+                meal_id=item.meal_id,
+                quantity=item.quantity,
+                note=item.note,
+                calories_per_unit=item.food.calories,
+            )
+            for target_date in target_dates
+            for item in items
+        ],
+    )
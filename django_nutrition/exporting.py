@@ -0,0 +1,176 @@
+"""
+Streaming CSV/JSON lines export of a user's foods and portions, in the
+format read by importing.py (portions also get a "calories" column).
+
+The portions of compacted days (compaction.py) are exported from their
+archive.  Those compacted without one are exported as one row per meal
+with an empty food, their count in the note: the importer reports them
+as errors rather than guessing.
+"""
+
+import csv
+import heapq
+import json
+import zlib
+from collections import defaultdict
+from collections.abc import Iterable, Iterator
+from itertools import groupby, islice
+from operator import itemgetter
+from typing import TYPE_CHECKING
+
+from . import api, compaction, models
+
+if TYPE_CHECKING:
+    from django.contrib.auth.models import User
+
+FORMATS = ["csv", "jsonl"]
+KINDS = ["foods", "portions"]
+FIELDS = {
+    "foods": ["name", "calories"],
+    "portions": ["date", "food", "quantity", "meal", "note", "calories"],
+}
+CHUNK_SIZE = 2000  # rows fetched per database round trip
+DAYS_PER_CHUNK = 100  # compacted days (and their archives) per round trip
+BUFFER_SIZE = 64 * 1024  # bytes yielded at a time
+
+
+def food_rows(user: "User", chunk_size: int = CHUNK_SIZE) -> Iterator[dict]:
+    foods = models.Food.objects.filter(user=user).order_by("name", "id")
+    for _food in foods.iterator(chunk_size=chunk_size):
+        yield {"name": _food.name, "calories": _food.calories}
+
+
+def _live_rows(user: "User", chunk_size: int) -> Iterator[dict]:
+    portions = (
+        models.Portion.objects.filter(user=user)
+        .select_related("food", "meal")
+        .order_by("date", "id")
+    )
+    for _portion in portions.iterator(chunk_size=chunk_size):
+        yield {
+            "date": _portion.date.isoformat(),
+            "food": _portion.food.name,
+            "quantity": _portion.quantity,
+            "meal": _portion.meal.name if _portion.meal else "",
+            "note": _portion.note,
+            "calories": _portion.calories_rounded_01(),
+        }
+
+
+def _compacted_day_rows(
+    summaries: list[models.MealSummary],
+    archive: models.PortionArchive | None,
+) -> Iterator[dict]:
+    meal_ids = {s.meal_id for s in summaries}
+    archived = defaultdict(list)
+    for p in compaction.archived_portions(archive) if archive else []:
+        # (the meal may have been deleted since, as in add_summary_meals)
+        archived[p.meal_id if p.meal_id in meal_ids else None].append(p)
+    for summary in summaries:
+        meal = summary.meal.name if summary.meal else ""
+        _portions = archived.pop(summary.meal_id, [])
+        for p in _portions:
+            yield {
+                "date": summary.date.isoformat(),
+                "food": p.food.name,
+                "quantity": p.quantity,
+                "meal": meal,
+                "note": p.note,
+                "calories": p.calories_rounded_01(),
+            }
+        # compacted without an archive (or partly, by a later compaction)
+        missing = summary.portion_count - len(_portions)
+        if missing > 0:
+            yield {
+                "date": summary.date.isoformat(),
+                "food": "",
+                "quantity": 1,
+                "meal": meal,
+                "note": f"compacted portions: {missing}",
+                "calories": api.round_01(
+                    summary.calories - sum(p.calories() for p in _portions)
+                ),
+            }
+
+
+def _compacted_rows(user: "User", chunk_size: int) -> Iterator[dict]:
+    summaries = (
+        models.MealSummary.objects.filter(user=user)
+        .select_related("meal")
+        .order_by("date", "id")
+    )
+    days = groupby(summaries.iterator(chunk_size=chunk_size), lambda s: s.date)
+    while True:
+        chunk = [(_date, list(_s)) for _date, _s in islice(days, DAYS_PER_CHUNK)]
+        if not chunk:
+            return
+        _archives = {
+            a.date: a for a in compaction.archives(user.pk, [d for d, _ in chunk])
+        }
+        for _date, _summaries in chunk:
+            yield from _compacted_day_rows(_summaries, _archives.get(_date))
+
+
+def portion_rows(user: "User", chunk_size: int = CHUNK_SIZE) -> Iterator[dict]:
+    """
+    The user's live and compacted portions, by date.
+    """
+    # (on the same date, the compacted rows first: they were logged before)
+    return heapq.merge(
+        _compacted_rows(user, chunk_size),
+        _live_rows(user, chunk_size),
+        key=itemgetter("date"),
+    )
+
+
+class _Echo:
+    # csv.writer target that returns the row instead of buffering it
+    def write(self, value):
+        return value
+
+
+def encode_rows(rows: Iterable[dict], kind: str, file_format: str) -> Iterator[str]:
+    if file_format == "csv":
+        writer = csv.DictWriter(_Echo(), fieldnames=FIELDS[kind])
+        yield writer.writeheader()
+        for row in rows:
+            yield writer.writerow(row)
+    elif file_format == "jsonl":
+        for row in rows:
+            yield json.dumps(row) + "\n"
+    else:
+        raise ValueError(f"unknown format: {file_format}")
+
+
+def _buffered(lines: Iterable[str]) -> Iterator[bytes]:
+    buffer = []
+    size = 0
+    for line in lines:
+        data = line.encode()
+        buffer.append(data)
+        size += len(data)
+        if size >= BUFFER_SIZE:
+            yield b"".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+def _gzipped(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)  # gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_stream(
+    user: "User", kind: str, file_format: str, gzip: bool = False
+) -> Iterator[bytes]:
+    if kind not in KINDS:
+        raise ValueError(f"unknown kind: {kind}")
+    rows = food_rows(user) if kind == "foods" else portion_rows(user)
+    chunks = _buffered(encode_rows(rows, kind, file_format))
+    return _gzipped(chunks) if gzip else chunks
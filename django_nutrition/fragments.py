@@ -0,0 +1,138 @@
+"""
+Cached rendered per-day tables: the meal table of each day in the days
+list and the meal/portion table of the day page.
+
+A fragment is cached under (template, user, date, generation of the day).
+The day's generation is bumped whenever its portions change (the
+portions_changed signal) or one of its foods is renamed (see signals.py),
+so fragments are only re-rendered for the days that changed.
+The fragments don't depend on the request (no CSRF token or user
+preferences).
+"""
+
+from datetime import date
+from typing import TYPE_CHECKING
+
+from django.template import loader
+from django.utils.dateparse import parse_date
+from django.utils.safestring import SafeString, mark_safe
+
+from . import caching, timing
+
+if TYPE_CHECKING:
+    from . import api
+
+MEALS_TABLE = "django_nutrition/meals.html"
+DAY_TABLE = "django_nutrition/day-meals.html"
+
+
+def _generation_keys(user_id: int, contexts: dict[date, dict]) -> dict[date, str]:
+    return {d: caching.day_generation_key(user_id, d) for d in contexts}
+
+
+def _fragment_keys(
+    template_name: str,
+    user_id: int,
+    generation_keys: dict[date, str],
+    generations: dict[str, str],
+) -> dict[date, str]:
+    return {
+        d: caching.fragment_key(template_name, user_id, d, generations[k])
+        for d, k in generation_keys.items()
+    }
+
+
+def _render_missing(
+    template_name: str,
+    contexts: dict[date, dict],
+    keys: dict[date, str],
+    found: dict[str, str],
+) -> dict[str, str]:
+    template = loader.get_template(template_name)
+    with timing.measure("render"):
+        return {
+            keys[d]: template.render(context)
+            for d, context in contexts.items()
+            if keys[d] not in found
+        }
+
+
+def render(
+    template_name: str, user_id: int, contexts: dict[date, dict]
+) -> dict[date, SafeString]:
+    """
+    template_name rendered with the context of each day, from the cache
+    unless the day changed since.  Two cache round trips for any number
+    of days (plus one to store the rendered ones).
+    """
+    _cache = caching.get_fragments_cache()
+    generation_keys = _generation_keys(user_id, contexts)
+    generations = caching.get_generations(_cache, generation_keys.values())
+    keys = _fragment_keys(template_name, user_id, generation_keys, generations)
+    found = _cache.get_many(keys.values())
+    rendered = _render_missing(template_name, contexts, keys, found)
+    if rendered:
+        _cache.set_many(rendered)
+        found.update(rendered)
+    return {d: mark_safe(found[k]) for d, k in keys.items()}
+
+
+async def arender(
+    template_name: str, user_id: int, contexts: dict[date, dict]
+) -> dict[date, SafeString]:
+    """
+    Async render()
+    """
+    _cache = caching.get_fragments_cache()
+    generation_keys = _generation_keys(user_id, contexts)
+    generations = await caching.aget_generations(_cache, generation_keys.values())
+    keys = _fragment_keys(template_name, user_id, generation_keys, generations)
+    found = await _cache.aget_many(keys.values())
+    rendered = _render_missing(template_name, contexts, keys, found)
+    if rendered:
+        await _cache.aset_many(rendered)
+        found.update(rendered)
+    return {d: mark_safe(found[k]) for d, k in keys.items()}
+
+
+def _meals_contexts(days: list["api.DayTotal"]) -> dict[date, dict]:
+    return {d.date: {"meals": d.meals} for d in days}
+
+
+def _day_context(day_str: str, meals: list["api.MealTotal"]) -> dict[date, dict]:
+    return {parse_date(day_str): {"meals": meals}}
+
+
+def add_meal_tables(user_id: int, days: list["api.DayTotal"]):
+    """
+    Set the rendered meal table of each day (DayTotal.meals_table).
+    """
+    tables = render(MEALS_TABLE, user_id, _meals_contexts(days))
+    for _day in days:
+        _day.meals_table = tables[_day.date]
+
+
+async def aadd_meal_tables(user_id: int, days: list["api.DayTotal"]):
+    """
+    Async add_meal_tables()
+    """
+    tables = await arender(MEALS_TABLE, user_id, _meals_contexts(days))
+    for _day in days:
+        _day.meals_table = tables[_day.date]
+
+
+def day_table(user_id: int, day_str: str, meals: list["api.MealTotal"]) -> SafeString:
+    """
+    The rendered meal/portion table of the day page.
+    """
+    return next(iter(render(DAY_TABLE, user_id, _day_context(day_str, meals)).values()))
+
+
+async def aday_table(
+    user_id: int, day_str: str, meals: list["api.MealTotal"]
+) -> SafeString:
+    """
+    Async day_table()
+    """
+    tables = await arender(DAY_TABLE, user_id, _day_context(day_str, meals))
+    return next(iter(tables.values()))
@@ -0,0 +1,239 @@
+"""
+Streaming import of foods and portions from CSV or JSON lines.
+
+Rows are read one at a time and written with bulk_create in chunks (one
+transaction per chunk), so memory use doesn't depend on the file size.
+
+foods:    name, calories
+portions: date (YYYY-MM-DD), food (name), quantity (default 1),
+          meal (name, optional - created if unknown), note (optional)
+"""
+
+import csv
+import json
+import math
+from collections.abc import Callable, Iterable, Iterator
+from datetime import date
+from typing import IO, TYPE_CHECKING
+
+from django.db import transaction
+
+from . import models, signals, usage
+
+if TYPE_CHECKING:
+    from django.contrib.auth.models import User
+
+FORMATS = ["csv", "jsonl"]
+KINDS = ["foods", "portions"]
+CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+
+
+def guess_format(filename: str) -> str:
+    return "jsonl" if filename.lower().endswith((".jsonl", ".ndjson")) else "csv"
+
+
+def _csv_rows(stream: IO[str]) -> Iterator[dict | csv.Error]:
+    reader = csv.DictReader(stream)
+    while True:
+        try:
+            yield next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            yield e  # the reader goes on with the next line
+
+
+def _jsonl_rows(stream: IO[str]) -> Iterator[dict | None | ValueError]:
+    for line in stream:
+        line = line.strip()
+        if not line:
+            yield None
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield e
+
+
+def read_rows(
+    stream: IO[str], file_format: str
+) -> Iterator[dict | None | ValueError | csv.Error]:
+    """
+    Yield the rows of the stream as dicts, None for blank lines and
+    the exception for lines that can't be parsed.  Reading stops at the
+    first bytes that can't be decoded (yielding the UnicodeDecodeError).
+    """
+    if file_format == "csv":
+        rows = _csv_rows(stream)
+    elif file_format == "jsonl":
+        rows = _jsonl_rows(stream)
+    else:
+        raise ValueError(f"unknown format: {file_format}")
+    try:
+        yield from rows
+    except UnicodeDecodeError as e:
+        yield e
+
+
+class ImportResult:
+    def __init__(self):
+        self.created = 0
+        self.skipped = 0
+        self.error_count = 0
+        self.errors = []
+
+    def add_error(self, row_number: int, message: str):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"row": row_number, "error": message})
+
+    def to_dict(self):
+        return {
+            "created": self.created,
+            "skipped": self.skipped,
+            "error_count": self.error_count,
+            "errors": self.errors,
+        }
+
+
+def _chunked_import(
+    rows: Iterable[dict],
+    make_instance: Callable[[dict], object],
+    flush: Callable[[list], None],
+    chunk_size: int,
+    result: ImportResult,
+):
+    chunk = []
+    for row_number, row in enumerate(rows, start=1):
+        if row is None:
+            continue  # blank line
+        try:
+            if isinstance(row, (ValueError, csv.Error)):
+                raise row
+            instance = make_instance(row)
+        except (AttributeError, KeyError, TypeError, ValueError, csv.Error) as e:
+            result.add_error(row_number, f"{type(e).__name__}: {e}")
+            continue
+        if instance is None:
+            result.skipped += 1
+            continue
+        chunk.append(instance)
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+            result.created += len(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+        result.created += len(chunk)
+
+
+def _number(row: dict, field: str, default=None) -> float:
+    value = float(row[field] if default is None else row.get(field) or default)
+    if not math.isfinite(value):
+        raise ValueError(f'"{field}" must be finite')
+    return value
+
+
+def _text(value: str, model, field: str) -> str:
+    max_length = model._meta.get_field(field).max_length
+    if len(value) > max_length:
+        raise ValueError(f'"{field}" must be at most {max_length} characters')
+    return value
+
+
+def import_foods(
+    user: "User", rows: Iterable[dict], chunk_size: int = CHUNK_SIZE
+) -> ImportResult:
+    """
+    Create the foods, skipping names the user already has.
+    """
+    result = ImportResult()
+    names = set(models.Food.objects.filter(user=user).values_list("name", flat=True))
+
+    def _make_food(row):
+        name = _text(row["name"].strip(), models.Food, "name")
+        if not name:
+            raise ValueError("empty name")
+        if name in names:
+            return None
+        calories = _number(row, "calories")
+        names.add(name)
+        return models.Food(user=user, name=name, calories=calories)
+
+    def _flush(chunk):
+        with transaction.atomic():
+            models.Food.objects.bulk_create(chunk)
+        models.DataVersion.bump(user.pk)  # bulk_create sends no signals
+
+    _chunked_import(rows, _make_food, _flush, chunk_size, result)
+    return result
+
+
+def import_portions(
+    user: "User", rows: Iterable[dict], chunk_size: int = CHUNK_SIZE
+) -> ImportResult:
+    """
+    Create the portions, resolving food and meal names with an in-memory
+    lookup of the user's foods and meals.  Unknown meals are created,
+    rows with unknown foods are reported as errors.
+    """
+    result = ImportResult()
+    foods: dict[str, tuple[int, float]] = {
+        name: (food_id, calories)
+        for name, food_id, calories in models.Food.objects.filter(
+            user=user
+        ).values_list("name", "id", "calories")
+    }
+    meals: dict[str, int] = dict(
+        models.Meal.objects.filter(user=user).values_list("name", "id")
+    )
+
+    def _meal_id(name):
+        if name not in meals:
+            meals[name] = models.Meal.objects.create(user=user, name=name).pk
+        return meals[name]
+
+    def _make_portion(row):
+        food_name = row["food"].strip()
+        if food_name not in foods:
+            raise ValueError(f'unknown food "{food_name}"')
+        meal_name = _text((row.get("meal") or "").strip(), models.Meal, "name")
+        food_id, calories = foods[food_name]
+        day = date.fromisoformat(row["date"].strip())
+        quantity = _number(row, "quantity", default=1)
+        note = _text((row.get("note") or "").strip(), models.Portion, "note")
+        return models.Portion(
+            user=user,
+            date=day,
+            food_id=food_id,
+            calories_per_unit=calories,
+            meal_id=_meal_id(meal_name) if meal_name else None,
+            quantity=quantity,
+            note=note,
+        )
+
+    def _flush(chunk):
+        with transaction.atomic():
+            models.Portion.objects.bulk_create(chunk)
+        # bulk_create sends no signals: refresh the chunk's days at once
+        signals.send_portions_changed(user.pk, {p.date for p in chunk})
+        usage.refresh_portions(user.pk, chunk)
+
+    _chunked_import(rows, _make_portion, _flush, chunk_size, result)
+    return result
+
+
+def import_stream(
+    user: "User",
+    stream: IO[str],
+    kind: str,
+    file_format: str,
+    chunk_size: int = CHUNK_SIZE,
+) -> ImportResult:
+    if kind not in KINDS:
+        raise ValueError(f"unknown kind: {kind}")
+    rows = read_rows(stream, file_format)
+    if kind == "foods":
+        return import_foods(user, rows, chunk_size)
+    return import_portions(user, rows, chunk_size)
@@ -0,0 +1,237 @@
+import asyncio
+import json
+import random
+import statistics
+import time
+import tracemalloc
+import types
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import AsyncClient, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path, reverse
+from django.utils import timezone
+
+from django_nutrition import models, rollup, usage
+
+USERNAME_PREFIX = "nutrition-bench-"
+MEAL_NAMES = ["breakfast", "lunch", "dinner", "snack"]
+BATCH_SIZE = 1000
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a synthetic dataset, time the main views through the test "
+        "client and print p50/p95 latency, query counts and peak memory as JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1)
+        parser.add_argument("--foods", type=int, default=100, help="per user")
+        parser.add_argument("--portions-per-day", type=int, default=5)
+        parser.add_argument("--years", type=float, default=1)
+        parser.add_argument(
+            "--iterations", type=int, default=20, help="requests per view"
+        )
+        parser.add_argument(
+            "--concurrency",
+            type=int,
+            default=20,
+            help="simultaneous ASGI requests when comparing against WSGI",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--label", default="", help="free text copied to the report"
+        )
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help="don't delete the generated users and their data afterwards",
+        )
+
+    def handle(self, *args, **options):
+        if User.objects.filter(username__startswith=USERNAME_PREFIX).exists():
+            raise CommandError(
+                f'users named "{USERNAME_PREFIX}*" exist, delete them first'
+            )
+
+        random.seed(options["seed"])
+        started = time.perf_counter()
+        users = self._generate(options)
+        generate_seconds = time.perf_counter() - started
+
+        try:
+            with override_settings(
+                ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, "testserver"]
+            ):
+                results = self._run(users[0], options["iterations"])
+                asgi = self._compare_asgi(
+                    users[0], options["iterations"], options["concurrency"]
+                )
+        finally:
+            if not options["keep"]:
+                User.objects.filter(pk__in=[u.pk for u in users]).delete()
+
+        report = {
+            "label": options["label"],
+            "params": {
+                k: options[k]
+                for k in [
+                    "users",
+                    "foods",
+                    "portions_per_day",
+                    "years",
+                    "iterations",
+                    "concurrency",
+                ]
+            },
+            "generate_seconds": round(generate_seconds, 3),
+            "use_rollup": rollup.enabled(),
+            "results": results,
+            "asgi": asgi,
+        }
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def _generate(self, options):
+        User.objects.bulk_create(
+            User(username=f"{USERNAME_PREFIX}{i}", password="!")
+            for i in range(options["users"])
+        )
+        # (not all backends return the primary keys from bulk_create)
+        users = list(
+            User.objects.filter(username__startswith=USERNAME_PREFIX).order_by("pk")
+        )
+
+        today = timezone.now().date()
+        days = int(options["years"] * 365)
+        for _user in users:
+            models.Food.objects.bulk_create(
+                models.Food(
+                    user=_user,
+                    name=f"food {i:05d}",
+                    calories=random.randint(10, 800),
+                )
+                for i in range(options["foods"])
+            )
+            foods = list(models.Food.objects.filter(user=_user))
+            models.Meal.objects.bulk_create(
+                models.Meal(user=_user, name=_name) for _name in MEAL_NAMES
+            )
+            meals = list(models.Meal.objects.filter(user=_user))
+            models.Portion.objects.bulk_create(
+                (
+                    models.Portion(
+                        user=_user,
+                        date=today - timedelta(days=day),
+                        food=_food,
+                        meal=random.choice(meals + [None]),
+                        quantity=random.choice([0.5, 1, 1, 1, 2]),
+                        calories_per_unit=_food.calories,
+                    )
+                    for day in range(days)
+                    for _food in random.choices(foods, k=options["portions_per_day"])
+                ),
+                batch_size=BATCH_SIZE,
+            )
+        # bulk_create sends no signals
+        rollup.rebuild([u.pk for u in users])
+        usage.rebuild([u.pk for u in users])
+        return users
+
+    def _run(self, user, iterations):
+        client = Client()
+        client.force_login(user)
+
+        today = timezone.now().date()
+        urls = {
+            "day-events": reverse("day-events")
+            + f"?start={today - timedelta(weeks=6)}&end={today}",
+            "days": reverse("days"),
+            "day": reverse("day", args=[today.isoformat()]),
+            "foods": reverse("foods"),
+            "add_or_edit_portion": reverse("add_or_edit_portion"),
+        }
+        return {name: self._time(client, url, iterations) for name, url in urls.items()}
+
+    def _time(self, client, url, iterations):
+        latencies = []
+        queries = []
+        for _ in range(iterations):
+            with CaptureQueriesContext(connection) as ctx:
+                started = time.perf_counter()
+                response = client.get(url)
+                latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                raise CommandError(f"{url}: status {response.status_code}")
+            queries.append(len(ctx.captured_queries))
+
+        # measured separately, tracing slows everything down
+        tracemalloc.start()
+        try:
+            client.get(url)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        return {
+            "url": url,
+            "first_ms": round(latencies[0] * 1000, 3),
+            "p50_ms": round(statistics.median(latencies) * 1000, 3),
+            "p95_ms": round(_percentile(latencies, 0.95) * 1000, 3),
+            "queries_first": queries[0],
+            "queries_p50": statistics.median(queries),
+            "peak_memory_kb": round(peak / 1024, 1),
+        }
+
+    def _compare_asgi(self, user, rounds, concurrency):
+        """
+        Calendar loads per second: a WSGI worker serving the sync view one
+        request at a time vs. the async view (urls_async) serving
+        concurrency simultaneous requests in the ASGI handler.
+        """
+        today = timezone.now().date()
+        url = reverse("day-events") + f"?start={today - timedelta(weeks=6)}&end={today}"
+        # the app's urls, mounted where they are, with the async views
+        prefix = reverse("days").lstrip("/")
+        urlconf = types.ModuleType("nutrition_bench_urls")
+        urlconf.urlpatterns = [path(prefix, include("django_nutrition.urls_async"))]
+        count = rounds * concurrency
+
+        client = Client()
+        client.force_login(user)
+        started = time.perf_counter()
+        for _ in range(count):
+            client.get(url)
+        wsgi_seconds = time.perf_counter() - started
+
+        async def _async_run():
+            async_client = AsyncClient()
+            await async_client.aforce_login(user)
+            started = time.perf_counter()
+            for _ in range(rounds):
+                responses = await asyncio.gather(
+                    *(async_client.get(url) for _ in range(concurrency))
+                )
+                if any(r.status_code != 200 for r in responses):
+                    raise CommandError(f"{url}: async view failed")
+            return time.perf_counter() - started
+
+        with override_settings(ROOT_URLCONF=urlconf):
+            asgi_seconds = async_to_sync(_async_run)()
+
+        return {
+            "url": url,
+            "requests": count,
+            "wsgi_per_second": round(count / wsgi_seconds, 1),
+            "asgi_per_second": round(count / asgi_seconds, 1),
+        }
@@ -0,0 +1,54 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_nutrition import models, pricing
+
+
+class Command(BaseCommand):
+    help = (
+        "Snapshot the food calories of portions logged before "
+        "Portion.calories_per_unit existed, or with --reprice apply foods' "
+        "current calories to their past portions"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--reprice",
+            action="append",
+            type=int,
+            dest="food_ids",
+            help="re-price the portions of this food id (can be repeated)",
+        )
+        parser.add_argument(
+            "--since",
+            type=date.fromisoformat,
+            help="with --reprice, only portions since this date (YYYY-MM-DD)",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=pricing.CHUNK_SIZE,
+            help="portions per transaction",
+        )
+
+    def handle(self, *args, food_ids=None, since=None, chunk_size=None, **options):
+        if chunk_size < 1:
+            raise CommandError("--chunk-size must be positive")
+        if not food_ids:
+            count = pricing.backfill(
+                chunk_size, progress=lambda done: self.stderr.write(f"{done}...")
+            )
+            self.stdout.write(self.style.SUCCESS(f"snapshotted {count} portions"))
+            return
+
+        foods = models.Food.objects.in_bulk(food_ids)
+        missing = set(food_ids) - foods.keys()
+        if missing:
+            raise CommandError(
+                f"unknown food id(s): {', '.join(map(str, sorted(missing)))}"
+            )
+        count = sum(
+            pricing.reprice(_food, since, chunk_size) for _food in foods.values()
+        )
+        self.stdout.write(self.style.SUCCESS(f"re-priced {count} portions"))
@@ -0,0 +1,70 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from django_nutrition import compaction
+
+
+class Command(BaseCommand):
+    help = (
+        "Compact the portions older than NUTRITION_COMPACT_AFTER_DAYS (or "
+        "--older-than) into per-day, per-meal summary rows, keeping their "
+        "detail in a compressed archive unless NUTRITION_COMPACT_ARCHIVE is "
+        "False (or --no-archive)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than",
+            type=int,
+            metavar="DAYS",
+            help="compact the portions older than this many days",
+        )
+        parser.add_argument(
+            "--user",
+            action="append",
+            dest="usernames",
+            help="only process this user (can be repeated, default: all users)",
+        )
+        parser.add_argument(
+            "--no-archive",
+            action="store_false",
+            dest="archive",
+            default=None,
+            help="don't keep the detail of the compacted portions",
+        )
+
+    def handle(self, *args, older_than=None, usernames=None, archive=None, **options):
+        if older_than is not None:
+            if older_than < 1:
+                raise CommandError("--older-than must be positive")
+            age = timezone.timedelta(days=older_than)
+        else:
+            age = compaction.policy_age()
+            if age is None:
+                raise CommandError(
+                    "no compaction policy: set NUTRITION_COMPACT_AFTER_DAYS "
+                    "or pass --older-than"
+                )
+
+        user_ids = None
+        if usernames:
+            users = dict(
+                User.objects.filter(username__in=usernames).values_list(
+                    "username", "id"
+                )
+            )
+            missing = set(usernames) - users.keys()
+            if missing:
+                raise CommandError(f"unknown user(s): {', '.join(sorted(missing))}")
+            user_ids = list(users.values())
+
+        count, days = compaction.compact(
+            timezone.localdate() - age,
+            user_ids,
+            archive,
+            progress=lambda done: self.stderr.write(f"{done}..."),
+        )
+        self.stdout.write(
+            self.style.SUCCESS(f"compacted {count} portions of {days} days")
+        )
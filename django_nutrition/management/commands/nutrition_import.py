@@ -0,0 +1,49 @@
+import json
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from django_nutrition import importing
+
+
+class Command(BaseCommand):
+    help = "Import a user's foods or portions from a CSV or JSON lines file"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help='file to import ("-" for stdin)')
+        parser.add_argument("--user", required=True, help="username")
+        parser.add_argument("--kind", choices=importing.KINDS, required=True)
+        parser.add_argument(
+            "--format",
+            choices=importing.FORMATS,
+            help="default: guessed from the file extension",
+        )
+        parser.add_argument("--chunk-size", type=int, default=importing.CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options["user"])
+        except User.DoesNotExist:
+            raise CommandError(f"unknown user: {options['user']}")
+
+        path = options["path"]
+        file_format = options["format"] or importing.guess_format(path)
+        if path == "-":
+            result = self._import(user, sys.stdin, file_format, options)
+        else:
+            with open(path, encoding="utf-8-sig", newline="") as stream:
+                result = self._import(user, stream, file_format, options)
+
+        self.stdout.write(json.dumps(result.to_dict(), indent=2))
+        if result.error_count:
+            raise CommandError(f"{result.error_count} rows could not be imported")
+
+    def _import(self, user, stream, file_format, options):
+        return importing.import_stream(
+            user,
+            stream,
+            kind=options["kind"],
+            file_format=file_format,
+            chunk_size=options["chunk_size"],
+        )
@@ -0,0 +1,83 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from django_nutrition import parallel, rollup, usage
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild or verify the per-user daily totals rollup "
+        "(rebuilding also rebuilds the food and meal usage statistics)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--user",
+            action="append",
+            dest="usernames",
+            help="only process this user (can be repeated, default: all users)",
+        )
+        parser.add_argument(
+            "--verify",
+            action="store_true",
+            help="only report rows that differ from the portions, don't rebuild",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="process the users in this many processes (default: 1, serially)",
+        )
+
+    def handle(self, *args, usernames=None, verify=False, workers=1, **options):
+        if workers < 1:
+            raise CommandError("--workers must be positive")
+        user_ids = None
+        if usernames:
+            users = dict(
+                User.objects.filter(username__in=usernames).values_list(
+                    "username", "id"
+                )
+            )
+            missing = set(usernames) - users.keys()
+            if missing:
+                raise CommandError(f"unknown user(s): {', '.join(sorted(missing))}")
+            user_ids = list(users.values())
+
+        if not verify:
+            if workers == 1:
+                count = rollup.rebuild(user_ids)
+                usage_count = usage.rebuild(user_ids)
+            else:
+                results = list(
+                    parallel.run(
+                        parallel.rebuild_shard, user_ids, workers, self._progress
+                    )
+                )
+                count = sum(r[1] for r in results)
+                usage_count = sum(r[2] for r in results)
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"rebuilt {count} daily totals and {usage_count} usage statistics"
+                )
+            )
+            return
+
+        if workers == 1:
+            mismatches = rollup.verify(user_ids)
+        else:
+            mismatches = sorted(
+                key
+                for _, _mismatches in parallel.run(
+                    parallel.verify_shard, user_ids, workers, self._progress
+                )
+                for key in _mismatches
+            )
+        for user_id, date in mismatches:
+            self.stdout.write(f"user {user_id}: {date} differs")
+        if mismatches:
+            raise CommandError(f"{len(mismatches)} daily totals differ")
+        self.stdout.write(self.style.SUCCESS("daily totals are consistent"))
+
+    def _progress(self, done: int, total: int):
+        self.stderr.write(f"{done}/{total} users...")
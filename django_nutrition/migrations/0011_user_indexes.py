@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:03
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = (
+        ("django_nutrition", "0010_dailytotal"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    )
+
+    operations = (
+        migrations.AddIndex(
+            model_name="food",
+            index=models.Index(fields=["user", "name"], name="food_user_name_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="portion",
+            index=models.Index(fields=["user", "date"], name="portion_user_date_idx"),
+        ),
+    )
@@ -0,0 +1,15 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = (("django_nutrition", "0014_mealtemplate"),)
+
+    operations = (
+        migrations.AddField(
+            model_name="portion",
+            name="calories_per_unit",
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+    )
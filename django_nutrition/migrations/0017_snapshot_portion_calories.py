@@ -0,0 +1,31 @@
+from django.db import migrations, transaction
+from django.db.models import Max, OuterRef, Subquery
+
+BATCH_SIZE = 5000  # ids per UPDATE (and transaction)
+
+
+def snapshot_calories(apps, schema_editor):
+    # the portions logged before 0015 added the field (if the
+    # nutrition_calories command hasn't snapshotted them already)
+    db = schema_editor.connection.alias
+    Food = apps.get_model("django_nutrition", "Food")
+    Portion = apps.get_model("django_nutrition", "Portion")
+    food_calories = Subquery(
+        Food.objects.using(db).filter(pk=OuterRef("food_id")).values("calories")[:1]
+    )
+    last_id = Portion.objects.using(db).aggregate(Max("id"))["id__max"] or 0
+    for start in range(0, last_id, BATCH_SIZE):
+        with transaction.atomic(using=db):
+            Portion.objects.using(db).filter(
+                id__gt=start,
+                id__lte=start + BATCH_SIZE,
+                calories_per_unit__isnull=True,
+            ).update(calories_per_unit=food_calories)
+
+
+class Migration(migrations.Migration):
+    atomic = False  # one transaction per batch, not one for the whole table
+
+    dependencies = (("django_nutrition", "0016_mealsummary_portionarchive"),)
+
+    operations = (migrations.RunPython(snapshot_calories, migrations.RunPython.noop),)
@@ -0,0 +1,13 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = (("django_nutrition", "0017_snapshot_portion_calories"),)
+
+    operations = (
+        migrations.AlterField(
+            model_name="portion",
+            name="calories_per_unit",
+            field=models.FloatField(editable=False),
+        ),
+    )
@@ -1,22 +1,49 @@
 from django.db import models
 from django.utils import timezone
 from django.contrib.auth.models import User
-from typing import TYPE_CHECKING
+from typing import Optional, TYPE_CHECKING
+from . import caching
 
 if TYPE_CHECKING:
     from django.http import HttpRequest
 
 
-class Food(models.Model):
+class _LoadedValuesMixin:
+    """
+    Remember the field values as loaded from the database, so that
+    post_save handlers can tell what changed (e.g. a portion moved
+    to another day).
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._loaded_values = {
+            f.attname: getattr(self, f.attname) for f in self._meta.concrete_fields
+        }
+
+    def loaded_value(self, field_name: str):
+        return getattr(self, "_loaded_values", {}).get(field_name)
+
+
+class Food(_LoadedValuesMixin, models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     name = models.CharField(max_length=200)
     calories = models.FloatField()
 
+    class Meta:
+        indexes = (models.Index(fields=["user", "name"], name="food_user_name_idx"),)
+
     def __str__(self):
         return self.name
 
 
-class Meal(models.Model):
+class Meal(_LoadedValuesMixin, models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     name = models.CharField(max_length=200)
 
@@ -24,16 +51,31 @@ class Meal(models.Model):
         return self.name
 
 
-class Portion(models.Model):
+class Portion(_LoadedValuesMixin, models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     date = models.DateField(default=timezone.now)
     quantity = models.FloatField(default=1)
     note = models.CharField(max_length=200, blank=True)
     food = models.ForeignKey(Food, on_delete=models.CASCADE)
     meal = models.ForeignKey(Meal, on_delete=models.SET_NULL, null=True, blank=True)
+    # the food's calories when the portion was logged (see pricing.py)
+    calories_per_unit = models.FloatField(editable=False)
+
+    class Meta:
+        indexes = (models.Index(fields=["user", "date"], name="portion_user_date_idx"),)
+
+    def save(self, *args, **kwargs):
+        food_changed = not self._state.adding and self.food_id != self.loaded_value(
+            "food_id"
+        )
+        if self.calories_per_unit is None or food_changed:
+            self.calories_per_unit = self.food.calories
+        super().save(*args, **kwargs)
 
     def calories(self):
-        return self.food.calories * self.quantity
+        if self.calories_per_unit is None:  # not saved yet
+            return self.food.calories * self.quantity
+        return self.calories_per_unit * self.quantity
 
     def calories_rounded_01(self):
         c10 = self.calories() * 10
@@ -43,6 +85,211 @@ class Portion(models.Model):
         return f"{self.food.name} ({self.quantity})"
 
 
+class DailyTotal(models.Model):
+    """
+    Rollup of a user's portions for one day, kept current by the
+    handlers in signals.py (see rollup.py).
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    date = models.DateField()
+    calories = models.FloatField(default=0)
+    portion_count = models.PositiveIntegerField(default=0)
+    # meal name ("other" for portions without a meal) -> calories
+    meal_calories = models.JSONField(default=dict)
+
+    class Meta:
+        constraints = (
+            models.UniqueConstraint(
+                fields=["user", "date"], name="unique_daily_total_user_date"
+            ),
+        )
+
+    def __str__(self):
+        return f"{self.user}, {self.date}: {self.calories} calories"
+
+
+class MealSummary(models.Model):
+    """
+    Portions of one meal of a day, compacted (see compaction.py): their
+    total calories and count replace the portions themselves.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    date = models.DateField()
+    meal = models.ForeignKey(Meal, on_delete=models.SET_NULL, null=True, blank=True)
+    calories = models.FloatField(default=0)
+    portion_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            models.Index(fields=["user", "date"], name="meal_summary_user_date_idx"),
+        )
+
+    def __str__(self):
+        return f"{self.user}, {self.date}, {self.meal}: {self.calories} calories"
+
+
+class PortionArchive(models.Model):
+    """
+    The detail of a day's compacted portions, when kept (see compaction.py):
+    a zlib compressed JSON list.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    date = models.DateField()
+    data = models.BinaryField()
+
+    class Meta:
+        constraints = (
+            models.UniqueConstraint(
+                fields=["user", "date"], name="unique_portion_archive_user_date"
+            ),
+        )
+
+    def __str__(self):
+        return f"{self.user}, {self.date}"
+
+
+class FoodUsage(models.Model):
+    """
+    How often and how recently a user logged a food, kept current by the
+    handlers in signals.py (see usage.py).
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    food = models.ForeignKey(Food, on_delete=models.CASCADE)
+    count = models.PositiveIntegerField(default=0)
+    last_used = models.DateField()
+
+    class Meta:
+        constraints = (
+            models.UniqueConstraint(
+                fields=["user", "food"], name="unique_food_usage_user_food"
+            ),
+        )
+        indexes = (
+            models.Index(fields=["user", "-count"], name="food_usage_count_idx"),
+            models.Index(fields=["user", "-last_used"], name="food_usage_recent_idx"),
+        )
+
+    def __str__(self):
+        return f"{self.user}, {self.food}: {self.count} (last {self.last_used})"
+
+
+class MealUsage(models.Model):
+    """
+    How often and how recently a user logged a portion for a meal
+    (see FoodUsage).
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    meal = models.ForeignKey(Meal, on_delete=models.CASCADE)
+    count = models.PositiveIntegerField(default=0)
+    last_used = models.DateField()
+
+    class Meta:
+        constraints = (
+            models.UniqueConstraint(
+                fields=["user", "meal"], name="unique_meal_usage_user_meal"
+            ),
+        )
+        indexes = (
+            models.Index(fields=["user", "-count"], name="meal_usage_count_idx"),
+            models.Index(fields=["user", "-last_used"], name="meal_usage_recent_idx"),
+        )
+
+    def __str__(self):
+        return f"{self.user}, {self.meal}: {self.count} (last {self.last_used})"
+
+
+class MealTemplate(models.Model):
+    """
+    Portions of a day or meal saved under a name, to log them again on
+    other days in one step (see copying.py).
+    """
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    name = models.CharField(max_length=200)
+
+    class Meta:
+        constraints = (
+            models.UniqueConstraint(
+                fields=["user", "name"], name="unique_meal_template_user_name"
+            ),
+        )
+
+    def __str__(self):
+        return self.name
+
+
+class MealTemplateItem(models.Model):
+    template = models.ForeignKey(
+        MealTemplate, on_delete=models.CASCADE, related_name="items"
+    )
+    food = models.ForeignKey(Food, on_delete=models.CASCADE)
+    meal = models.ForeignKey(Meal, on_delete=models.SET_NULL, null=True, blank=True)
+    quantity = models.FloatField(default=1)
+    note = models.CharField(max_length=200, blank=True)
+
+    def __str__(self):
+        return f"{self.template}: {self.food} ({self.quantity})"
+
+
+class DataVersion(models.Model):
+    """
+    Per-user counter, bumped on every write of a user's portions, foods,
+    meals or preferences (see signals.py).  Used to answer conditional
+    requests without looking at the data itself.
+    """
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE)
+    version = models.PositiveBigIntegerField(default=1)
+    modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user}: version {self.version}"
+
+    @staticmethod
+    def bump(user_id: int):
+        updated = DataVersion.objects.filter(user_id=user_id).update(
+            version=models.F("version") + 1, modified=timezone.now()
+        )
+        if not updated:
+            _version, created = DataVersion.objects.get_or_create(user_id=user_id)
+            if not created:
+                DataVersion.bump(user_id)  # lost a race with another writer
+
+    @staticmethod
+    def current(request: "HttpRequest") -> Optional["DataVersion"]:
+        """
+        The requesting user's version, memoized on the request (None if
+        anonymous or if nothing has been written yet).
+        """
+        if not request.user.is_authenticated:
+            return None
+        if not hasattr(request, "_nutrition_data_version"):
+            request._nutrition_data_version = DataVersion.objects.filter(
+                user=request.user
+            ).first()
+        return request._nutrition_data_version
+
+    @staticmethod
+    async def acurrent(request: "HttpRequest") -> Optional["DataVersion"]:
+        """
+        Async current(), for async views (it also memoizes the version,
+        so the sync conditional.py functions don't query afterwards).
+        """
+        user = await request.auser()
+        if not user.is_authenticated:
+            return None
+        if not hasattr(request, "_nutrition_data_version"):
+            request._nutrition_data_version = await DataVersion.objects.filter(
+                user=user
+            ).afirst()
+        return request._nutrition_data_version
+
+
 class Preferences(models.Model):
     DEFAULT_MAX_CALORIES = 2000
     DEFAULT_THEME = "light"
@@ -96,18 +343,69 @@ class Preferences(models.Model):
 
     @staticmethod
     def current_preferences(request: "HttpRequest") -> dict:
+        """
+        The preferences of the requesting user (or the defaults), memoized
+        on the request and cached per user until the Preferences row is
+        saved or deleted.
+        """
+        if not request.user.is_authenticated:
+            return Preferences._load_preferences(None)
+
+        memo = getattr(request, "_nutrition_preferences", None)
+        if memo is None:
+            _cache = caching.get_cache()
+            _key = caching.preferences_key(request.user.pk)
+            memo = _cache.get(_key)
+            if memo is None:
+                memo = Preferences._load_preferences(request.user)
+                _cache.set(_key, memo)
+            request._nutrition_preferences = memo
+        return dict(memo)
+
+    @staticmethod
+    async def acurrent_preferences(request: "HttpRequest") -> dict:
+        """
+        Async current_preferences(), memoizing on the request too (so
+        e.g. the context processor can be used when rendering afterwards).
+        """
+        user = await request.auser()
+        if not user.is_authenticated:
+            return Preferences._load_preferences(None)
+
+        memo = getattr(request, "_nutrition_preferences", None)
+        if memo is None:
+            _cache = caching.get_cache()
+            _key = caching.preferences_key(user.pk)
+            memo = await _cache.aget(_key)
+            if memo is None:
+                try:
+                    _prefs = await Preferences.objects.aget(user=user)
+                except Preferences.DoesNotExist:
+                    _prefs = None  # ok (prefs are optional)
+                memo = Preferences._to_dict(_prefs)
+                await _cache.aset(_key, memo)
+            request._nutrition_preferences = memo
+        return dict(memo)
+
+    @staticmethod
+    def _to_dict(_prefs: Optional["Preferences"]) -> dict:
         return_value = {
             "max_calories": Preferences.DEFAULT_MAX_CALORIES,
             "theme": Preferences.DEFAULT_THEME,
         }
-        if request.user.is_authenticated:
+        if _prefs is not None:
+            return_value["max_calories"] = (
+                _prefs.max_calories or Preferences.DEFAULT_MAX_CALORIES
+            )
+            return_value["theme"] = _prefs.theme or Preferences.DEFAULT_THEME
+        return return_value
+
+    @staticmethod
+    def _load_preferences(user: User | None) -> dict:
+        _prefs = None
+        if user is not None:
             try:
-                _prefs = Preferences.objects.get(user=request.user)
-                return_value["max_calories"] = (
-                    _prefs.max_calories or Preferences.DEFAULT_MAX_CALORIES
-                )
-                return_value["theme"] = _prefs.theme or Preferences.DEFAULT_THEME
+                _prefs = Preferences.objects.get(user=user)
             except Preferences.DoesNotExist:
                 pass  # ok (prefs are optional)
-
-        return return_value
+        return Preferences._to_dict(_prefs)
@@ -0,0 +1,98 @@
+"""
+Rebuilding or verifying the rollup (and usage statistics) of many users
+in parallel, e.g. for every user after a schema change or a bulk food
+correction.
+
+The users are split into shards of about the same number of portions,
+more shards than workers so that progress can be reported as they
+complete.  Each shard runs rollup.rebuild()/verify() (one GROUP BY
+query, bulk writes in one transaction) in a worker process, which has
+its own database connection.
+"""
+
+import heapq
+import multiprocessing
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.contrib.auth.models import User
+from django.db import connections, transaction
+from django.db.models import Count
+
+from . import models, rollup, usage
+
+SHARDS_PER_WORKER = 4
+
+
+def shards(user_ids: list[int] | None, count: int) -> list[list[int]]:
+    """
+    The users (default: everyone) split into at most count shards,
+    balanced by their number of portions (and compacted meals).
+    """
+    users = User.objects.all()
+    if user_ids is not None:
+        users = users.filter(pk__in=user_ids)
+    sizes = dict.fromkeys(users.order_by("pk").values_list("pk", flat=True), 0)
+    for model in [models.Portion, models.MealSummary]:
+        rows = model.objects.all()
+        if user_ids is not None:
+            rows = rows.filter(user_id__in=user_ids)
+        for user_id, size in (
+            rows.values_list("user_id").annotate(size=Count("id")).order_by()
+        ):
+            sizes[user_id] += size
+
+    # largest first, each to the smallest shard so far
+    heap = [(0, i, []) for i in range(min(count, len(sizes)))]
+    for user_id in sorted(sizes, key=lambda u: (-sizes[u], u)):
+        total, i, shard = heapq.heappop(heap)
+        shard.append(user_id)
+        heapq.heappush(heap, (total + sizes[user_id], i, shard))
+    return [sorted(shard) for _, _, shard in sorted(heap, key=lambda s: s[1])]
+
+
+def rebuild_shard(user_ids: list[int]) -> tuple[int, int, int]:
+    """
+    :return: (number of users, of daily totals, of usage statistics)
+    """
+    with transaction.atomic():
+        return len(user_ids), rollup.rebuild(user_ids), usage.rebuild(user_ids)
+
+
+def verify_shard(user_ids: list[int]) -> tuple[int, list[tuple]]:
+    """
+    :return: (number of users, rollup.verify() mismatches)
+    """
+    return len(user_ids), rollup.verify(user_ids)
+
+
+def run(
+    task: Callable[[list[int]], tuple],
+    user_ids: list[int] | None,
+    workers: int,
+    progress: Callable[[int, int], None] | None = None,
+) -> Iterator[tuple]:
+    """
+    Yield the results of task (rebuild_shard or verify_shard) over the
+    shards of the users (default: everyone), as they complete.
+
+    :param progress: called with (users done, users) after each shard
+    """
+    _shards = shards(user_ids, workers * SHARDS_PER_WORKER)
+    total = sum(map(len, _shards))
+    done = 0
+    # (the workers open their own connections, don't share the parent's)
+    connections.close_all()
+    with ProcessPoolExecutor(
+        workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        # (referenced from a module importable before the setup)
+        initializer=django.setup,
+    ) as pool:
+        for future in as_completed([pool.submit(task, s) for s in _shards]):
+            result = future.result()
+            done += result[0]
+            if progress:
+                progress(done, total)
+            yield result
@@ -0,0 +1,106 @@
+"""
+Calorie snapshots of portions (Portion.calories_per_unit).
+
+A portion keeps the calories of its food as they were when it was
+logged, so daily totals aggregate the portion table alone, and editing
+a food's calories doesn't rewrite the history.  backfill() snapshots
+the portions logged before the field existed (migration 0017 does the
+same for the ones left), and reprice() applies a food's current
+calories to its past portions, for when that's wanted (e.g. fixing a
+typo).
+
+Both operations run in chunks of portions (one short transaction each),
+so they can run on large tables while the site is up.
+"""
+
+from collections import defaultdict
+from collections.abc import Callable
+from typing import TYPE_CHECKING, Optional
+
+from django.db.models import OuterRef, Subquery
+
+from . import models, signals
+
+if TYPE_CHECKING:
+    from datetime import date
+
+CHUNK_SIZE = 1000
+
+
+def _chunks(portions, chunk_size: int):
+    """
+    Yield lists of (id, user_id, date) of the portions, in id order.
+    The queryset is re-evaluated after each chunk (keyset on id), so the
+    caller may update the rows it was given.
+    """
+    last_id = 0
+    while True:
+        rows = list(
+            portions.filter(id__gt=last_id)
+            .order_by("id")
+            .values_list("id", "user_id", "date")[:chunk_size]
+        )
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def _send_changed(rows):
+    # update() sends no signals
+    dates = defaultdict(set)
+    for _, user_id, _date in rows:
+        dates[user_id].add(_date)
+    for user_id, _dates in dates.items():
+        signals.send_portions_changed(user_id, _dates)
+
+
+def backfill(
+    chunk_size: int = CHUNK_SIZE, progress: Callable[[int], None] | None = None
+) -> int:
+    """
+    Snapshot the food calories of the portions without a snapshot (those
+    logged before the field existed, which the totals leave out until
+    then).
+
+    :param progress: called with the number of portions done after each chunk
+    :return: the number of portions updated
+    """
+    food_calories = Subquery(
+        models.Food.objects.filter(pk=OuterRef("food_id")).values("calories")[:1]
+    )
+    missing = models.Portion.objects.filter(calories_per_unit__isnull=True)
+    done = 0
+    for rows in _chunks(missing, chunk_size):
+        done += models.Portion.objects.filter(
+            id__in=[_id for _id, _, _ in rows], calories_per_unit__isnull=True
+        ).update(calories_per_unit=food_calories)
+        _send_changed(rows)
+        if progress:
+            progress(done)
+    return done
+
+
+def reprice(
+    food: "models.Food",
+    start_date: Optional["date"] = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> int:
+    """
+    Apply the food's current calories to its portions (since start_date,
+    default: all of them), refreshing the totals of each affected day.
+
+    :return: the number of portions updated
+    """
+    portions = models.Portion.objects.filter(food=food).exclude(
+        calories_per_unit=food.calories
+    )
+    if start_date is not None:
+        portions = portions.filter(date__gte=start_date)
+    done = 0
+    for rows in _chunks(portions, chunk_size):
+        done += models.Portion.objects.filter(
+            id__in=[_id for _id, _, _ in rows]
+        ).update(calories_per_unit=food.calories)
+        _send_changed(rows)
+    return done
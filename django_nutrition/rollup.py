@@ -0,0 +1,200 @@
+"""
+Per-user daily totals (models.DailyTotal).  When the portions of a day
+change only that day is recomputed, so reading totals costs one row per
+day rather than one row per portion.
+"""
+
+from collections.abc import Iterable
+from itertools import chain
+from typing import TYPE_CHECKING
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Min, Sum
+
+from . import models
+
+if TYPE_CHECKING:
+    from datetime import date
+
+UNASSIGNED_MEAL = "other"  # same grouping as api.MealTotal.split_portions
+BATCH_SIZE = 1000
+
+
+def enabled() -> bool:
+    """
+    True if views should read daily totals from the rollup table
+    (settings.NUTRITION_USE_ROLLUP) rather than aggregating portions.
+    """
+    return getattr(settings, "NUTRITION_USE_ROLLUP", False)
+
+
+def _portion_groups(portions):
+    return (
+        portions.values_list("user_id", "date", "meal__name")
+        .annotate(
+            calories=Sum(F("calories_per_unit") * F("quantity")),
+            count=Count("id"),
+            first=Min("id"),
+        )
+        .order_by("user_id", "date", "first")
+    )
+
+
+def _summary_groups(summaries):
+    # same columns as _portion_groups, from compacted portions (compaction.py)
+    return summaries.values_list(
+        "user_id", "date", "meal__name", "calories", "portion_count", "id"
+    ).order_by("user_id", "date", "id")
+
+
+def _build_totals(groups) -> dict[tuple, models.DailyTotal]:
+    totals = {}
+    for user_id, date, meal_name, calories, count, _ in groups:
+        _total = totals.get((user_id, date))
+        if _total is None:
+            _total = models.DailyTotal(user_id=user_id, date=date)
+            totals[(user_id, date)] = _total
+        _total.calories += calories
+        _total.portion_count += count
+        _name = meal_name or UNASSIGNED_MEAL
+        _total.meal_calories[_name] = _total.meal_calories.get(_name, 0) + calories
+    return totals
+
+
+def compute_days(user_id: int, dates: Iterable["date"]) -> list[models.DailyTotal]:
+    """
+    Compute (without saving) the totals of the given days from the
+    Portion table and the compacted portions.  Days without portions are
+    omitted.
+    """
+    dates = list(dates)
+    groups = chain(
+        _summary_groups(
+            models.MealSummary.objects.filter(user_id=user_id, date__in=dates)
+        ),
+        _portion_groups(models.Portion.objects.filter(user_id=user_id, date__in=dates)),
+    )
+    return list(_build_totals(groups).values())
+
+
+def _upsert(totals: list[models.DailyTotal]):
+    models.DailyTotal.objects.bulk_create(
+        totals,
+        batch_size=BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=["user", "date"],
+        update_fields=["calories", "portion_count", "meal_calories"],
+    )
+
+
+def refresh_days(user_id: int, dates: Iterable["date"]):
+    """
+    Recompute the rollup rows of the given days, deleting the rows
+    of days that no longer have any portions.
+    """
+    dates = set(dates)
+    if not dates:
+        return
+    totals = compute_days(user_id, dates)
+    with transaction.atomic():
+        models.DailyTotal.objects.filter(user_id=user_id, date__in=dates).exclude(
+            date__in=[t.date for t in totals]
+        ).delete()
+        _upsert(totals)
+
+
+def affected_dates(**portion_filter) -> list["date"]:
+    """
+    Distinct dates of the portions matching the filter, e.g.
+    affected_dates(food=food).
+    """
+    return list(
+        models.Portion.objects.filter(**portion_filter)
+        .values_list("date", flat=True)
+        .distinct()
+    )
+
+
+def meal_dates(meal: models.Meal) -> list["date"]:
+    """
+    Distinct dates of the meal's portions, compacted or not.
+    """
+    compacted = models.MealSummary.objects.filter(meal=meal).values_list(
+        "date", flat=True
+    )
+    return sorted(set(affected_dates(meal=meal)) | set(compacted))
+
+
+def _user_rows(model, user_ids: Iterable[int] | None):
+    rows = model.objects.all()
+    if user_ids is not None:
+        rows = rows.filter(user_id__in=list(user_ids))
+    return rows
+
+
+def _user_groups(user_ids: Iterable[int] | None):
+    return chain(
+        _summary_groups(_user_rows(models.MealSummary, user_ids)).iterator(),
+        _portion_groups(_user_rows(models.Portion, user_ids)).iterator(),
+    )
+
+
+def rebuild(user_ids: Iterable[int] | None = None) -> int:
+    """
+    Replace the rollup of the given users (default: everyone) with totals
+    recomputed from scratch.  Returns the number of rows written.
+    """
+    if user_ids is not None:
+        user_ids = list(user_ids)
+    totals = _build_totals(_user_groups(user_ids))
+    with transaction.atomic():
+        stale = models.DailyTotal.objects.all()
+        if user_ids is not None:
+            stale = stale.filter(user_id__in=user_ids)
+        stale.delete()
+        _upsert(list(totals.values()))
+    return len(totals)
+
+
+def _same(a: float, b: float) -> bool:
+    return abs(a - b) < 1e-6
+
+
+def _differs(stored: models.DailyTotal, expected: models.DailyTotal) -> bool:
+    if stored.portion_count != expected.portion_count:
+        return True
+    if not _same(stored.calories, expected.calories):
+        return True
+    if stored.meal_calories.keys() != expected.meal_calories.keys():
+        return True
+    return not all(
+        _same(stored.meal_calories[name], calories)
+        for name, calories in expected.meal_calories.items()
+    )
+
+
+def verify(user_ids: Iterable[int] | None = None) -> list[tuple]:
+    """
+    Compare the stored rollup against the Portion table.
+
+    :return: (user_id, date) keys of missing, stale or orphaned rows
+    """
+    if user_ids is not None:
+        user_ids = list(user_ids)
+    expected = _build_totals(_user_groups(user_ids))
+
+    stored = models.DailyTotal.objects.all()
+    if user_ids is not None:
+        stored = stored.filter(user_id__in=user_ids)
+
+    mismatches = []
+    seen = set()
+    for _total in stored.iterator():
+        key = (_total.user_id, _total.date)
+        seen.add(key)
+        _expected = expected.get(key)
+        if _expected is None or _differs(_total, _expected):
+            mismatches.append(key)
+    mismatches.extend(key for key in expected if key not in seen)
+    return sorted(mismatches)
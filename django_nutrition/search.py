@@ -0,0 +1,142 @@
+"""
+Food name search for autocompletion.
+
+On SQLite builds with FTS5 the names are indexed in an external content
+FTS5 table, kept in sync with the food table by triggers (so bulk_create,
+QuerySet.update and raw SQL writes are covered too).  It's (re)created
+after every migrate, since SQLite drops the triggers when a migration
+rebuilds the food table.  Other databases fall back to prefix matching
+with LIKE.
+"""
+
+import functools
+import re
+import sqlite3
+from typing import TYPE_CHECKING
+
+from django.db import connections
+from django.db.models import Case, IntegerField, Q, Value, When
+
+from . import models
+
+if TYPE_CHECKING:
+    from django.contrib.auth.models import User
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+
+FOOD_TABLE = "django_nutrition_food"
+FTS_TABLE = "django_nutrition_food_fts"
+_TRIGGERS = {
+    f"{FTS_TABLE}_insert": f"""
+        AFTER INSERT ON {FOOD_TABLE} BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, name, user_id)
+            VALUES (new.id, new.name, new.user_id);
+        END""",
+    f"{FTS_TABLE}_delete": f"""
+        AFTER DELETE ON {FOOD_TABLE} BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, user_id)
+            VALUES ('delete', old.id, old.name, old.user_id);
+        END""",
+    f"{FTS_TABLE}_update": f"""
+        AFTER UPDATE OF name, user_id ON {FOOD_TABLE} BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, user_id)
+            VALUES ('delete', old.id, old.name, old.user_id);
+            INSERT INTO {FTS_TABLE}(rowid, name, user_id)
+            VALUES (new.id, new.name, new.user_id);
+        END""",
+}
+
+
+@functools.cache
+def _sqlite_has_fts5() -> bool:
+    with sqlite3.connect(":memory:") as conn:
+        options = [row[0] for row in conn.execute("PRAGMA compile_options")]
+    return "ENABLE_FTS5" in options
+
+
+def fts_enabled(using: str = "default") -> bool:
+    return connections[using].vendor == "sqlite" and _sqlite_has_fts5()
+
+
+def install_index(using: str = "default", **kwargs):
+    """
+    Create the FTS5 table and its triggers if missing (post_migrate receiver).
+    """
+    if not fts_enabled(using):
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')"
+        )
+        existing = {row[0] for row in cursor.fetchall()}
+        if FOOD_TABLE not in existing:
+            return  # not migrated yet
+        if FTS_TABLE in existing and existing.issuperset(_TRIGGERS):
+            return
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            f"name, user_id, content='{FOOD_TABLE}', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2', prefix='1 2 3')"
+        )
+        for name, body in _TRIGGERS.items():
+            cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def tokens(query: str) -> list[str]:
+    return re.findall(r"\w+", query.lower())
+
+
+def _fts_search(user: "User", words: list[str], limit: int) -> list[int]:
+    # every word must prefix-match a token of the name, names starting
+    # with the first word rank first, then by bm25
+    match = " AND ".join([f'user_id : "{user.pk}"'] + [f'name : "{w}"*' for w in words])
+    with connections["default"].cursor() as cursor:
+        cursor.execute(
+            f"SELECT {FTS_TABLE}.rowid FROM {FTS_TABLE} "
+            f"JOIN {FOOD_TABLE} ON {FOOD_TABLE}.id = {FTS_TABLE}.rowid "
+            f"WHERE {FTS_TABLE} MATCH %s "
+            f"ORDER BY instr(lower({FOOD_TABLE}.name), %s) != 1, "
+            f"{FTS_TABLE}.rank, {FOOD_TABLE}.name "
+            "LIMIT %s",
+            [match, words[0], limit],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def _like_search(user: "User", words: list[str], limit: int) -> list[int]:
+    condition = Q(user=user)
+    for w in words:
+        condition &= Q(name__istartswith=w) | Q(name__icontains=f" {w}")
+    return list(
+        models.Food.objects.filter(condition)
+        .annotate(
+            prefix=Case(
+                When(name__istartswith=words[0], then=Value(0)),
+                default=Value(1),
+                output_field=IntegerField(),
+            )
+        )
+        .order_by("prefix", "name")
+        .values_list("id", flat=True)[:limit]
+    )
+
+
+def search_foods(
+    user: "User", query: str, limit: int = DEFAULT_LIMIT
+) -> list["models.Food"]:
+    """
+    The user's foods with a name token starting with each word of query,
+    best matches first.
+    """
+    words = tokens(query)
+    if not words:
+        return []
+    limit = max(1, min(limit, MAX_LIMIT))
+    if fts_enabled():
+        ids = _fts_search(user, words, limit)
+    else:
+        ids = _like_search(user, words, limit)
+    foods = models.Food.objects.in_bulk(ids)
+    return [foods[i] for i in ids if i in foods]
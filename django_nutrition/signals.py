@@ -0,0 +1,179 @@
+from django.contrib.auth.models import User
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import Signal, receiver
+
+from . import caching, models, rollup, usage
+
+# Sent whenever the portions of one or more days of a user change,
+# with the keyword arguments user_id and dates.  Code that writes
+# portions without going through Model.save/delete (bulk_create,
+# queryset.update, ...) must send it once for all the affected days.
+portions_changed = Signal()
+
+
+def send_portions_changed(user_id: int, dates):
+    # a portion's date may still be what was assigned to it (e.g. the
+    # timezone.now default or a string), the receivers want dates
+    _field = models.Portion._meta.get_field("date")
+    dates = {_field.to_python(d) for d in dates}
+    if dates:
+        portions_changed.send(sender=models.Portion, user_id=user_id, dates=dates)
+
+
+def _deleting(origin, model) -> bool:
+    """
+    True if a deletion cascades from deleting instance(s) of model.
+    """
+    if isinstance(origin, QuerySet):
+        return origin.model is model
+    return isinstance(origin, model)
+
+
+def _deleting_user(origin) -> bool:
+    """
+    True if a deletion cascades from deleting the user, in which case
+    there are no totals or versions left to maintain.
+    """
+    return _deleting(origin, User)
+
+
+@receiver(post_save, sender=models.Portion)
+def _portion_saved(sender, instance, created, **kwargs):
+    dates = {instance.date}
+    if not created:
+        _loaded_user = instance.loaded_value("user_id")
+        _loaded_date = instance.loaded_value("date")
+        if _loaded_user is not None and _loaded_user != instance.user_id:
+            send_portions_changed(_loaded_user, [_loaded_date])
+        elif _loaded_date is not None:
+            dates.add(_loaded_date)
+    send_portions_changed(instance.user_id, dates)
+
+
+@receiver(post_delete, sender=models.Portion)
+def _portion_deleted(sender, instance, origin=None, **kwargs):
+    if _deleting_user(origin):
+        return
+    send_portions_changed(instance.user_id, [instance.date])
+
+
+@receiver(post_save, sender=models.Portion)
+def _portion_usage_saved(sender, instance, created, **kwargs):
+    if created:
+        usage.record(
+            instance.user_id, instance.food_id, instance.meal_id, instance.date
+        )
+        return
+    _loaded = {
+        f: instance.loaded_value(f) for f in ["user_id", "food_id", "meal_id", "date"]
+    }
+    if all(getattr(instance, f) == v for f, v in _loaded.items()):
+        return  # e.g. only the quantity changed
+    if _loaded["user_id"] is not None and _loaded["user_id"] != instance.user_id:
+        usage.refresh(_loaded["user_id"], [_loaded["food_id"]], [_loaded["meal_id"]])
+    usage.refresh(
+        instance.user_id,
+        [instance.food_id, _loaded["food_id"]],
+        [instance.meal_id, _loaded["meal_id"]],
+    )
+
+
+@receiver(post_delete, sender=models.Portion)
+def _portion_usage_deleted(sender, instance, origin=None, **kwargs):
+    if _deleting_user(origin) or _deleting(origin, models.Food):
+        return  # the food's statistics are deleted with it, see _food_deleted
+    usage.refresh(instance.user_id, [instance.food_id], [instance.meal_id])
+
+
+@receiver(post_delete, sender=models.Food)
+def _food_deleted(sender, instance, origin=None, **kwargs):
+    if _deleting_user(origin):
+        return
+    # its portions were deleted too, which changes the meal statistics
+    usage.rebuild([instance.user_id])
+
+
+@receiver(post_save, sender=models.Food)
+@receiver(post_save, sender=models.Meal)
+@receiver(post_delete, sender=models.Meal)
+def _usage_names_changed(sender, instance, origin=None, **kwargs):
+    if _deleting_user(origin):
+        return
+    usage.invalidate(instance.user_id)
+
+
+@receiver(post_save, sender=models.Food)
+def _food_saved(sender, instance, created, **kwargs):
+    if created:
+        return
+    # (calorie edits don't change the portions' snapshots, see pricing.py)
+    if instance.loaded_value("name") != instance.name:
+        # only in the rendered day fragments (not in totals or events)
+        caching.invalidate_days(instance.user_id, rollup.affected_dates(food=instance))
+
+
+@receiver(post_save, sender=models.Meal)
+def _meal_saved(sender, instance, created, **kwargs):
+    if created:
+        return
+    if instance.loaded_value("name") != instance.name:
+        send_portions_changed(instance.user_id, rollup.meal_dates(instance))
+
+
+@receiver(pre_delete, sender=models.Meal)
+def _meal_deleting(sender, instance, **kwargs):
+    # portions are detached with an UPDATE (SET_NULL), which sends no signals
+    instance._affected_dates = rollup.meal_dates(instance)
+
+
+@receiver(post_delete, sender=models.Meal)
+def _meal_deleted(sender, instance, origin=None, **kwargs):
+    if _deleting_user(origin):
+        return
+    send_portions_changed(instance.user_id, getattr(instance, "_affected_dates", []))
+
+
+@receiver(post_save, sender=models.Preferences)
+@receiver(post_delete, sender=models.Preferences)
+def _preferences_changed(sender, instance, **kwargs):
+    caching.invalidate_preferences(instance.user_id)
+
+
+@receiver(post_save, sender=models.Food)
+@receiver(post_delete, sender=models.Food)
+@receiver(post_save, sender=models.Meal)
+@receiver(post_delete, sender=models.Meal)
+@receiver(post_save, sender=models.Preferences)
+@receiver(post_delete, sender=models.Preferences)
+def _bump_data_version(sender, instance, origin=None, **kwargs):
+    if _deleting_user(origin):
+        return
+    models.DataVersion.bump(instance.user_id)
+
+
+@receiver(portions_changed)
+def _refresh_rollup(sender, user_id, dates, **kwargs):
+    # nothing reads it otherwise (nutrition_rollup rebuilds it before enabling)
+    if rollup.enabled():
+        rollup.refresh_days(user_id, dates)
+
+
+@receiver(portions_changed)
+def _portions_data_version(sender, user_id, **kwargs):
+    models.DataVersion.bump(user_id)
+
+
+@receiver(portions_changed)
+def _invalidate_event_months(sender, user_id, dates, **kwargs):
+    caching.invalidate_event_months(user_id, dates)
+
+
+@receiver(portions_changed)
+def _invalidate_day_fragments(sender, user_id, dates, **kwargs):
+    caching.invalidate_days(user_id, dates)
+
+
+@receiver(portions_changed)
+def _invalidate_analytics(sender, user_id, dates, **kwargs):
+    caching.invalidate_analytics(user_id, dates)
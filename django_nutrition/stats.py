@@ -0,0 +1,154 @@
+"""
+Per-week and per-month summaries of a user's daily calorie totals
+(total, mean, min, max and the number of days in each calorie range),
+computed with a single query.
+"""
+
+from collections.abc import Iterable
+from datetime import timedelta
+from typing import TYPE_CHECKING
+
+from django.db.models import Count, Max, Min, Q, Sum
+from django.db.models.functions import TruncMonth, TruncWeek
+
+from . import api, models, rollup
+
+if TYPE_CHECKING:
+    from datetime import date
+
+    from django.contrib.auth.models import User
+
+PERIODS = ["week", "month"]
+
+
+def period_start(day: "date", period: str) -> "date":
+    if period == "week":
+        return day - timedelta(days=day.weekday())  # ISO weeks start on Monday
+    return day.replace(day=1)
+
+
+def period_end(start: "date", period: str) -> "date":
+    if period == "week":
+        return start + timedelta(days=6)
+    return (start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+
+
+def _summary(
+    start: "date",
+    period: str,
+    days: int,
+    total: float,
+    low: float,
+    high: float,
+    ranges: dict["api.DailyTotalRange", int],
+) -> dict:
+    over = ranges[api.DailyTotalRange.OVER]
+    slightly_over = ranges[api.DailyTotalRange.SLIGHTLY_OVER]
+    return {
+        "start": start,
+        "end": period_end(start, period),
+        "days": days,
+        "total": api.round_01(total),
+        "mean": api.round_01(total / days),
+        "min": api.round_01(low),
+        "max": api.round_01(high),
+        "days_over_target": over + slightly_over,
+        "ranges": {r.value: ranges[r] for r in api.DailyTotalRange},
+    }
+
+
+def _from_rollup(
+    user: "User",
+    start_date: "date",
+    end_date: "date",
+    period: str,
+    max_calories: float,
+) -> list[dict]:
+    # same boundaries as FullDayEvent.get_calorie_range
+    over_limit = max_calories * (1 + api.CALORIES_WARNING_THRESHOLD)
+    rows = (
+        models.DailyTotal.objects.filter(
+            user=user, date__gte=start_date, date__lte=end_date
+        )
+        .annotate(period=TruncWeek("date") if period == "week" else TruncMonth("date"))
+        .values_list("period")
+        .annotate(
+            days=Count("id"),
+            total=Sum("calories"),
+            low=Min("calories"),
+            high=Max("calories"),
+            under=Count("id", filter=Q(calories__lt=max_calories)),
+            over=Count("id", filter=Q(calories__gt=over_limit)),
+        )
+        .order_by("period")
+    )
+    return [
+        _summary(
+            start,
+            period,
+            days,
+            total,
+            low,
+            high,
+            {
+                api.DailyTotalRange.UNDER: under,
+                api.DailyTotalRange.OVER: over,
+                api.DailyTotalRange.SLIGHTLY_OVER: days - under - over,
+            },
+        )
+        for start, days, total, low, high, under, over in rows
+    ]
+
+
+def summarize_days(
+    days: Iterable["api.DailyCalories"], period: str, max_calories: float
+) -> list[dict]:
+    """
+    Summaries of the per-day totals (in date order), one per period
+    with at least one day.
+    """
+    summaries = []
+    current = None
+    for _day in days:
+        start = period_start(_day.date, period)
+        if current is None or current["start"] != start:
+            current = {
+                "start": start,
+                "days": 0,
+                "total": 0,
+                "low": _day.calories,
+                "high": _day.calories,
+                "ranges": {r: 0 for r in api.DailyTotalRange},
+            }
+            summaries.append(current)
+        current["days"] += 1
+        current["total"] += _day.calories
+        current["low"] = min(current["low"], _day.calories)
+        current["high"] = max(current["high"], _day.calories)
+        _range = api.FullDayEvent.get_calorie_range(
+            _day.calories, max_calories, api.CALORIES_WARNING_THRESHOLD
+        )
+        current["ranges"][_range] += 1
+    return [_summary(period=period, **s) for s in summaries]
+
+
+def summaries(
+    user: "User",
+    start_date: "date",
+    end_date: "date",
+    period: str,
+    max_calories: float,
+) -> list[dict]:
+    """
+    One summary per week/month (of the inclusive range) with portions.
+    Means are per day with portions.  Periods are cut at the range
+    boundaries, so pass whole periods to summarize them fully.
+    """
+    if period not in PERIODS:
+        raise ValueError(f"unknown period: {period}")
+    if rollup.enabled():
+        # aggregated by the database
+        return _from_rollup(user, start_date, end_date, period, max_calories)
+    # one GROUP BY query for the daily totals, summarized here
+    days = api.daily_calories(user, start_date, end_date)
+    return summarize_days(days, period, max_calories)
@@ -1,11 +1,71 @@
-from django.test import TestCase
+from asgiref.sync import sync_to_async
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory, modify_settings, override_settings
+from django.test import TestCase as DjangoTestCase
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
 from django.contrib.auth.models import User
 from django.urls import reverse
 
-from .models import Portion, Food, Meal
-from .api import MealTotal
-from datetime import timedelta
+from .models import DailyTotal, Portion, Food, Meal, Preferences
+from . import (
+    analytics,
+    caching,
+    compaction,
+    copying,
+    models,
+    pagination,
+    parallel,
+    pricing,
+    rollup,
+    search,
+    stats,
+    timing,
+    usage,
+    views,
+)
+from .importing import import_stream
+from .api import (
+    DayTotal,
+    FullDayEvent,
+    FullDayEventSerializer,
+    MealTotal,
+    daily_calories,
+    encode_events,
+    month_events,
+    range_events,
+    serialize_events,
+)
+import asyncio
+import csv
+from concurrent.futures import Executor, Future
+import gzip
+import importlib
+import json
+import os
+import tempfile
+from datetime import date, timedelta
+from io import StringIO
+from unittest import skipUnless
+from unittest.mock import patch
+
+
+class TestCase(DjangoTestCase):
+    """
+    Starts every test with empty caches: the app caches per-user data,
+    and user ids are reused across tests.
+    """
+
+    def run(self, result=None):
+        for _cache in caches.all():
+            _cache.clear()
+        return super().run(result)
 
 
 class MealTotalTests(TestCase):
@@ -34,6 +94,622 @@ class MealTotalTests(TestCase):
         self.assertEqual(meals[0].calories, 600)
 
 
+class DailyCaloriesTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("test3", "1234")
+        foods = [
+            Food.objects.create(name=f"food {c}", calories=c, user=self.user)
+            for c in (100, 250, 300)
+        ]
+        today = timezone.now().date()
+        for offset in range(5):
+            for _f in foods:
+                Portion.objects.create(
+                    food=_f,
+                    quantity=0.5 + offset,
+                    date=today - timedelta(days=offset),
+                    user=self.user,
+                )
+        self.start = today - timedelta(days=10)
+        self.end = today
+
+    def test_single_query(self):
+        with self.assertNumQueries(1):
+            days = daily_calories(self.user, self.start, self.end)
+        self.assertEqual(len(days), 5)
+
+    def test_matches_split_days(self):
+        expected = {
+            d.date: d.calories
+            for d in DayTotal.split_days(Portion.objects.filter(user=self.user))
+        }
+        actual = {
+            d.date: d.calories for d in daily_calories(self.user, self.start, self.end)
+        }
+        self.assertEqual(actual, expected)
+
+    def test_same_events(self):
+        def _event(day):
+            return FullDayEvent(day, max_calories=500, warning_threshold=0.1).to_dict()
+
+        expected = sorted(
+            map(_event, DayTotal.split_days(Portion.objects.filter(user=self.user))),
+            key=lambda e: e["start"],
+        )
+        actual = list(map(_event, daily_calories(self.user, self.start, self.end)))
+        self.assertEqual(actual, expected)
+
+    def test_fast_encoding(self):
+        days = daily_calories(self.user, self.start, self.end)
+        events = [
+            FullDayEvent(d, max_calories=500, warning_threshold=0.1) for d in days
+        ]
+        expected = JSONRenderer().render(FullDayEventSerializer(events, many=True).data)
+        self.assertEqual(encode_events(serialize_events(days, 500)), expected)
+
+
+class MonthEventsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("test6", "1234")
+        self.food = Food.objects.create(name="food 100", calories=100, user=self.user)
+        self.dates = [date(2024, 1, 31), date(2024, 2, 1), date(2024, 3, 15)]
+        for _date in self.dates:
+            Portion.objects.create(food=self.food, date=_date, user=self.user)
+
+    def _portion_queries(self, *args):
+        with CaptureQueriesContext(connection) as ctx:
+            events = month_events(self.user, *args)
+        queries = [
+            q for q in ctx.captured_queries if "django_nutrition_portion" in q["sql"]
+        ]
+        return events, len(queries)
+
+    def test_stitched_ranges(self):
+        events, queries = self._portion_queries(
+            date(2024, 1, 1), date(2024, 3, 31), 2000
+        )
+        self.assertEqual(queries, 1)
+        self.assertEqual(
+            events,
+            serialize_events(
+                daily_calories(self.user, date(2024, 1, 1), date(2024, 3, 31)), 2000
+            ),
+        )
+
+        events, queries = self._portion_queries(
+            date(2024, 1, 31), date(2024, 2, 29), 2000
+        )
+        self.assertEqual(queries, 0)
+        self.assertEqual([e["start"] for e in events], ["2024-01-31", "2024-02-01"])
+
+        # a different target is cached separately
+        _, queries = self._portion_queries(date(2024, 1, 1), date(2024, 1, 31), 50)
+        self.assertEqual(queries, 1)
+
+    def test_invalidates_changed_month(self):
+        self._portion_queries(date(2024, 1, 1), date(2024, 3, 31), 2000)
+        Portion.objects.create(food=self.food, date="2024-02-10", user=self.user)
+
+        _, queries = self._portion_queries(date(2024, 1, 1), date(2024, 1, 31), 2000)
+        self.assertEqual(queries, 0)
+        events, queries = self._portion_queries(
+            date(2024, 1, 1), date(2024, 3, 31), 2000
+        )
+        self.assertEqual(queries, 1)
+        self.assertEqual(len(events), 4)
+
+    @override_settings(NUTRITION_SINGLE_PROCESS=False)
+    def test_local_cache(self):
+        # another process's writes wouldn't invalidate a per-process cache
+        self._portion_queries(date(2024, 1, 1), date(2024, 1, 31), 2000)
+        _, queries = self._portion_queries(date(2024, 1, 1), date(2024, 1, 31), 2000)
+        self.assertEqual(queries, 1)
+
+    def _range_queries(self, ranges, prefetch=False):
+        with CaptureQueriesContext(connection) as ctx:
+            events = range_events(self.user, ranges, 2000, prefetch)
+        queries = [
+            q for q in ctx.captured_queries if "django_nutrition_portion" in q["sql"]
+        ]
+        return events, len(queries)
+
+    def test_batched_ranges(self):
+        ranges = [
+            (date(2024, 3, 1), date(2024, 3, 31)),
+            (date(2024, 1, 15), date(2024, 2, 5)),
+        ]
+        events, queries = self._range_queries(ranges)
+        self.assertEqual(queries, 1)
+        self.assertEqual(
+            events,
+            [serialize_events(daily_calories(self.user, *r), 2000) for r in ranges],
+        )
+        _, queries = self._range_queries(ranges)
+        self.assertEqual(queries, 0)
+
+    def test_prefetch_adjacent_months(self):
+        events, queries = self._range_queries(
+            [(date(2024, 2, 1), date(2024, 2, 29))], prefetch=True
+        )
+        self.assertEqual(queries, 1)
+        self.assertEqual([e["start"] for e in events[0]], ["2024-02-01"])
+
+        for month in [
+            (date(2024, 1, 1), date(2024, 1, 31)),
+            (date(2024, 3, 1), date(2024, 3, 31)),
+        ]:
+            events, queries = self._portion_queries(*month, 2000)
+            self.assertEqual(queries, 0)
+            self.assertEqual(len(events), 1)
+
+    def test_batched_api(self):
+        self.client.force_login(self.user)
+        url = reverse("day-events")
+        single = [
+            self.client.get(url, {"start": start, "end": end}).json()
+            for start, end in [
+                ("2024-01-01", "2024-01-31"),
+                ("2024-03-01", "2024-03-31"),
+            ]
+        ]
+        response = self.client.get(
+            url,
+            {"ranges": "2024-01-01/2024-01-31,2024-03-01/2024-03-31", "prefetch": 1},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), single)
+
+        for ranges in [
+            "2024-01-01",
+            "x/2024-01-31",
+            ",".join(["2024-01-01/2024-01-31"] * 13),
+        ]:
+            with self.subTest(ranges):
+                response = self.client.get(url, {"ranges": ranges})
+                self.assertEqual(response.status_code, 400)
+
+
+@override_settings(NUTRITION_USE_ROLLUP=True)
+class RollupTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("test4", "1234")
+        self.food = Food.objects.create(name="food 100", calories=100, user=self.user)
+        self.meal = Meal.objects.create(name="lunch", user=self.user)
+        self.today = timezone.now().date()
+        self.yesterday = self.today - timedelta(days=1)
+        self.portion = Portion.objects.create(
+            food=self.food, quantity=2, date=self.today, user=self.user
+        )
+        Portion.objects.create(
+            food=self.food,
+            quantity=1,
+            meal=self.meal,
+            date=self.today,
+            user=self.user,
+        )
+
+    def _total(self, day):
+        return DailyTotal.objects.get(user=self.user, date=day)
+
+    def test_portion_writes(self):
+        _total = self._total(self.today)
+        self.assertEqual(_total.calories, 300)
+        self.assertEqual(_total.portion_count, 2)
+        self.assertEqual(_total.meal_calories, {"other": 200, "lunch": 100})
+
+        self.portion.date = self.yesterday
+        self.portion.save()
+        self.assertEqual(self._total(self.today).calories, 100)
+        self.assertEqual(self._total(self.yesterday).calories, 200)
+
+        self.portion.delete()
+        self.assertFalse(
+            DailyTotal.objects.filter(user=self.user, date=self.yesterday).exists()
+        )
+
+    def test_food_and_meal_edits(self):
+        # portions keep their calories, unless re-priced
+        self.food.calories = 150
+        self.food.save()
+        self.assertEqual(self._total(self.today).calories, 300)
+        self.assertEqual(pricing.reprice(self.food), 2)
+        self.assertEqual(self._total(self.today).calories, 450)
+
+        self.meal.name = "dinner"
+        self.meal.save()
+        self.assertEqual(
+            self._total(self.today).meal_calories, {"other": 300, "dinner": 150}
+        )
+
+        self.meal.delete()
+        self.assertEqual(self._total(self.today).meal_calories, {"other": 450})
+
+    def test_rebuild_and_verify(self):
+        DailyTotal.objects.update(calories=0)
+        self.assertEqual(rollup.verify(), [(self.user.id, self.today)])
+        with self.assertRaises(CommandError):
+            call_command("nutrition_rollup", verify=True, stdout=StringIO())
+
+        call_command("nutrition_rollup", stdout=StringIO())
+        self.assertEqual(rollup.verify(), [])
+        self.assertEqual(self._total(self.today).calories, 300)
+
+    def test_read_from_rollup(self):
+        days = daily_calories(self.user, self.yesterday, self.today)
+        self.assertEqual(days, [(self.today, 300)])
+
+    @override_settings(NUTRITION_USE_ROLLUP=False)
+    def test_disabled(self):
+        # nothing reads the rollup: writes don't maintain it
+        with self.assertNumQueries(3):  # the portion, DataVersion, FoodUsage
+            Portion.objects.create(food=self.food, date=self.yesterday, user=self.user)
+        self.assertFalse(DailyTotal.objects.filter(date=self.yesterday).exists())
+
+
+class InlineExecutor(Executor):
+    """
+    Runs the submitted calls right away, in place of parallel's process
+    pool (whose workers wouldn't see the in-memory test database)
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+@override_settings(NUTRITION_USE_ROLLUP=True)
+class ParallelRollupTest(TestCase):
+    def setUp(self):
+        self.users = []
+        for i, count in enumerate([6, 1, 3, 2, 0]):
+            _user = User.objects.create_user(f"user {i}")
+            _food = Food.objects.create(name="food 100", calories=100, user=_user)
+            for day in range(count):
+                Portion.objects.create(
+                    user=_user, food=_food, date=date(2024, 1, 1 + day)
+                )
+            self.users.append(_user)
+
+    def test_shards(self):
+        shards = parallel.shards(None, 2)
+        self.assertEqual(
+            sorted(map(sorted, shards)),
+            sorted(
+                [
+                    [self.users[0].pk, self.users[4].pk],  # 6 portions
+                    [self.users[1].pk, self.users[2].pk, self.users[3].pk],  # 6
+                ]
+            ),
+        )
+        self.assertEqual(len(parallel.shards(None, 10)), 5)
+        self.assertEqual(parallel.shards([self.users[1].pk], 4), [[self.users[1].pk]])
+
+    @patch("django_nutrition.parallel.ProcessPoolExecutor", InlineExecutor)
+    def test_rebuild_and_verify(self):
+        DailyTotal.objects.filter(user__in=self.users[:2]).update(calories=0)
+        models.FoodUsage.objects.all().delete()
+        out, err = StringIO(), StringIO()
+        with self.assertRaisesMessage(CommandError, "7 daily totals differ"):
+            call_command(
+                "nutrition_rollup", verify=True, workers=2, stdout=out, stderr=err
+            )
+        self.assertIn(f"user {self.users[1].pk}: 2024-01-01 differs", out.getvalue())
+        self.assertIn("5/5 users...", err.getvalue())
+
+        out = StringIO()
+        call_command("nutrition_rollup", workers=2, stdout=out, stderr=StringIO())
+        self.assertIn("rebuilt 12 daily totals and 4 usage", out.getvalue())
+        self.assertEqual(rollup.verify(), [])
+        self.assertEqual(models.FoodUsage.objects.count(), 4)
+
+        with self.assertRaises(CommandError):
+            call_command("nutrition_rollup", workers=0)
+
+
+class PricingTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("test7", "1234")
+        self.food = Food.objects.create(name="food 100", calories=100, user=self.user)
+        self.other = Food.objects.create(name="food 50", calories=50, user=self.user)
+        self.day = date(2024, 1, 1)
+        self.portion = Portion.objects.create(
+            food=self.food, quantity=2, date=self.day, user=self.user
+        )
+
+    def test_snapshot(self):
+        self.assertEqual(self.portion.calories_per_unit, 100)
+        self.food.calories = 150
+        self.food.save()
+        self.portion.refresh_from_db()
+        self.assertEqual(self.portion.calories(), 200)
+        self.assertEqual(daily_calories(self.user, self.day, self.day)[0].calories, 200)
+
+        # a quantity edit keeps the snapshot, a food change takes a new one
+        self.portion.quantity = 3
+        self.portion.save()
+        self.assertEqual(self.portion.calories_per_unit, 100)
+        self.portion.food = self.other
+        self.portion.save()
+        self.assertEqual(self.portion.calories_per_unit, 50)
+
+    def test_aggregates_one_table(self):
+        with CaptureQueriesContext(connection) as ctx:
+            daily_calories(self.user, self.day, self.day)
+        self.assertNotIn("django_nutrition_food", ctx.captured_queries[0]["sql"])
+
+    def test_reprice(self):
+        Portion.objects.create(
+            food=self.food, date=self.day - timedelta(days=1), user=self.user
+        )
+        month_events(self.user, date(2023, 12, 1), date(2024, 1, 31), 2000)
+        self.food.calories = 150
+        self.food.save()
+
+        self.assertEqual(pricing.reprice(self.food, start_date=self.day), 1)
+        events = month_events(self.user, date(2023, 12, 1), date(2024, 1, 31), 2000)
+        self.assertEqual(
+            [(e["start"], e["title"]) for e in events],
+            [("2023-12-31", "100"), ("2024-01-01", "300")],
+        )
+        self.assertEqual(pricing.reprice(self.food, chunk_size=1), 1)
+        self.assertEqual(pricing.reprice(self.food), 0)
+
+    def test_reprice_command(self):
+        self.food.calories = 120
+        self.food.save()
+        call_command(
+            "nutrition_calories",
+            food_ids=[self.food.pk],
+            chunk_size=2,
+            stdout=StringIO(),
+        )
+        self.portion.refresh_from_db()
+        self.assertEqual(self.portion.calories_per_unit, 120)
+        with self.assertRaises(CommandError):
+            call_command("nutrition_calories", food_ids=[0], stdout=StringIO())
+
+    def test_food_form_reprice(self):
+        self.client.force_login(self.user)
+        url = reverse("add_or_edit_food", args=[self.food.pk])
+        self.client.post(url, {"name": "food 100", "calories": 110})
+        self.portion.refresh_from_db()
+        self.assertEqual(self.portion.calories_per_unit, 100)
+        self.client.post(url, {"name": "food 100", "calories": 120, "reprice": "on"})
+        self.portion.refresh_from_db()
+        self.assertEqual(self.portion.calories_per_unit, 120)
+
+        # other users' foods are out of reach
+        self.client.force_login(User.objects.create_user("other"))
+        response = self.client.post(
+            url, {"name": "food 100", "calories": 130, "reprice": "on"}
+        )
+        self.assertEqual(response.status_code, 404)
+        self.portion.refresh_from_db()
+        self.assertEqual(self.portion.calories_per_unit, 120)
+
+
+class SnapshotMigrationTest(TransactionTestCase):
+    BEFORE = (("django_nutrition", "0016_mealsummary_portionarchive"),)
+
+    def setUp(self):
+        for _cache in caches.all():
+            _cache.clear()
+
+    def tearDown(self):
+        self._migrate(None)
+
+    def _migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        targets = list(targets or executor.loader.graph.leaf_nodes())
+        executor.migrate(targets)
+        executor.loader.build_graph()
+        return executor.loader.project_state(targets).apps
+
+    def _log_unsnapshotted(self, apps, user_id, count):
+        _food = apps.get_model("django_nutrition", "Food").objects.create(
+            user_id=user_id, name="food 100", calories=100
+        )
+        apps.get_model("django_nutrition", "Portion").objects.bulk_create(
+            apps.get_model("django_nutrition", "Portion")(
+                user_id=user_id, food=_food, date=date(2024, 1, 1)
+            )
+            for _ in range(count)
+        )
+
+    def test_backfill(self):
+        user = User.objects.create_user("test8", "1234")
+        apps = self._migrate(self.BEFORE)
+        self._log_unsnapshotted(apps, user.pk, 3)
+        out = StringIO()
+        call_command("nutrition_calories", chunk_size=2, stdout=out, stderr=StringIO())
+        self.assertIn("snapshotted 3 portions", out.getvalue())
+        self.assertEqual(
+            month_events(user, date(2024, 1, 1), date(2024, 1, 31), 2000)[0]["title"],
+            "300",
+        )
+
+        # the migration snapshots what's left, a batch of ids at a time
+        self._log_unsnapshotted(apps, user.pk, 3)
+        migration = importlib.import_module(
+            "django_nutrition.migrations.0017_snapshot_portion_calories"
+        )
+        with patch.object(migration, "BATCH_SIZE", 2):
+            self._migrate(None)
+        self.assertEqual(
+            list(Portion.objects.values_list("calories_per_unit", flat=True)),
+            [100] * 6,
+        )
+
+
+class CompactionTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser")
+        food_100 = Food.objects.create(name="food 100", calories=100, user=self.user)
+        food_250 = Food.objects.create(name="food 250", calories=250, user=self.user)
+        self.lunch = Meal.objects.create(name="lunch", user=self.user)
+        dinner = Meal.objects.create(name="dinner", user=self.user)
+        self.today = timezone.localdate()
+        self.old_day = self.today - timedelta(days=60)
+        for days_ago, _food, meal, quantity in [
+            (60, food_100, self.lunch, 1),
+            (60, food_250, self.lunch, 2),
+            (60, food_100, None, 3),
+            (59, food_250, dinner, 1),
+            (45, food_100, self.lunch, 2),
+            (1, food_100, self.lunch, 1),
+        ]:
+            Portion.objects.create(
+                user=self.user,
+                food=_food,
+                meal=meal,
+                quantity=quantity,
+                date=self.today - timedelta(days=days_ago),
+            )
+        self.food_100 = food_100
+        self.client.force_login(self.user)
+
+    def _compact(self, **kwargs):
+        return compaction.compact(self.today - timedelta(days=30), **kwargs)
+
+    def _day(self, day):
+        response = self.client.get(reverse("day", args=[day.isoformat()]))
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def _reads(self):
+        start = self.today - timedelta(days=90)
+        days = self.client.get(
+            reverse("days") + f"?before={self.today - timedelta(days=2)}"
+        ).context["days"]
+        day = self._day(self.old_day).context
+        return {
+            "daily_calories": daily_calories(self.user, start, self.today),
+            "events": range_events(self.user, [(start, self.today)], 1000),
+            "days": [
+                (d.date, d.calories, sorted((m.name, m.calories) for m in d.meals))
+                for d in days
+            ],
+            "day": (
+                day["calories"],
+                sorted((m.name, m.calories) for m in day["meals"]),
+            ),
+        }
+
+    def test_transparent(self):
+        before = self._reads()
+        self.assertEqual(self._compact(), (5, 3))
+        self.assertEqual(Portion.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(
+            sorted(
+                models.MealSummary.objects.values_list(
+                    "date", "meal__name", "calories", "portion_count"
+                ),
+                key=lambda s: (s[0], s[1] or ""),
+            ),
+            [
+                (self.old_day, None, 300.0, 1),
+                (self.old_day, "lunch", 600.0, 2),
+                (self.today - timedelta(days=59), "dinner", 250.0, 1),
+                (self.today - timedelta(days=45), "lunch", 200.0, 1),
+            ],
+        )
+        self.assertEqual(self._reads(), before)
+
+    @override_settings(NUTRITION_USE_ROLLUP=True)
+    def test_transparent_from_rollup(self):
+        rollup.rebuild()
+        self.test_transparent()
+        self.assertEqual(rollup.verify(), [])
+
+        # a renamed meal, in the summaries as in the portions
+        self.lunch.name = "brunch"
+        self.lunch.save()
+        self.assertEqual(rollup.verify(), [])
+        self.assertIn(
+            "brunch",
+            DailyTotal.objects.get(user=self.user, date=self.old_day).meal_calories,
+        )
+
+    def test_archive(self):
+        self._compact()
+        self.assertEqual(models.PortionArchive.objects.count(), 3)
+        meals = {m.name: m for m in self._day(self.old_day).context["meals"]}
+        self.assertEqual(
+            [(p.pk, p.food.name, p.quantity) for p in meals["lunch"].portions],
+            [(None, "food 100", 1), (None, "food 250", 2)],
+        )
+        self.assertEqual([p.quantity for p in meals["other"].portions], [3])
+
+    def test_no_archive(self):
+        with override_settings(NUTRITION_COMPACT_ARCHIVE=False):
+            self._compact()
+        self.assertFalse(models.PortionArchive.objects.exists())
+        meals = self._day(self.old_day).context["meals"]
+        self.assertEqual(
+            sorted((m.name, m.calories, len(m.portions)) for m in meals),
+            [("lunch", 600.0, 0), ("other", 300.0, 0)],
+        )
+
+    def _usage(self):
+        return [
+            sorted(models.FoodUsage.objects.values_list("food__name", "count")),
+            sorted(models.MealUsage.objects.values_list("meal__name", "count")),
+        ]
+
+    def test_usage(self):
+        # the compacted portions stop counting at once, as after a rebuild
+        self._compact()
+        self.assertEqual(self._usage(), [[("food 100", 1)], [("lunch", 1)]])
+        usage.rebuild()
+        self.assertEqual(self._usage(), [[("food 100", 1)], [("lunch", 1)]])
+
+    def test_compacted_day_with_new_portions(self):
+        self._compact()
+        Portion.objects.create(
+            user=self.user, food=self.food_100, meal=self.lunch, date=self.old_day
+        )
+        day = self._day(self.old_day).context
+        self.assertEqual(day["calories"], 1000.0)
+        self.assertEqual(
+            sorted((m.name, m.calories, len(m.portions)) for m in day["meals"]),
+            [("lunch", 700.0, 3), ("other", 300.0, 1)],
+        )
+        calories = daily_calories(self.user, self.old_day, self.old_day)
+        self.assertEqual([c.calories for c in calories], [1000.0])
+
+        # compacted again: merged into the day's summary and archive
+        self.assertEqual(self._compact(), (1, 1))
+        lunch = models.MealSummary.objects.get(date=self.old_day, meal=self.lunch)
+        self.assertEqual((lunch.calories, lunch.portion_count), (700.0, 3))
+        archive = models.PortionArchive.objects.get(date=self.old_day)
+        self.assertEqual(len(compaction.archived_portions(archive)), 4)
+        self.assertEqual(self._day(self.old_day).context["calories"], 1000.0)
+
+    def test_command(self):
+        with self.assertRaises(CommandError):
+            call_command("nutrition_compact")
+        with self.assertRaises(CommandError):
+            call_command("nutrition_compact", "--older-than", "30", "--user", "x")
+        out = StringIO()
+        with override_settings(NUTRITION_COMPACT_AFTER_DAYS=50):
+            call_command("nutrition_compact", stdout=out, stderr=StringIO())
+        self.assertIn("compacted 4 portions of 2 days", out.getvalue())
+        call_command(
+            "nutrition_compact",
+            "--older-than",
+            "30",
+            "--no-archive",
+            stdout=out,
+            stderr=StringIO(),
+        )
+        self.assertIn("compacted 1 portions of 1 days", out.getvalue())
+        self.assertEqual(models.PortionArchive.objects.count(), 2)
+
+
 class ViewsTest(TestCase):
     USERNAME = "testuser"
     PASSWORD = "testpassword"
@@ -88,6 +764,17 @@ class ViewsTest(TestCase):
         # dumb ... should do a better test than this (e.g. dates)
         self.assertContains(response, "Calories")
 
+    @override_settings(NUTRITION_USE_ROLLUP=True)
+    def test_days_from_rollup(self):
+        rollup.rebuild()
+        self.client.login(username=ViewsTest.USERNAME, password=ViewsTest.PASSWORD)
+        response = self.client.get(reverse("days"))
+        self.assertEqual(response.status_code, 200)
+        days = response.context["days"]
+        self.assertEqual(len(days), 3)
+        self.assertEqual([d.calories for d in days], [1600] * 3)
+        self.assertEqual(days[0].meals[0].name, "other")
+
     def test_days_list_api(self):
         response = self.client.get(reverse("day-events"))
         self.assertEqual(response.status_code, 403)
@@ -100,6 +787,1422 @@ class ViewsTest(TestCase):
         assert len(days_list) == 2
 
 
+class FragmentCacheTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser")
+        self.food = Food.objects.create(name="food 100", calories=100, user=self.user)
+        self.meal = Meal.objects.create(name="lunch", user=self.user)
+        self.today = timezone.localdate()
+        for days_ago in range(3):
+            Portion.objects.create(
+                user=self.user,
+                food=self.food,
+                meal=self.meal,
+                date=self.today - timedelta(days=days_ago),
+            )
+        self.client.force_login(self.user)
+
+    def _rendered(self, url, template_name):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [t.name for t in response.templates].count(template_name), response
+
+    def test_days_meal_tables(self):
+        url = reverse("days")
+        rendered, _ = self._rendered(url, "django_nutrition/meals.html")
+        self.assertEqual(rendered, 3)
+        rendered, response = self._rendered(url, "django_nutrition/meals.html")
+        self.assertEqual(rendered, 0)
+        self.assertContains(response, "lunch", count=3)
+
+        # only the changed day is rendered again
+        Portion.objects.create(
+            user=self.user, food=self.food, meal=self.meal, date=self.today
+        )
+        rendered, response = self._rendered(url, "django_nutrition/meals.html")
+        self.assertEqual(rendered, 1)
+        self.assertContains(response, '<td class="px-4 py-2">200.0</td>')
+
+        self.meal.name = "dinner"
+        self.meal.save()
+        rendered, response = self._rendered(url, "django_nutrition/meals.html")
+        self.assertEqual(rendered, 3)
+        self.assertContains(response, "dinner", count=3)
+
+    def test_day_table(self):
+        url = reverse("day", args=[self.today.isoformat()])
+        rendered, _ = self._rendered(url, "django_nutrition/day-meals.html")
+        self.assertEqual(rendered, 1)
+        rendered, response = self._rendered(url, "django_nutrition/day-meals.html")
+        self.assertEqual(rendered, 0)
+        self.assertContains(response, "food 100")
+
+        # a rename changes no totals, but the rendered portions
+        self.food.name = "renamed food"
+        self.food.save()
+        rendered, response = self._rendered(url, "django_nutrition/day-meals.html")
+        self.assertEqual(rendered, 1)
+        self.assertContains(response, "renamed food")
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}}
+    )
+    def test_dummy_cache(self):
+        url = reverse("days")
+        for _ in range(2):
+            rendered, response = self._rendered(url, "django_nutrition/meals.html")
+            self.assertEqual(rendered, 3)
+            self.assertContains(response, "lunch", count=3)
+
+
+class PaginationTest(TestCase):
+    USERNAME = "testuser"
+    PASSWORD = "testpassword"
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username=PaginationTest.USERNAME, password=PaginationTest.PASSWORD
+        )
+        self.client.login(
+            username=PaginationTest.USERNAME, password=PaginationTest.PASSWORD
+        )
+
+    def _follow(self, url_name, param, context_key, object_key):
+        pages = []
+        cursor = None
+        while True:
+            url = reverse(url_name) + (f"?{param}={cursor}" if cursor else "")
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            pages.append(list(response.context[object_key]))
+            cursor = response.context[context_key]
+            if cursor is None:
+                return pages
+            if param == "before":
+                cursor = cursor.isoformat()
+
+    def test_foods(self):
+        # duplicate names must neither repeat nor vanish across pages
+        Food.objects.bulk_create(
+            Food(user=self.user, name=f"food {i // 2:03d}", calories=i)
+            for i in range(7)
+        )
+        with patch.object(views.FoodsView, "PAGE_SIZE", 2):
+            pages = self._follow("foods-more", "after", "next_cursor", "foods")
+        self.assertEqual([len(p) for p in pages], [2, 2, 2, 1])
+        foods = [f for p in pages for f in p]
+        self.assertEqual([f.calories for f in foods], list(range(7)))
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse("foods") + "?after=xyz")
+        self.assertEqual(response.status_code, 400)
+        for values in [["x", "y"], ["x", {}], [None, 1]]:
+            with self.subTest(values):
+                cursor = pagination.encode_cursor(values)
+                response = self.client.get(reverse("foods") + f"?after={cursor}")
+                self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse("days") + "?before=xyz")
+        self.assertEqual(response.status_code, 400)
+
+    def _days_pages(self):
+        _food = Food.objects.create(name="food 100", calories=100, user=self.user)
+        _today = timezone.now().date()
+        Portion.objects.bulk_create(
+            Portion(
+                user=self.user,
+                food=_food,
+                date=_today - timedelta(days=d),
+                calories_per_unit=_food.calories,
+            )
+            for d in [0, 1, 40, 40, 41, 50, 60, 70]
+        )
+        rollup.rebuild([self.user.pk])
+        with patch.object(views.DaysView, "PAGE_SIZE", 2):
+            pages = self._follow("days", "before", "next_before", "days")
+        self.assertEqual([len(p) for p in pages], [2, 2, 2, 1])
+        _days = [d for p in pages for d in p]
+        self.assertEqual(
+            [(_today - d.date).days for d in _days], [0, 1, 40, 41, 50, 60, 70]
+        )
+        self.assertEqual(_days[2].calories, 200)
+
+    def test_days(self):
+        self._days_pages()
+
+    @override_settings(NUTRITION_USE_ROLLUP=True)
+    def test_days_from_rollup(self):
+        self._days_pages()
+
+
+class FoodSearchTest(TestCase):
+    USERNAME = "testuser"
+    PASSWORD = "testpassword"
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username=FoodSearchTest.USERNAME, password=FoodSearchTest.PASSWORD
+        )
+        _other = User.objects.create_user(username="other")
+        # bulk_create sends no signals, the index must follow anyway
+        Food.objects.bulk_create(
+            Food(user=self.user, name=_name, calories=100)
+            for _name in ["Apple pie", "Green apple", "Pineapple", "Crème brûlée"]
+        )
+        Food.objects.create(user=_other, name="Apple", calories=50)
+
+    def _names(self, query, **kwargs):
+        return [f.name for f in search.search_foods(self.user, query, **kwargs)]
+
+    def _check(self):
+        self.assertEqual(self._names("app"), ["Apple pie", "Green apple"])
+        self.assertEqual(self._names("APPLE gr"), ["Green apple"])
+        self.assertEqual(self._names("crème"), ["Crème brûlée"])
+        self.assertEqual(self._names("app", limit=1), ["Apple pie"])
+        self.assertEqual(self._names(" "), [])
+
+        _food = Food.objects.get(name="Pineapple")
+        _food.name = "Apple, pine"
+        _food.save()
+        Food.objects.filter(name="Apple pie").delete()
+        self.assertEqual(self._names("app"), ["Apple, pine", "Green apple"])
+
+    @skipUnless(search.fts_enabled(), "no FTS5")
+    def test_search(self):
+        self.assertEqual(self._names("creme"), ["Crème brûlée"])  # unicode61
+        self._check()
+
+    def test_search_without_fts(self):
+        with patch.object(search, "fts_enabled", return_value=False):
+            self._check()
+
+    def test_api(self):
+        response = self.client.get(reverse("food-search"), {"q": "app"})
+        self.assertEqual(response.status_code, 403)
+
+        self.client.login(
+            username=FoodSearchTest.USERNAME, password=FoodSearchTest.PASSWORD
+        )
+        response = self.client.get(reverse("food-search"), {"q": "green"})
+        self.assertEqual(response.status_code, 200)
+        _food = Food.objects.get(name="Green apple")
+        self.assertEqual(
+            response.json(), [{"id": _food.pk, "name": "Green apple", "calories": 100}]
+        )
+
+    def test_portion_form(self):
+        self.client.login(
+            username=FoodSearchTest.USERNAME, password=FoodSearchTest.PASSWORD
+        )
+        response = self.client.get(reverse("add_or_edit_portion"))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, "Pineapple")
+
+        _food = Food.objects.get(name="Pineapple")
+        response = self.client.post(
+            reverse("add_or_edit_portion"),
+            {"date": "2024-10-01", "quantity": 1, "food": _food.pk},
+        )
+        self.assertEqual(response.status_code, 302)
+        _portion = Portion.objects.get(user=self.user)
+        response = self.client.get(reverse("add_or_edit_portion", args=[_portion.pk]))
+        self.assertContains(response, 'value="Pineapple"')
+
+        # another user's food is rejected
+        response = self.client.post(
+            reverse("add_or_edit_portion"),
+            {
+                "date": "2024-10-01",
+                "quantity": 1,
+                "food": Food.objects.get(name="Apple").pk,
+            },
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, 'value="Apple"')
+
+
+class UsageTest(TestCase):
+    USERNAME = "testuser"
+    PASSWORD = "testpassword"
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username=UsageTest.USERNAME, password=UsageTest.PASSWORD
+        )
+        self.apple = Food.objects.create(name="apple", calories=50, user=self.user)
+        self.bread = Food.objects.create(name="bread", calories=80, user=self.user)
+        self.lunch = Meal.objects.create(name="lunch", user=self.user)
+        self.today = timezone.now().date()
+
+    def _add(self, food, days_ago, meal=None):
+        return Portion.objects.create(
+            user=self.user,
+            food=food,
+            meal=meal,
+            date=self.today - timedelta(days=days_ago),
+        )
+
+    def _stats(self):
+        return sorted(
+            models.FoodUsage.objects.values_list("food__name", "count", "last_used")
+        ) + sorted(
+            models.MealUsage.objects.values_list("meal__name", "count", "last_used")
+        )
+
+    def assertConsistent(self):
+        stats = self._stats()
+        usage.rebuild()
+        self.assertEqual(stats, self._stats())
+
+    def test_suggestions(self):
+        for days_ago in [5, 4, 3]:
+            self._add(self.apple, days_ago, self.lunch)
+        self._add(self.bread, 1)
+        _suggestions = usage.suggestions(self.user.pk)
+        self.assertEqual(
+            [f["name"] for f in _suggestions["frequent_foods"]], ["apple", "bread"]
+        )
+        self.assertEqual(
+            [f["name"] for f in _suggestions["recent_foods"]], ["bread", "apple"]
+        )
+        self.assertEqual(_suggestions["frequent_foods"][0]["count"], 3)
+        self.assertEqual(_suggestions["recent_meals"][0]["name"], "lunch")
+
+        # cached, until a portion or a name changes
+        with self.assertNumQueries(0):
+            usage.suggestions(self.user.pk)
+        self.apple.name = "green apple"
+        self.apple.save()
+        _suggestions = usage.suggestions(self.user.pk)
+        self.assertEqual(_suggestions["frequent_foods"][0]["name"], "green apple")
+        self.assertConsistent()
+
+    def test_portion_writes(self):
+        _portion = self._add(self.apple, 0, self.lunch)
+        self._add(self.apple, 3)
+        _portion.food = self.bread
+        _portion.meal = None
+        _portion.save()
+        self.assertConsistent()
+        self.assertEqual(
+            self._stats(),
+            [("apple", 1, self.today - timedelta(days=3)), ("bread", 1, self.today)],
+        )
+
+        _portion.delete()
+        self.assertConsistent()
+        Portion.objects.filter(food=self.apple).delete()
+        self.assertEqual(self._stats(), [])
+
+    def test_bulk_writes(self):
+        self._add(self.apple, 0, self.lunch)
+        import_stream(
+            self.user,
+            StringIO("date,food,meal\n2024-01-01,bread,dinner\n2024-01-02,apple,\n"),
+            "portions",
+            "csv",
+        )
+        self.assertConsistent()
+        self.assertEqual(len(self._stats()), 4)
+
+        self.bread.delete()
+        self.assertConsistent()
+        self.assertEqual([name for name, _, _ in self._stats()], ["apple", "lunch"])
+
+    def test_api_and_form(self):
+        self._add(self.bread, 0, self.lunch)
+        self.client.login(username=UsageTest.USERNAME, password=UsageTest.PASSWORD)
+        response = self.client.get(reverse("suggestions"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json()["frequent_foods"],
+            [
+                {
+                    "id": self.bread.pk,
+                    "name": "bread",
+                    "calories": 80,
+                    "count": 1,
+                    "last_used": self.today.isoformat(),
+                }
+            ],
+        )
+
+        response = self.client.get(reverse("add_or_edit_portion"))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, f"pickSuggestion('id_food', '{self.bread.pk}'")
+        self.assertContains(response, f"pickSuggestion('id_meal', '{self.lunch.pk}'")
+        self.assertContains(response, "function pickSuggestion", count=1)
+        self.assertContains(response, "<title>New Portion</title>")
+
+
+class SummariesTest(TestCase):
+    USERNAME = "testuser"
+    PASSWORD = "testpassword"
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username=SummariesTest.USERNAME, password=SummariesTest.PASSWORD
+        )
+        Preferences.objects.create(user=self.user, max_calories=1000)
+        _food = Food.objects.create(name="food 100", calories=100, user=self.user)
+        # Mon 2024-01-29 .. Sun 2024-02-04, then Mon 2024-02-05
+        for day, quantity in [
+            (date(2024, 1, 29), 5),  # under
+            (date(2024, 1, 31), 10),  # slightly over (1100, the upper bound)
+            (date(2024, 1, 31), 1),
+            (date(2024, 2, 1), 12),  # over
+            (date(2024, 2, 4), 10.5),  # slightly over
+            (date(2024, 2, 5), 2),
+        ]:
+            Portion.objects.create(
+                user=self.user, food=_food, quantity=quantity, date=day
+            )
+        self.client.login(
+            username=SummariesTest.USERNAME, password=SummariesTest.PASSWORD
+        )
+
+    def _get(self, **params):
+        response = self.client.get(reverse("summaries"), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def _check(self):
+        weeks = self._get(period="week", start="2024-01-01", end="2024-02-29")
+        self.assertEqual(
+            weeks[0],
+            {
+                "start": "2024-01-29",
+                "end": "2024-02-04",
+                "days": 4,
+                "total": 3850.0,
+                "mean": 962.5,
+                "min": 500.0,
+                "max": 1200.0,
+                "days_over_target": 3,
+                "ranges": {"under": 1, "over": 1, "slightly_over": 2},
+            },
+        )
+        self.assertEqual([w["start"] for w in weeks], ["2024-01-29", "2024-02-05"])
+
+        months = self._get(period="month", start="2024-01-01", end="2024-02-29")
+        self.assertEqual(
+            [(m["start"], m["end"], m["days"], m["total"]) for m in months],
+            [
+                ("2024-01-01", "2024-01-31", 2, 1600.0),
+                ("2024-02-01", "2024-02-29", 3, 2450.0),
+            ],
+        )
+        self.assertEqual(
+            months[1]["ranges"], {"under": 1, "over": 1, "slightly_over": 1}
+        )
+
+    def test_summaries(self):
+        self._check()
+
+    @override_settings(NUTRITION_USE_ROLLUP=True)
+    def test_summaries_from_rollup(self):
+        rollup.rebuild()
+        with self.assertNumQueries(1):
+            stats.summaries(
+                self.user, date(2024, 1, 1), date(2024, 12, 31), "month", 1000
+            )
+        self._check()
+
+    def test_invalid(self):
+        response = self.client.get(reverse("summaries"), {"period": "year"})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse("summaries"), {"start": "x"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self._get(), [])  # nothing in the last year
+
+
+class AnalyticsTest(TestCase):
+    USERNAME = "testuser"
+    PASSWORD = "testpassword"
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username=AnalyticsTest.USERNAME, password=AnalyticsTest.PASSWORD
+        )
+        Preferences.objects.create(user=self.user, max_calories=1000)
+        self.food = Food.objects.create(name="food 100", calories=100, user=self.user)
+        for day, quantity in [
+            (date(2024, 2, 20), 11),  # over
+            (date(2024, 3, 1), 5),
+            (date(2024, 3, 2), 8),
+            (date(2024, 3, 3), 9),
+            (date(2024, 3, 4), 12),  # over
+            (date(2024, 3, 5), 6),
+            (date(2024, 3, 6), 7),
+        ]:
+            self._log(day, quantity)
+        self.client.login(
+            username=AnalyticsTest.USERNAME, password=AnalyticsTest.PASSWORD
+        )
+
+    def _log(self, day, quantity):
+        return Portion.objects.create(
+            user=self.user, food=self.food, quantity=quantity, date=day
+        )
+
+    def test_analytics(self):
+        result = analytics.analytics(self.user, 1000, date(2024, 3, 7))
+        self.assertEqual(result["first"], date(2024, 2, 20))
+        self.assertEqual(
+            result["averages"],
+            {"7": 783.3, "30": 828.6, "90": 828.6},  # 4700 / 6, 5800 / 7
+        )
+        # nothing logged on the 7th (yet): the streak ends on the 6th
+        self.assertEqual(result["streaks"], {"current": 2, "longest": 3})
+        self.assertEqual(len(result["series"]), 17)  # since the first day
+        self.assertEqual(
+            result["series"][-2],
+            {
+                "date": date(2024, 3, 6),
+                "calories": 700.0,
+                "averages": {"7": 783.3, "30": 828.6, "90": 828.6},
+            },
+        )
+        self.assertIsNone(result["series"][-1]["calories"])
+
+        # the streaks follow the target
+        result = analytics.analytics(self.user, 850, date(2024, 3, 7))
+        self.assertEqual(result["streaks"], {"current": 2, "longest": 2})
+
+    def test_trend(self):
+        # every other day, 10 more calories per day
+        first = date(2024, 1, 1)
+        history = analytics.History(first, 1000)
+        history.extend(
+            date(2024, 1, 31),
+            {first + timedelta(days=i): 1000 + 10 * i for i in range(0, 31, 2)},
+        )
+        self.assertEqual(
+            history.trend(30, analytics.TREND_DAYS),
+            {"slope": 10.0, "projection": 1600.0},
+        )
+        self.assertEqual(history.trend(30, 7), {"slope": 10.0, "projection": 1600.0})
+        self.assertIsNone(history.trend(1, 2))  # a single logged day
+
+    def test_incremental(self):
+        analytics.analytics(self.user, 1000, date(2024, 3, 7))
+        # nothing changed: the cached arrays are extended without queries
+        with self.assertNumQueries(0):
+            result = analytics.analytics(self.user, 1000, date(2024, 3, 8))
+        # (nothing logged on the 7th: the streak is over)
+        self.assertEqual(result["streaks"], {"current": 0, "longest": 3})
+        self.assertIsNone(result["series"][-1]["calories"])
+
+        # a change reloads its month only
+        self._log(date(2024, 3, 8), 4)
+        with CaptureQueriesContext(connection) as queries:
+            result = analytics.analytics(self.user, 1000, date(2024, 3, 8))
+        self.assertEqual(len(queries), 1)
+        self.assertIn("2024-03-01", queries[0]["sql"])
+        self.assertEqual(result["streaks"], {"current": 1, "longest": 3})
+        self.assertEqual(result["series"][-1]["calories"], 400.0)
+
+        # portions before the first day reload everything
+        self._log(date(2024, 1, 15), 5)
+        result = analytics.analytics(self.user, 1000, date(2024, 3, 8))
+        self.assertEqual(result["first"], date(2024, 1, 15))
+        self.assertEqual(result["averages"]["90"], 744.4)  # 6700 / 9
+
+    def test_earlier_end_date(self):
+        expected = analytics.analytics(self.user, 1000, date(2024, 3, 8))
+        result = analytics.analytics(self.user, 1000, date(2024, 3, 4))
+        self.assertEqual(result["last"], date(2024, 3, 4))
+        self.assertEqual(result["series"][-1]["calories"], 1200.0)
+        # the days after it are still there for a later request
+        with self.assertNumQueries(0):
+            result = analytics.analytics(self.user, 1000, date(2024, 3, 8))
+        self.assertEqual(result, expected)
+
+    def test_default_date(self):
+        today = timezone.localdate()
+        analytics.analytics(self.user, 1000, today)
+        # the date is still the timezone.now datetime when the signals run
+        Portion.objects.create(user=self.user, food=self.food, quantity=2)
+        result = analytics.analytics(self.user, 1000, today)
+        self.assertEqual(result["series"][-1]["calories"], 200.0)
+
+    @override_settings(NUTRITION_USE_ROLLUP=True)
+    def test_incremental_from_rollup(self):
+        rollup.rebuild()
+        self.test_incremental()
+
+    def test_api(self):
+        today = timezone.localdate()
+        self._log(today, 3)
+        response = self.client.get(reverse("analytics"))
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual(result["last"], today.isoformat())
+        self.assertEqual(result["averages"]["7"], 300.0)
+        self.assertEqual(result["streaks"]["current"], 1)
+
+        # nothing logged yet
+        User.objects.create_user(username="new", password=AnalyticsTest.PASSWORD)
+        self.client.login(username="new", password=AnalyticsTest.PASSWORD)
+        self.assertEqual(self.client.get(reverse("analytics")).json(), {})
+
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse("analytics")).status_code, 403)
+
+
+@skipUnless(connection.vendor == "sqlite", "EXPLAIN QUERY PLAN is sqlite specific")
+class QueryPlanTest(TestCase):
+    USERNAME = "testuser"
+    PASSWORD = "testpassword"
+    TABLES = ("django_nutrition_portion", "django_nutrition_food")
+
+    def setUp(self):
+        _user = User.objects.create_user(
+            username=QueryPlanTest.USERNAME, password=QueryPlanTest.PASSWORD
+        )
+        _food = Food.objects.create(name="food 100", calories=100, user=_user)
+        Portion.objects.create(food=_food, date=timezone.now(), user=_user)
+        self.client.login(
+            username=QueryPlanTest.USERNAME, password=QueryPlanTest.PASSWORD
+        )
+
+    def _plans(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        plans = []
+        with connection.cursor() as cursor:
+            for query in ctx.captured_queries:
+                if not any(t in query["sql"] for t in self.TABLES):
+                    continue
+                cursor.execute(f"EXPLAIN QUERY PLAN {query['sql']}")
+                plans.append([row[-1] for row in cursor.fetchall()])
+        self.assertTrue(plans)
+        return plans
+
+    def assertNoTableScan(self, url, index_name):
+        plans = self._plans(url)
+        for plan in plans:
+            for step in plan:
+                for table in self.TABLES:
+                    self.assertFalse(step.startswith(f"SCAN {table}"), f"{url}: {step}")
+        self.assertTrue(
+            any(index_name in step for plan in plans for step in plan),
+            f"{url}: {index_name} not used",
+        )
+
+    def test_day_events(self):
+        self.assertNoTableScan(reverse("day-events"), "portion_user_date_idx")
+
+    def test_days(self):
+        self.assertNoTableScan(reverse("days"), "portion_user_date_idx")
+
+    def test_day(self):
+        _today = timezone.now().date().isoformat()
+        self.assertNoTableScan(reverse("day", args=[_today]), "portion_user_date_idx")
+
+    def test_foods(self):
+        self.assertNoTableScan(reverse("foods"), "food_user_name_idx")
+
+    def test_foods_page(self):
+        cursor = pagination.encode_cursor(["food 050", 1])
+        self.assertNoTableScan(
+            reverse("foods") + f"?after={cursor}", "food_user_name_idx"
+        )
+
+    def test_days_page(self):
+        self.assertNoTableScan(
+            reverse("days") + "?before=2024-01-01", "portion_user_date_idx"
+        )
+
+
+class QueryBudgetTest(TestCase):
+    USERNAME = "testuser"
+    PASSWORD = "testpassword"
+    SIZES = (10, 100, 1000)
+
+    def setUp(self):
+        self.user = User.objects.create_superuser(
+            username=QueryBudgetTest.USERNAME, password=QueryBudgetTest.PASSWORD
+        )
+        self.client.login(
+            username=QueryBudgetTest.USERNAME, password=QueryBudgetTest.PASSWORD
+        )
+        self.today = timezone.now().date()
+        self.foods = [
+            Food.objects.create(name=f"food {i}", calories=10 * i, user=self.user)
+            for i in range(10)
+        ]
+        self.meals = [
+            Meal.objects.create(name=f"meal {i}", user=self.user) for i in range(3)
+        ]
+
+    def _create_portions(self, count, days):
+        Portion.objects.all().delete()
+        Portion.objects.bulk_create(
+            Portion(
+                user=self.user,
+                date=self.today - timedelta(days=i % days),
+                food=self.foods[i % len(self.foods)],
+                meal=self.meals[i % len(self.meals)] if i % 4 else None,
+                calories_per_unit=self.foods[i % len(self.foods)].calories,
+            )
+            for i in range(count)
+        )
+
+    def assertQueryBudget(self, url, budget, days=1):
+        self.client.get(url)  # warm up the per-user caches
+        for size in QueryBudgetTest.SIZES:
+            with self.subTest(size=size):
+                self._create_portions(size, days)
+                with self.assertNumQueries(budget):
+                    response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+
+    def test_day(self):
+        # (session, user, data version, portions, compacted portions)
+        self.assertQueryBudget(reverse("day", args=[self.today.isoformat()]), 5)
+
+    def test_days(self):
+        self.assertQueryBudget(reverse("days"), 4, days=28)
+
+    def test_portion_admin(self):
+        self.assertQueryBudget(
+            reverse("admin:django_nutrition_portion_changelist"), 5, days=28
+        )
+
+
+class PreferencesCacheTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("test5", "1234")
+        self.factory = RequestFactory()
+
+    def _request(self):
+        request = self.factory.get("/")
+        request.user = self.user
+        return request
+
+    def test_cached(self):
+        with self.assertNumQueries(1):
+            prefs = Preferences.current_preferences(self._request())
+        self.assertEqual(prefs["max_calories"], Preferences.DEFAULT_MAX_CALORIES)
+
+        request = self._request()
+        with self.assertNumQueries(0):
+            Preferences.current_preferences(request)
+            Preferences.current_preferences(request)
+
+    def test_invalidated_on_save(self):
+        Preferences.current_preferences(self._request())
+        _prefs = Preferences.objects.create(user=self.user, max_calories=1500)
+        self.assertEqual(
+            Preferences.current_preferences(self._request())["max_calories"], 1500
+        )
+
+        _prefs.theme = "dark"
+        _prefs.save()
+        self.assertEqual(
+            Preferences.current_preferences(self._request())["theme"], "dark"
+        )
+
+    @override_settings(
+        CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "shared": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"},
+        },
+        NUTRITION_CACHE="shared",
+        NUTRITION_SINGLE_PROCESS=False,
+    )
+    def test_shared_caches_check(self):
+        self.assertEqual(caching.check_shared_caches(), [])
+        with override_settings(NUTRITION_FRAGMENTS_CACHE="default"):
+            warnings = caching.check_shared_caches()
+            self.assertEqual([w.id for w in warnings], ["django_nutrition.W001"])
+            self.assertIn("NUTRITION_FRAGMENTS_CACHE", warnings[0].msg)
+            with override_settings(NUTRITION_SINGLE_PROCESS=True):
+                self.assertEqual(caching.check_shared_caches(), [])
+
+
+class ConditionalGetTest(TestCase):
+    USERNAME = "testuser"
+    PASSWORD = "testpassword"
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username=ConditionalGetTest.USERNAME, password=ConditionalGetTest.PASSWORD
+        )
+        self.food = Food.objects.create(name="food 100", calories=100, user=self.user)
+        Portion.objects.create(food=self.food, date=timezone.now(), user=self.user)
+        self.client.login(
+            username=ConditionalGetTest.USERNAME, password=ConditionalGetTest.PASSWORD
+        )
+
+    def assertNotModifiedUntilWrite(self, url):
+        self.client.get(url)  # sets the CSRF cookie
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers["ETag"]
+        self.assertIn("Last-Modified", response.headers)
+
+        # session, user and data version only
+        with self.assertNumQueries(3):
+            response = self.client.get(url, headers={"if-none-match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        Portion.objects.create(food=self.food, date=timezone.now(), user=self.user)
+        response = self.client.get(url, headers={"if-none-match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        etag = response.headers["ETag"]
+
+        Preferences.objects.create(user=self.user, max_calories=100)
+        response = self.client.get(url, headers={"if-none-match": etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_day_events(self):
+        self.assertNotModifiedUntilWrite(reverse("day-events"))
+
+    def test_day(self):
+        _today = timezone.now().date().isoformat()
+        self.assertNotModifiedUntilWrite(reverse("day", args=[_today]))
+
+    def test_summaries_after_midnight(self):
+        self.test_day_events_after_midnight(reverse("summaries"))
+
+    def test_day_events_after_midnight(self, url=None):
+        url = url or reverse("day-events")
+        response = self.client.get(url)
+        etag = response.headers["ETag"]
+        modified = response.headers["Last-Modified"]
+        _today = timezone.localdate().isoformat()
+        explicit = {"start": _today, "end": _today}
+        explicit_etag = self.client.get(url, explicit).headers["ETag"]
+
+        tomorrow = timezone.now() + timedelta(days=1)
+        with patch("django.utils.timezone.now", return_value=tomorrow):
+            # the default range moved (today's portion is now yesterday's)
+            response = self.client.get(url, headers={"if-none-match": etag})
+            self.assertEqual(response.status_code, 200)
+            response = self.client.get(url, headers={"if-modified-since": modified})
+            self.assertEqual(response.status_code, 200)
+
+            response = self.client.get(
+                url, explicit, headers={"if-none-match": explicit_etag}
+            )
+            self.assertEqual(response.status_code, 304)
+
+
+@modify_settings(
+    MIDDLEWARE={"append": "django_nutrition.timing.ServerTimingMiddleware"}
+)
+class TimingTest(TestCase):
+    def setUp(self):
+        timing.reset()
+        self.user = User.objects.create_user(username="testuser")
+        _food = Food.objects.create(name="food 100", calories=100, user=self.user)
+        for days_ago in range(3):
+            Portion.objects.create(
+                user=self.user,
+                food=_food,
+                date=timezone.localdate() - timedelta(days=days_ago),
+            )
+        self.client.force_login(self.user)
+
+    def _timings(self, response) -> dict:
+        self.assertEqual(response.status_code, 200)
+        metrics = {}
+        for metric in response["Server-Timing"].split(", "):
+            name, *params = metric.split(";")
+            metrics[name] = dict(p.split("=", 1) for p in params)
+        return metrics
+
+    def test_server_timing(self):
+        metrics = self._timings(self.client.get(reverse("day-events")))
+        self.assertEqual(set(metrics), {"sql", "agg", "render", "total"})
+        self.assertGreater(float(metrics["agg"]["dur"]), 0)
+        self.assertGreater(float(metrics["sql"]["dur"]), 0)
+        self.assertRegex(metrics["sql"]["desc"], r'^"[1-9]\d* queries"$')
+
+        metrics = self._timings(self.client.get(reverse("days")))
+        self.assertGreater(float(metrics["render"]["dur"]), 0)
+        self.assertEqual(float(metrics["agg"]["dur"]), 0)
+
+        # other apps' views aren't instrumented
+        response = self.client.get("/admin/login/")
+        self.assertNotIn("Server-Timing", response)
+
+    async def test_server_timing_async(self):
+        await self.async_client.aforce_login(self.user)
+        with override_settings(ROOT_URLCONF="test_project.urls_async"):
+            response = await self.async_client.get(reverse("day-events"))
+        metrics = self._timings(response)
+        self.assertGreater(float(metrics["agg"]["dur"]), 0)
+        self.assertRegex(metrics["sql"]["desc"], r'^"[1-9]\d* queries"$')
+
+    def test_summary(self):
+        for _ in range(3):
+            self.client.get(reverse("days"))
+        self.client.get(reverse("day-events"))
+
+        response = self.client.get(reverse("timings"))
+        self.assertEqual(response.status_code, 403)
+
+        self.user.is_staff = True
+        self.user.save()
+        summary = self.client.get(reverse("timings")).json()
+        self.assertEqual(summary["days"]["count"], 3)
+        self.assertEqual(summary["day-events"]["count"], 1)
+        self.assertEqual(set(summary["days"]), {"count", *timing.METRICS})
+        self.assertLessEqual(
+            summary["days"]["total"]["p50"], summary["days"]["total"]["p95"]
+        )
+
+    @override_settings(NUTRITION_TIMING_SAMPLES=2)
+    def test_ring_buffer(self):
+        timing.reset()
+        for _ in range(3):
+            self.client.get(reverse("days"))
+        self.assertEqual(timing.summary()["days"]["count"], 2)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(timing._percentile(values, 50), 50)
+        self.assertEqual(timing._percentile(values, 95), 95)
+        self.assertEqual(timing._percentile([7], 95), 7)
+
+
+@override_settings(ROOT_URLCONF="test_project.urls_async")
+class AsyncViewsTest(TestCase):
+    """
+    The async views (urls_async) against the sync ones, through
+    AsyncClient (ASGI) and Client (WSGI)
+    """
+
+    CONCURRENCY = 50
+
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser")
+        _food = Food.objects.create(name="food 100", calories=100, user=self.user)
+        _meal = Meal.objects.create(name="lunch", user=self.user)
+        _today = timezone.now().date()
+        for days_ago in [0, 0, 1, 3, 40]:
+            Portion.objects.create(
+                user=self.user,
+                food=_food,
+                meal=_meal if days_ago else None,
+                quantity=days_ago + 1,
+                date=_today - timedelta(days=days_ago),
+            )
+        Preferences.objects.create(user=self.user, max_calories=300)
+        self.client.force_login(self.user)
+        self.urls = {
+            "events": reverse("day-events")
+            + f"?start={_today - timedelta(weeks=8)}&end={_today}",
+            "days": reverse("days"),
+            "days_before": reverse("days") + f"?before={_today - timedelta(days=2)}",
+            "day": reverse("day", args=[_today.isoformat()]),
+            "batched_events": reverse("day-events")
+            + f"?ranges={_today - timedelta(weeks=8)}/{_today - timedelta(weeks=4)},"
+            + f"{_today - timedelta(weeks=4)}/{_today}&prefetch=1",
+        }
+
+    def _get_sync(self, url):
+        # (never concurrent: override_settings() isn't safe across tasks)
+        with override_settings(ROOT_URLCONF="test_project.urls"):
+            return self.client.get(url)
+
+    def _summary(self, response):
+        self.assertEqual(response.status_code, 200)
+        if response["Content-Type"] == "application/json":
+            return response.json()
+        context = response.context
+        if "days" in context:
+            return context["next_before"], [
+                (d.date, d.calories, [(m.name, m.calories) for m in d.meals])
+                for d in context["days"]
+            ]
+        return context["calories"], [(m.name, m.calories) for m in context["meals"]]
+
+    async def _compare(self):
+        await self.async_client.aforce_login(self.user)
+        for name, url in self.urls.items():
+            expected = self._summary(await sync_to_async(self._get_sync)(url))
+            with self.subTest(name):
+                self.assertEqual(
+                    self._summary(await self.async_client.get(url)), expected
+                )
+
+    async def test_same_as_sync(self):
+        await self._compare()
+
+    @override_settings(NUTRITION_USE_ROLLUP=True)
+    async def test_same_as_sync_from_rollup(self):
+        await self._compare()
+
+    async def test_same_as_sync_compacted(self):
+        _today = timezone.localdate()
+        await sync_to_async(compaction.compact)(_today - timedelta(days=2))
+        await self._compare()
+
+    async def test_anonymous(self):
+        response = await self.async_client.get(self.urls["events"])
+        self.assertEqual(response.status_code, 403)
+        for name in ["days", "day"]:
+            response = await self.async_client.get(self.urls[name])
+            self.assertEqual(response.status_code, 302)
+
+    async def test_not_modified(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(self.urls["events"])
+        etag = response.headers["ETag"]
+        response = await self.async_client.get(
+            self.urls["events"], headers={"if-none-match": etag}
+        )
+        self.assertEqual(response.status_code, 304)
+
+    async def test_concurrent_clients(self):
+        await self.async_client.aforce_login(self.user)
+        expected = await sync_to_async(self._get_sync)(self.urls["events"])
+        names = ["events", "days", "day"] * self.CONCURRENCY
+        responses = await asyncio.gather(
+            *(self.async_client.get(self.urls[name]) for name in names)
+        )
+        self.assertEqual({r.status_code for r in responses}, {200})
+        self.assertEqual(
+            {r.content for r, name in zip(responses, names) if name == "events"},
+            {expected.content},
+        )
+
+
+class BenchCommandTest(TestCase):
+    def test_report(self):
+        out = StringIO()
+        call_command(
+            "nutrition_bench",
+            users=2,
+            foods=5,
+            portions_per_day=2,
+            years=0.1,
+            iterations=2,
+            concurrency=3,
+            stdout=out,
+        )
+        report = json.loads(out.getvalue())
+        self.assertEqual(
+            set(report["results"]),
+            {"day-events", "days", "day", "foods", "add_or_edit_portion"},
+        )
+        for result in report["results"].values():
+            self.assertLessEqual(result["p50_ms"], result["p95_ms"])
+        self.assertGreater(report["asgi"]["asgi_per_second"], 0)
+        self.assertFalse(User.objects.filter(username__startswith="nutrition-bench-"))
+
+
+class ImportTest(TestCase):
+    USERNAME = "testuser"
+    PASSWORD = "testpassword"
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username=ImportTest.USERNAME, password=ImportTest.PASSWORD
+        )
+        Food.objects.create(name="apple", calories=50, user=self.user)
+
+    def test_import_foods_command(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as f:
+            f.write("name,calories\napple,60\nbread,250\nrice,130\n,10\n")
+        self.addCleanup(os.remove, f.name)
+
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command(
+                "nutrition_import",
+                f.name,
+                user=ImportTest.USERNAME,
+                kind="foods",
+                chunk_size=1,
+                stdout=out,
+            )
+        result = json.loads(out.getvalue())
+        self.assertEqual(result["created"], 2)
+        self.assertEqual(result["skipped"], 1)
+        self.assertEqual(
+            result["errors"], [{"row": 4, "error": "ValueError: empty name"}]
+        )
+        self.assertEqual(
+            sorted(Food.objects.filter(user=self.user).values_list("name", "calories")),
+            [("apple", 50), ("bread", 250), ("rice", 130)],
+        )
+
+    @override_settings(NUTRITION_USE_ROLLUP=True)
+    def test_upload_portions(self):
+        lines = [
+            {"date": "2024-05-01", "food": "apple", "quantity": 2, "meal": "lunch"},
+            {"date": "2024-05-01", "food": "apple", "note": "green"},
+            {"date": "2024-05-02", "food": "apple", "meal": "lunch"},
+            {"date": "2024-05-02", "food": "pear"},
+        ]
+        content = "\n".join(json.dumps(line) for line in lines) + "\n{broken\n"
+        upload = SimpleUploadedFile("portions.jsonl", content.encode())
+
+        response = self.client.post(
+            reverse("import"), {"file": upload, "kind": "portions"}
+        )
+        self.assertEqual(response.status_code, 403)
+
+        self.client.login(username=ImportTest.USERNAME, password=ImportTest.PASSWORD)
+        upload.seek(0)
+        response = self.client.post(
+            reverse("import"), {"file": upload, "kind": "portions"}
+        )
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual(result["created"], 3)
+        self.assertEqual([e["row"] for e in result["errors"]], [4, 5])
+
+        self.assertEqual(Meal.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(
+            dict(DailyTotal.objects.values_list("date", "calories")),
+            {date(2024, 5, 1): 150, date(2024, 5, 2): 50},
+        )
+
+    def _upload(self, name, content, kind):
+        self.client.login(username=ImportTest.USERNAME, password=ImportTest.PASSWORD)
+        upload = SimpleUploadedFile(name, content)
+        response = self.client.post(reverse("import"), {"file": upload, "kind": kind})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_invalid_values(self):
+        rows = ["nan,1", "bread,nan", "rice,inf", f"{'x' * 201},1", "pear,60"]
+        content = "\n".join(["name,calories", *rows, "x" * 140000 + ",1"])
+        result = self._upload("foods.csv", content.encode(), "foods")
+        self.assertEqual(result["created"], 2)  # "nan" and pear
+        self.assertEqual(
+            [(e["row"], e["error"].split(":")[0]) for e in result["errors"]],
+            [(2, "ValueError"), (3, "ValueError"), (4, "ValueError"), (6, "Error")],
+        )
+
+        lines = [
+            {"date": "2024-05-01", "food": "apple", "quantity": "nan"},
+            {"date": "2024-05-01", "food": "apple", "quantity": 1e309},
+            {"date": "2024-05-01", "food": "apple", "note": "x" * 201},
+            {"date": "2024-05-01", "food": "apple", "meal": "x" * 201},
+            {"date": "2024-05-01", "food": "apple"},
+        ]
+        content = "\n".join(json.dumps(line) for line in lines)
+        result = self._upload("portions.jsonl", content.encode(), "portions")
+        self.assertEqual(result["created"], 1)
+        self.assertEqual([e["row"] for e in result["errors"]], [1, 2, 3, 4])
+        self.assertFalse(Meal.objects.exists())
+
+    def test_undecodable(self):
+        result = self._upload("foods.csv", b"name,calories\n\xff,10\n", "foods")
+        self.assertEqual(result["created"], 0)
+        self.assertEqual(
+            result["errors"][0]["error"].split(":")[0], "UnicodeDecodeError"
+        )
+
+
+class BulkPortionsTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser")
+        self.food = Food.objects.create(name="food 100", calories=100, user=self.user)
+        self.meal = Meal.objects.create(name="lunch", user=self.user)
+        self.portion = Portion.objects.create(
+            user=self.user, food=self.food, date=date(2024, 1, 1)
+        )
+        _other = User.objects.create_user(username="other")
+        self.other_food = Food.objects.create(name="other", calories=1, user=_other)
+        self.other_portion = Portion.objects.create(
+            user=_other, food=self.other_food, date=date(2024, 1, 1)
+        )
+        self.client.force_login(self.user)
+
+    def _post(self, portions):
+        return self.client.post(
+            reverse("bulk-portions"), portions, content_type="application/json"
+        )
+
+    def _new(self, count, day="2024-01-02"):
+        return [
+            {"date": day, "food": self.food.pk, "meal": self.meal.pk, "quantity": 2}
+            for _ in range(count)
+        ]
+
+    @override_settings(NUTRITION_USE_ROLLUP=True)
+    def test_create_and_update(self):
+        # cached events of the affected months must be dropped
+        month_events(self.user, date(2024, 1, 1), date(2024, 1, 31), 2000)
+
+        response = self._post(
+            self._new(2)
+            + [{"id": self.portion.pk, "date": "2024-01-03", "meal": self.meal.pk}]
+        )
+        self.assertEqual(response.status_code, 200)
+        result = response.json()
+        self.assertEqual(len(result["created"]), 2)
+        self.assertEqual(result["updated"], [self.portion.pk])
+
+        self.portion.refresh_from_db()
+        self.assertEqual(self.portion.date, date(2024, 1, 3))
+        self.assertEqual(self.portion.quantity, 1)  # not given, unchanged
+        self.assertEqual(
+            list(
+                DailyTotal.objects.filter(user=self.user)
+                .order_by("date")
+                .values_list("date", "calories")
+            ),
+            [(date(2024, 1, 2), 400), (date(2024, 1, 3), 100)],
+        )
+        self.assertEqual(
+            [
+                e["start"]
+                for e in month_events(
+                    self.user, date(2024, 1, 1), date(2024, 1, 31), 2000
+                )
+            ],
+            ["2024-01-02", "2024-01-03"],
+        )
+        self.assertEqual(
+            models.MealUsage.objects.get(user=self.user, meal=self.meal).count, 3
+        )
+
+    @override_settings(NUTRITION_USE_ROLLUP=True)
+    def test_update_food(self):
+        _food = Food.objects.create(name="food 500", calories=500, user=self.user)
+        response = self._post([{"id": self.portion.pk, "food": _food.pk}])
+        self.assertEqual(response.status_code, 200)
+        self.portion.refresh_from_db()
+        self.assertEqual(self.portion.calories_per_unit, 500)
+        self.assertEqual(
+            DailyTotal.objects.get(user=self.user, date=date(2024, 1, 1)).calories, 500
+        )
+
+    def test_constant_queries(self):
+        counts = []
+        for size in [1, 20]:
+            with CaptureQueriesContext(connection) as ctx:
+                response = self._post(self._new(size, f"2024-02-{size:02d}"))
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(ctx.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_invalid(self):
+        invalid = [
+            {"date": "2024-01-02"},
+            {"date": "2024-13-02", "food": self.food.pk},
+            {"date": "2024-01-02", "food": self.other_food.pk},
+            {"date": "2024-01-02", "food": True},
+            {"date": "2024-01-02", "food": self.food.pk, "meal": 0},
+            {"date": "2024-01-02", "food": self.food.pk, "quantity": "1"},
+            {"date": "2024-01-02", "food": self.food.pk, "calories": 1},
+            {"id": self.other_portion.pk, "quantity": 2},
+            "portion",
+        ]
+        for portion in invalid:
+            with self.subTest(portion):
+                response = self._post(self._new(1) + [portion])
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual([e["index"] for e in response.json()["errors"]], [1])
+
+        response = self._post([{"id": self.portion.pk}, {"id": self.portion.pk}])
+        self.assertEqual(response.status_code, 400)
+        response = self._post({"date": "2024-01-02", "food": self.food.pk})
+        self.assertEqual(response.status_code, 400)
+        # nothing was written
+        self.assertEqual(Portion.objects.filter(user=self.user).count(), 1)
+        self.other_portion.refresh_from_db()
+        self.assertEqual(self.other_portion.quantity, 1)
+
+    def test_anonymous(self):
+        self.client.logout()
+        self.assertEqual(self._post(self._new(1)).status_code, 403)
+
+
+class CopyingTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser")
+        self.food = Food.objects.create(name="food 100", calories=100, user=self.user)
+        self.lunch = Meal.objects.create(name="lunch", user=self.user)
+        self.day = date(2024, 1, 1)
+        for meal, quantity in [(self.lunch, 1), (self.lunch, 2), (None, 3)]:
+            Portion.objects.create(
+                user=self.user,
+                food=self.food,
+                meal=meal,
+                quantity=quantity,
+                note=f"note {quantity}",
+                date=self.day,
+            )
+        self.client.force_login(self.user)
+
+    def _logged(self, day):
+        return list(
+            Portion.objects.filter(user=self.user, date=day)
+            .order_by("id")
+            .values_list("food_id", "meal_id", "quantity", "note")
+        )
+
+    @override_settings(NUTRITION_USE_ROLLUP=True)
+    def test_copy_day(self):
+        targets = [date(2024, 1, 2), date(2024, 1, 3)]
+        copied = copying.copy_portions(self.user, self.day, targets)
+        self.assertEqual(len(copied), 6)
+        for target in targets:
+            self.assertEqual(self._logged(target), self._logged(self.day))
+        self.assertEqual(
+            DailyTotal.objects.get(user=self.user, date=targets[1]).calories, 600
+        )
+        self.assertEqual(
+            models.MealUsage.objects.get(user=self.user, meal=self.lunch).count, 6
+        )
+
+    def test_copy_meal(self):
+        self.assertEqual(copying.meal_names(self.user, self.day), ["lunch", "other"])
+        copying.copy_portions(self.user, self.day, [date(2024, 1, 2)], "lunch")
+        self.assertEqual(self._logged(date(2024, 1, 2)), self._logged(self.day)[:2])
+        copying.copy_portions(self.user, self.day, [date(2024, 1, 3)], "other")
+        self.assertEqual(self._logged(date(2024, 1, 3)), self._logged(self.day)[2:])
+        self.assertEqual(
+            copying.copy_portions(self.user, date(2024, 2, 1), [date(2024, 1, 4)]), []
+        )
+
+    def test_constant_queries(self):
+        counts = []
+        for targets in [[date(2024, 2, 1)], [date(2024, 3, d) for d in range(1, 29)]]:
+            with CaptureQueriesContext(connection) as ctx:
+                copying.copy_portions(self.user, self.day, targets)
+            counts.append(len(ctx.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_templates(self):
+        template = copying.save_template(self.user, "lunch", self.day, "lunch")
+        self.assertEqual(template.items.count(), 2)
+        # saving again under the same name replaces the items
+        template = copying.save_template(self.user, "lunch", self.day)
+        self.assertEqual(template.items.count(), 3)
+        self.assertEqual(models.MealTemplate.objects.filter(user=self.user).count(), 1)
+
+        copying.apply_template(template, [date(2024, 1, 5), date(2024, 1, 6)])
+        self.assertEqual(self._logged(date(2024, 1, 6)), self._logged(self.day))
+        self.assertIsNone(copying.save_template(self.user, "x", date(2024, 2, 1)))
+
+    def test_views(self):
+        response = self.client.post(
+            reverse("copy_day", args=["2024-01-01"]),
+            {"meal": "lunch", "dates": "2024-01-02, 2024-01-03"},
+        )
+        self.assertRedirects(
+            response, reverse("day", args=["2024-01-02"]), fetch_redirect_response=False
+        )
+        self.assertEqual(len(self._logged(date(2024, 1, 3))), 2)
+
+        for data in [{"dates": "2024-01-32"}, {"dates": ""}, {"meal": "dinner"}]:
+            with self.subTest(data):
+                response = self.client.post(
+                    reverse("copy_day", args=["2024-01-01"]), data
+                )
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.context["form"].errors)
+
+        response = self.client.post(
+            reverse("save_meal_template", args=["2024-01-01"]),
+            {"meal": "", "name": "my day"},
+        )
+        self.assertEqual(response.status_code, 302)
+        template = models.MealTemplate.objects.get(user=self.user, name="my day")
+
+        response = self.client.post(
+            reverse("apply_meal_template", args=["2024-01-09"]),
+            {"template": template.pk, "dates": "2024-01-09"},
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self._logged(date(2024, 1, 9)), self._logged(self.day))
+
+        # other users' templates can't be applied
+        other = User.objects.create_user(username="other")
+        self.client.force_login(other)
+        response = self.client.post(
+            reverse("apply_meal_template", args=["2024-01-10"]),
+            {"template": template.pk, "dates": "2024-01-10"},
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("template", response.context["form"].errors)
+        self.assertEqual(
+            self.client.get(reverse("copy_day", args=["2024-99-01"])).status_code, 404
+        )
+
+
+class ExportTest(TestCase):
+    USERNAME = "testuser"
+    PASSWORD = "testpassword"
+
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username=ExportTest.USERNAME, password=ExportTest.PASSWORD
+        )
+        _food = Food.objects.create(name="apple", calories=50, user=self.user)
+        _meal = Meal.objects.create(name="lunch", user=self.user)
+        for day in range(1, 4):
+            Portion.objects.create(
+                food=_food, meal=_meal, date=date(2024, 5, day), user=self.user
+            )
+        Portion.objects.create(
+            food=_food, quantity=1.5, date=date(2024, 5, 1), note="a, b", user=self.user
+        )
+        self.client.login(username=ExportTest.USERNAME, password=ExportTest.PASSWORD)
+
+    def _export(self, **params):
+        response = self.client.get(reverse("export"), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b"".join(response.streaming_content)
+
+    def test_csv(self):
+        content = self._export().decode()
+        rows = list(csv.DictReader(StringIO(content)))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[1]["note"], "a, b")
+        self.assertEqual(rows[1]["calories"], "75.0")
+        self.assertEqual([r["meal"] for r in rows], ["lunch", "", "lunch", "lunch"])
+
+    def test_gzipped_jsonl_round_trip(self):
+        content = gzip.decompress(self._export(format="jsonl", gzip="1"))
+        Portion.objects.all().delete()
+        result = import_stream(
+            self.user, StringIO(content.decode()), "portions", "jsonl"
+        )
+        self.assertEqual(result.created, 4)
+        self.assertEqual(
+            sum(p.calories() for p in Portion.objects.filter(user=self.user)), 225
+        )
+
+    def test_compacted(self):
+        expected = self._export().decode()
+        compaction.compact(date(2024, 5, 2))
+        self.assertEqual(self._export().decode(), expected)
+
+        Portion.objects.create(
+            food=Food.objects.get(name="apple"),
+            quantity=3,
+            date=date(2024, 5, 2),
+            user=self.user,
+        )
+        compaction.compact(date(2024, 5, 3), archive=False)
+        rows = list(csv.DictReader(StringIO(self._export().decode())))
+        self.assertEqual(
+            [(r["date"], r["food"], r["meal"], r["note"], r["calories"]) for r in rows],
+            [
+                ("2024-05-01", "apple", "lunch", "", "50.0"),
+                ("2024-05-01", "apple", "", "a, b", "75.0"),
+                ("2024-05-02", "", "lunch", "compacted portions: 1", "50.0"),
+                ("2024-05-02", "", "", "compacted portions: 1", "150.0"),
+                ("2024-05-03", "apple", "lunch", "", "50.0"),
+            ],
+        )
+
+
 class AddOrEditPortionViewTest(TestCase):
     USERNAME = "testuser"
     PASSWORD = "12345"
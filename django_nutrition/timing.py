@@ -0,0 +1,228 @@
+"""
+Opt-in per-request instrumentation of the django_nutrition views, without
+an external APM.  Add "django_nutrition.timing.ServerTimingMiddleware" to
+MIDDLEWARE to get, for every request to a view of this app:
+
+- a Server-Timing header (shown by the browser's developer tools) with
+  the number of SQL queries and their time ("sql"), the time spent
+  computing calendar events and summaries, including their SQL ("agg"),
+  rendering templates ("render") and the whole view ("total");
+- a sample in an in-process ring buffer of the last
+  settings.NUTRITION_TIMING_SAMPLES requests (default: 1000), summarized
+  per url name by the staff-only api/timings/ endpoint (p50/p95).
+
+The buffer is per process: with several server processes each endpoint
+request reports on the process that serves it.
+"""
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.template.response import TemplateResponse
+
+if TYPE_CHECKING:
+    from django.http import HttpRequest, HttpResponse
+
+DEFAULT_SAMPLES = 1000
+METRICS = ["total", "sql", "agg", "render", "queries"]
+
+
+class Timings:
+    """
+    Measurements of one request (milliseconds, except queries)
+    """
+
+    __slots__ = ("durations", "queries", "start")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.durations = {"sql": 0.0, "agg": 0.0, "render": 0.0}
+
+    def add(self, name: str, seconds: float):
+        self.durations[name] += seconds * 1000
+
+    def finish(self) -> dict:
+        sample = {
+            "total": (time.perf_counter() - self.start) * 1000,
+            **self.durations,
+        }
+        sample["queries"] = self.queries
+        return sample
+
+
+# the Timings of the request being handled, if instrumented
+# (context variables follow the request into sync_to_async threads)
+_current: ContextVar[Timings | None] = ContextVar("nutrition_timings", default=None)
+
+_lock = threading.Lock()
+_samples: deque | None = None
+
+
+def _buffer() -> deque:
+    global _samples
+    if _samples is None:
+        with _lock:
+            if _samples is None:
+                size = getattr(settings, "NUTRITION_TIMING_SAMPLES", DEFAULT_SAMPLES)
+                _samples = deque(maxlen=size)
+    return _samples
+
+
+def reset():
+    """
+    Drop the recorded samples (and re-read the buffer size setting).
+    """
+    global _samples
+    with _lock:
+        _samples = None
+
+
+@contextmanager
+def measure(name: str):
+    """
+    Add the duration of the block to the "agg" or "render" time of the
+    request, if instrumented.
+    """
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+def _record_query(execute, sql, params, many, context):
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.add("sql", time.perf_counter() - start)
+        timings.queries += 1
+
+
+def install_query_recorder(sender, connection, **kwargs):
+    """
+    connection_created receiver: time the connection's queries (a no-op
+    outside of instrumented requests).
+    """
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+connection_created.connect(install_query_recorder)
+
+
+class TimedTemplateResponse(TemplateResponse):
+    """
+    TemplateResponse measuring its (deferred) rendering, for class based views
+    """
+
+    @property
+    def rendered_content(self):
+        with measure("render"):
+            return super().rendered_content
+
+
+def _url_name(request: "HttpRequest") -> str | None:
+    """
+    The url name of the request's view, if it's a view of this app.
+    """
+    match = getattr(request, "resolver_match", None)
+    if match is None or not match.url_name:
+        return None
+    view = getattr(match.func, "view_class", match.func)
+    if not view.__module__.startswith(f"{__package__}."):
+        return None
+    return match.url_name
+
+
+def server_timing(sample: dict) -> str:
+    metrics = [f'sql;dur={sample["sql"]:.1f};desc="{sample["queries"]} queries"']
+    metrics += [f"{name};dur={sample[name]:.1f}" for name in ["agg", "render", "total"]]
+    return ", ".join(metrics)
+
+
+class ServerTimingMiddleware:
+    """
+    See the module documentation.  Works under WSGI and ASGI.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request: "HttpRequest") -> "HttpResponse":
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timings = Timings()
+        token = _current.set(timings)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, timings)
+
+    async def __acall__(self, request: "HttpRequest") -> "HttpResponse":
+        timings = Timings()
+        token = _current.set(timings)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._finish(request, response, timings)
+
+    def _finish(
+        self, request: "HttpRequest", response: "HttpResponse", timings: Timings
+    ) -> "HttpResponse":
+        url_name = _url_name(request)
+        if url_name is None:
+            return response
+        sample = timings.finish()
+        response["Server-Timing"] = server_timing(sample)
+        _buffer().append((url_name, sample))
+        return response
+
+
+def _percentile(values: list[float], percent: int) -> float:
+    # nearest rank, values sorted
+    rank = max(1, -(-len(values) * percent // 100))
+    return values[rank - 1]
+
+
+def summary() -> dict[str, dict]:
+    """
+    Per url name: the number of samples in the buffer, and the p50/p95
+    of each metric.
+    """
+    per_name: dict[str, list[dict]] = {}
+    for url_name, sample in list(_buffer()):
+        per_name.setdefault(url_name, []).append(sample)
+
+    result = {}
+    for url_name, samples in sorted(per_name.items()):
+        result[url_name] = {"count": len(samples)}
+        for metric in METRICS:
+            values = sorted(s[metric] for s in samples)
+            result[url_name][metric] = {
+                "p50": round(_percentile(values, 50), 2),
+                "p95": round(_percentile(values, 95), 2),
+            }
+    return result
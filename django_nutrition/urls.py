@@ -5,10 +5,39 @@ from . import views, api
 
 urlpatterns = [
     path("", views.DaysView.as_view(), name="days"),
+    path(
+        "days/more",
+        views.DaysView.as_view(template_name="django_nutrition/days-rows.html"),
+        name="days-more",
+    ),
     path("foods", views.FoodsView.as_view(), name="foods"),
+    path(
+        "foods/more",
+        views.FoodsView.as_view(template_name="django_nutrition/foods-rows.html"),
+        name="foods-more",
+    ),
     path("day/<str:day_str>", views.day, name="day"),
+    path("day/<str:day_str>/copy", views.copy_day, name="copy_day"),
+    path(
+        "day/<str:day_str>/save-template",
+        views.save_meal_template,
+        name="save_meal_template",
+    ),
+    path(
+        "day/<str:day_str>/apply-template",
+        views.apply_meal_template,
+        name="apply_meal_template",
+    ),
     path("user-preferences/", views.user_preferences, name="user_preferences"),
     path("api/events/", api.days, name="day-events"),
+    path("api/import/", api.import_data, name="import"),
+    path("api/portions/", api.bulk_portions, name="bulk-portions"),
+    path("api/foods/search/", api.food_search, name="food-search"),
+    path("api/suggestions/", api.suggestions, name="suggestions"),
+    path("api/summaries/", api.summaries, name="summaries"),
+    path("api/analytics/", api.analytics_view, name="analytics"),
+    path("api/timings/", api.timings, name="timings"),
+    path("export/", views.export_data, name="export"),
     path(
         "login/",
         auth_views.LoginView.as_view(template_name="django_nutrition/login.html"),
@@ -0,0 +1,24 @@
+"""
+django_nutrition.urls with the async versions of the read-only views
+(see async_views.py), for ASGI deployments.
+"""
+
+from django.urls import path
+
+from . import async_views, urls
+
+_ASYNC_VIEWS = {
+    "days": async_views.DaysView.as_view(),
+    "days-more": async_views.DaysView.as_view(
+        template_name="django_nutrition/days-rows.html"
+    ),
+    "day": async_views.day,
+    "day-events": async_views.days,
+}
+
+urlpatterns = [
+    path(str(p.pattern), _ASYNC_VIEWS[p.name], name=p.name)
+    if p.name in _ASYNC_VIEWS
+    else p
+    for p in urls.urlpatterns
+]
@@ -0,0 +1,187 @@
+"""
+Per-user food and meal usage statistics (models.FoodUsage/MealUsage),
+used to suggest the most frequent and most recent foods and meals when
+entering a portion without looking at the portion history.
+
+A new portion increments the counters of its food and meal; edits and
+deletions recompute the counters of the foods and meals involved.
+"""
+
+from collections.abc import Iterable
+from typing import TYPE_CHECKING
+
+from django.db import transaction
+from django.db.models import Count, DateField, F, Max, Value
+from django.db.models.functions import Greatest
+
+from . import caching, models
+
+if TYPE_CHECKING:
+    from datetime import date
+
+SUGGESTIONS = 10  # per list
+BATCH_SIZE = 1000
+
+# (model, Portion field) of the two statistics
+_KINDS = [(models.FoodUsage, "food"), (models.MealUsage, "meal")]
+
+
+def _increment(model, user_id: int, field: str, value: int, day: "date"):
+    updated = model.objects.filter(user_id=user_id, **{field: value}).update(
+        count=F("count") + 1,
+        last_used=Greatest("last_used", Value(day, output_field=DateField())),
+    )
+    if not updated:
+        _usage, created = model.objects.get_or_create(
+            user_id=user_id,
+            **{field: value},
+            defaults={"count": 1, "last_used": day},
+        )
+        if not created:
+            _increment(model, user_id, field, value, day)  # lost a race
+
+
+def record(user_id: int, food_id: int, meal_id: int | None, day: "date"):
+    """
+    Count one new portion.
+    """
+    _increment(models.FoodUsage, user_id, "food_id", food_id, day)
+    if meal_id is not None:
+        _increment(models.MealUsage, user_id, "meal_id", meal_id, day)
+    invalidate(user_id)
+
+
+def _usage_groups(portions, field: str):
+    return (
+        portions.filter(**{f"{field}__isnull": False})
+        .values_list("user_id", field)
+        .annotate(count=Count("id"), last_used=Max("date"))
+        .order_by()
+    )
+
+
+def _build(model, field: str, groups) -> list:
+    return [
+        model(user_id=user_id, **{f"{field}_id": value}, count=count, last_used=last)
+        for user_id, value, count, last in groups
+    ]
+
+
+def _upsert(model, field: str, rows: list):
+    model.objects.bulk_create(
+        rows,
+        batch_size=BATCH_SIZE,
+        update_conflicts=True,
+        unique_fields=["user", field],
+        update_fields=["count", "last_used"],
+    )
+
+
+def refresh(user_id: int, food_ids: Iterable = (), meal_ids: Iterable = ()):
+    """
+    Recompute the statistics of the given foods and meals, deleting
+    the rows of those no longer used.
+    """
+    for (model, field), ids in zip(_KINDS, [food_ids, meal_ids]):
+        ids = {i for i in ids if i is not None}
+        if not ids:
+            continue
+        portions = models.Portion.objects.filter(
+            user_id=user_id, **{f"{field}_id__in": ids}
+        )
+        rows = _build(model, field, _usage_groups(portions, f"{field}_id"))
+        with transaction.atomic():
+            model.objects.filter(user_id=user_id, **{f"{field}_id__in": ids}).exclude(
+                **{f"{field}_id__in": [getattr(r, f"{field}_id") for r in rows]}
+            ).delete()
+            _upsert(model, field, rows)
+    invalidate(user_id)
+
+
+def refresh_portions(user_id: int, portions: Iterable["models.Portion"]):
+    """
+    refresh() the foods and meals of portions written in bulk.
+    """
+    portions = list(portions)
+    refresh(
+        user_id,
+        food_ids={p.food_id for p in portions},
+        meal_ids={p.meal_id for p in portions},
+    )
+
+
+def rebuild(user_ids: Iterable[int] | None = None) -> int:
+    """
+    Replace the statistics of the given users (default: everyone) with
+    ones recomputed from scratch.  Returns the number of rows written.
+    """
+    if user_ids is not None:
+        user_ids = list(user_ids)
+    portions = models.Portion.objects.all()
+    if user_ids is not None:
+        portions = portions.filter(user_id__in=user_ids)
+
+    written = 0
+    users = set(user_ids or [])
+    with transaction.atomic():
+        for model, field in _KINDS:
+            rows = _build(model, field, _usage_groups(portions, f"{field}_id"))
+            stale = model.objects.all()
+            if user_ids is not None:
+                stale = stale.filter(user_id__in=user_ids)
+            stale.delete()
+            _upsert(model, field, rows)
+            written += len(rows)
+            users.update(r.user_id for r in rows)
+    caching.get_cache().delete_many([caching.suggestions_key(u) for u in users])
+    return written
+
+
+def invalidate(user_id: int):
+    caching.get_cache().delete(caching.suggestions_key(user_id))
+
+
+def _ranked(model, field: str, user_id: int, order: list[str]) -> list[dict]:
+    names = {"food": ["food__name", "food__calories"], "meal": ["meal__name"]}
+    rows = (
+        model.objects.filter(user_id=user_id)
+        .order_by(*order, f"{field}_id")
+        .values(f"{field}_id", "count", "last_used", *names[field])[:SUGGESTIONS]
+    )
+    return [
+        {
+            "id": row[f"{field}_id"],
+            "name": row[f"{field}__name"],
+            **({"calories": row["food__calories"]} if field == "food" else {}),
+            "count": row["count"],
+            "last_used": row["last_used"].isoformat(),
+        }
+        for row in rows
+    ]
+
+
+def _load_suggestions(user_id: int) -> dict:
+    suggestions = {}
+    for model, field in _KINDS:
+        suggestions[f"frequent_{field}s"] = _ranked(
+            model, field, user_id, ["-count", "-last_used"]
+        )
+        suggestions[f"recent_{field}s"] = _ranked(
+            model, field, user_id, ["-last_used", "-count"]
+        )
+    return suggestions
+
+
+def suggestions(user_id: int) -> dict:
+    """
+    The user's most frequent and most recent foods and meals (lists
+    "frequent_foods", "recent_foods", "frequent_meals" and "recent_meals"),
+    cached until a portion, food or meal of the user changes.
+    """
+    _cache = caching.get_cache()
+    _key = caching.suggestions_key(user_id)
+    value = _cache.get(_key)
+    if value is None:
+        value = _load_suggestions(user_id)
+        _cache.set(_key, value)
+    return value
@@ -1,8 +1,30 @@
-from django.http import HttpResponse
+from datetime import date
+from django.core.exceptions import BadRequest
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    StreamingHttpResponse,
+)
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django import forms
-from . import api, models
+from . import (
+    api,
+    compaction,
+    conditional,
+    copying,
+    exporting,
+    fragments,
+    models,
+    pagination,
+    pricing,
+    rollup,
+    timing,
+    usage,
+)
 from django.views import generic
+from django.views.decorators.http import condition
 from django.template import loader
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
@@ -10,28 +32,182 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.urls import reverse
 
 
+def before_date(request) -> date | None:
+    before = request.GET.get("before")
+    if not before:
+        return None
+    try:
+        return date.fromisoformat(before)
+    except ValueError:
+        raise BadRequest("invalid date")
+
+
+def recent_days_query(user, start_date):
+    if rollup.enabled():
+        return models.DailyTotal.objects.filter(
+            date__gte=start_date, user=user
+        ).order_by("-date")
+    return models.Portion.objects.filter(
+        date__gte=start_date, user=user
+    ).select_related("food", "meal")
+
+
+def page_query(user, before: date):
+    """
+    The first PAGE_SIZE + 1 rollup rows, or dates with portions
+    (compacted or not), before the given date.
+    """
+    size = DaysView.PAGE_SIZE
+    if rollup.enabled():
+        return models.DailyTotal.objects.filter(user=user, date__lt=before).order_by(
+            "-date"
+        )[: size + 1]
+    dates = (
+        models.Portion.objects.filter(user=user, date__lt=before)
+        .order_by("-date")
+        .values_list("date", flat=True)
+        .distinct()
+    )
+    compacted = models.MealSummary.objects.filter(
+        user=user, date__lt=before
+    ).values_list("date", flat=True)
+    dates = dates.order_by().union(compacted.order_by()).order_by("-date")
+    return dates[: size + 1]
+
+
+def page_portions_query(user, before: date, oldest: date):
+    return models.Portion.objects.filter(
+        user=user, date__lt=before, date__gte=oldest
+    ).select_related("food", "meal")
+
+
+def days_summaries(user, start_date: date, end_date: date | None):
+    """
+    The compacted portions to add to the portions of a days list (none
+    with the rollup, which includes them)
+    """
+    if rollup.enabled():
+        return models.MealSummary.objects.none()
+    return compaction.summaries(user.pk, start_date, end_date)
+
+
+def to_days(rows, summaries=()) -> list[api.DayTotal]:
+    """
+    DayTotals, newest first, from rollup rows or portions (and compacted
+    portions)
+    """
+    if rollup.enabled():
+        return [api.DayTotal.from_rollup(_total) for _total in rows]
+    _days = compaction.add_summary_days(api.DayTotal.split_days(rows), summaries)
+    return sorted(_days, key=lambda d: d.date, reverse=True)
+
+
 class DaysView(LoginRequiredMixin, generic.ListView):
+    """
+    The last four weeks, or with ?before=<date> the PAGE_SIZE days
+    (that have portions) before that date.
+    """
+
     template_name = "django_nutrition/days.html"
     context_object_name = "days"
+    response_class = timing.TimedTemplateResponse
+    PAGE_SIZE = 28
 
     def get_queryset(self):
+        before = before_date(self.request)
+        if before:
+            return self._days_before(before)
+
         start_date = timezone.now() - timezone.timedelta(weeks=4)
-        _days = api.DayTotal.split_days(
-            models.Portion.objects.filter(date__gte=start_date, user=self.request.user)
-        )
-        return sorted(_days, key=lambda d: d.date, reverse=True)
+        # everything older is on the following pages
+        self.next_before = timezone.localdate(start_date)
+        summaries = days_summaries(self.request.user, self.next_before, None)
+        return to_days(recent_days_query(self.request.user, start_date), summaries)
+
+    def _days_before(self, before: date):
+        user = self.request.user
+        rows = list(page_query(user, before))
+        has_more = len(rows) > DaysView.PAGE_SIZE
+        rows = rows[: DaysView.PAGE_SIZE]
+        summaries = ()
+        if rows and not rollup.enabled():
+            summaries = days_summaries(
+                user, rows[-1], before - timezone.timedelta(days=1)
+            )
+            rows = page_portions_query(user, before, rows[-1])
+        _days = to_days(rows, summaries)
+        self.next_before = _days[-1].date if has_more else None
+        return _days
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["next_before"] = self.next_before
+        fragments.add_meal_tables(self.request.user.pk, context["days"])
+        return context
+
+
+def day_portions(user, day_str: str):
+    return models.Portion.objects.filter(date=day_str, user=user).select_related(
+        "food", "meal"
+    )
 
 
-@login_required
-def day(request, day_str):
-    meals = api.MealTotal.split_portions(models.Portion.objects.filter(date=day_str))
+def day_summaries(user, day_str: str):
+    day = _day_date(day_str)
+    return compaction.summaries(user.pk, day, day)
+
+
+def render_day(
+    request, day_str: str, meals: list[api.MealTotal], meals_table: str
+) -> HttpResponse:
     template = loader.get_template("django_nutrition/day.html")
     context = {
         "meals": meals,
+        "meals_table": meals_table,
         "date": day_str,
         "calories": api.round_01(sum(m.calories for m in meals)),
     }
-    return HttpResponse(template.render(context, request))
+    with timing.measure("render"):
+        return HttpResponse(template.render(context, request))
+
+
+@login_required
+@condition(
+    etag_func=conditional.page_etag,
+    last_modified_func=conditional.data_version_last_modified,
+)
+def day(request, day_str):
+    user = request.user
+    meals = api.MealTotal.split_portions(day_portions(user, day_str))
+    summaries = list(day_summaries(user, day_str))
+    if summaries:
+        archives = compaction.archives(user.pk, [summaries[0].date])
+        meals = compaction.add_summary_meals(meals, summaries, archives)
+    meals_table = fragments.day_table(request.user.pk, day_str, meals)
+    return render_day(request, day_str, meals, meals_table)
+
+
+class FoodSearchInput(forms.Widget):
+    """
+    Food text input with autocompletion from the food search api, instead
+    of a <select> with all of the user's foods.  The selected food's id is
+    posted in a hidden input.
+    """
+
+    template_name = "django_nutrition/food-search-input.html"
+
+    def __init__(self, attrs=None):
+        super().__init__(attrs)
+        self.queryset = models.Food.objects.none()
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        context["widget"]["food_name"] = (
+            self.queryset.filter(pk=value).values_list("name", flat=True).first()
+            if value
+            else ""
+        )
+        return context
 
 
 class PortionForm(forms.ModelForm):
@@ -53,10 +229,10 @@ class PortionForm(forms.ModelForm):
                     "step": 0.01,
                 }
             ),
-            "food": forms.Select(
+            "food": FoodSearchInput(
                 attrs={
-                    # DaisyUI select style
-                    "class": "select select-bordered w-full max-w-xs",
+                    # DaisyUI input styling
+                    "class": "input input-bordered w-full max-w-xs",
                 }
             ),
             "meal": forms.Select(
@@ -78,7 +254,16 @@ class PortionForm(forms.ModelForm):
         assert user  # sanity (should always be logged in here & user provided)
         super(PortionForm, self).__init__(*args, **kwargs)
         self.fields["food"].queryset = models.Food.objects.filter(user=user)
+        self.fields["food"].widget.queryset = self.fields["food"].queryset
         self.fields["meal"].queryset = models.Meal.objects.filter(user=user)
+        self.user = user
+
+    @cached_property
+    def suggestions(self) -> dict:
+        """
+        The user's frequent and recent foods and meals, for quick entry
+        """
+        return usage.suggestions(self.user.pk)
 
 
 @login_required
@@ -121,6 +306,145 @@ def delete_portion(request, pk):
     )
 
 
+class DateListField(forms.CharField):
+    """
+    Dates (YYYY-MM-DD) separated by commas or spaces
+    """
+
+    def to_python(self, value) -> list[date]:
+        value = super().to_python(value)
+        try:
+            return [date.fromisoformat(d) for d in value.replace(",", " ").split()]
+        except ValueError:
+            raise forms.ValidationError("Enter dates as YYYY-MM-DD")
+
+    def validate(self, value):
+        super().validate(value)
+        if len(set(value)) > copying.MAX_TARGET_DATES:
+            raise forms.ValidationError(
+                f"Enter at most {copying.MAX_TARGET_DATES} dates"
+            )
+
+
+class MealChoiceForm(forms.Form):
+    """
+    Choice of the whole day or one of its meals (by name, as on the day page)
+    """
+
+    meal = forms.ChoiceField(
+        required=False,
+        widget=forms.Select(attrs={"class": "select select-bordered w-full"}),
+    )
+
+    def __init__(self, *args, meal_names: list[str], **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields["meal"].choices = [("", "whole day")] + [
+            (name, name) for name in meal_names
+        ]
+
+
+class CopyPortionsForm(MealChoiceForm):
+    dates = DateListField(
+        help_text="YYYY-MM-DD, separated by commas",
+        widget=forms.TextInput(attrs={"class": "input input-bordered w-full"}),
+    )
+
+
+class SaveMealTemplateForm(MealChoiceForm):
+    name = forms.CharField(
+        max_length=200,
+        widget=forms.TextInput(attrs={"class": "input input-bordered w-full"}),
+    )
+
+
+class ApplyMealTemplateForm(forms.Form):
+    template = forms.ModelChoiceField(
+        queryset=models.MealTemplate.objects.none(),
+        widget=forms.Select(attrs={"class": "select select-bordered w-full"}),
+    )
+    dates = DateListField(
+        help_text="YYYY-MM-DD, separated by commas",
+        widget=forms.TextInput(attrs={"class": "input input-bordered w-full"}),
+    )
+
+    def __init__(self, *args, user, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields["template"].queryset = models.MealTemplate.objects.filter(
+            user=user
+        ).order_by("name")
+
+
+def _day_date(day_str: str) -> date:
+    try:
+        return date.fromisoformat(day_str)
+    except ValueError:
+        raise Http404("invalid date")
+
+
+def _render_form(request, form, title: str, day_str: str) -> HttpResponse:
+    return render(
+        request,
+        "django_nutrition/portions-form.html",
+        {"form": form, "title": title, "date": day_str},
+    )
+
+
+@login_required
+def copy_day(request, day_str):
+    """
+    Copy the portions of the day, or of one of its meals, to other days
+    """
+    day = _day_date(day_str)
+    meal_names = copying.meal_names(request.user, day)
+    form = CopyPortionsForm(request.POST or None, meal_names=meal_names)
+    if request.method == "POST" and form.is_valid():
+        target_dates = form.cleaned_data["dates"]
+        copied = copying.copy_portions(
+            request.user, day, target_dates, form.cleaned_data["meal"] or None
+        )
+        if copied:
+            return redirect("day", day_str=min(target_dates).isoformat())
+        form.add_error(None, "There are no portions to copy")
+    return _render_form(request, form, f"Copy {day_str}", day_str)
+
+
+@login_required
+def save_meal_template(request, day_str):
+    """
+    Save the portions of the day, or of one of its meals, as a template
+    """
+    day = _day_date(day_str)
+    meal_names = copying.meal_names(request.user, day)
+    form = SaveMealTemplateForm(request.POST or None, meal_names=meal_names)
+    if request.method == "POST" and form.is_valid():
+        template = copying.save_template(
+            request.user,
+            form.cleaned_data["name"],
+            day,
+            form.cleaned_data["meal"] or None,
+        )
+        if template:
+            return redirect("day", day_str=day_str)
+        form.add_error(None, "There are no portions to save")
+    return _render_form(request, form, f"Save {day_str} as template", day_str)
+
+
+@login_required
+def apply_meal_template(request, day_str):
+    """
+    Log the portions of a template on the given days (default: this day)
+    """
+    _day_date(day_str)
+    form = ApplyMealTemplateForm(
+        request.POST or None, user=request.user, initial={"dates": day_str}
+    )
+    if request.method == "POST" and form.is_valid():
+        target_dates = form.cleaned_data["dates"]
+        copying.apply_template(form.cleaned_data["template"], target_dates)
+        return redirect("day", day_str=min(target_dates).isoformat())
+    return _render_form(request, form, "Apply template", day_str)
+
+
 class UserPreferencesForm(forms.ModelForm):
     class Meta:
         model = models.Preferences
@@ -158,6 +482,33 @@ def user_preferences(request):
     return render(request, "django_nutrition/user-preferences.html", {"form": form})
 
 
+@login_required
+def export_data(request):
+    """
+    Stream the user's portions (or foods, with ?kind=foods) as
+    ?format=csv (default) or jsonl, gzip compressed with ?gzip=1.
+    """
+    kind = request.GET.get("kind", "portions")
+    file_format = request.GET.get("format", "csv")
+    if kind not in exporting.KINDS or file_format not in exporting.FORMATS:
+        return HttpResponseBadRequest("unknown kind or format")
+    gzip = request.GET.get("gzip") in ("1", "true")
+
+    filename = f"{kind}.{file_format}" + (".gz" if gzip else "")
+    content_type = (
+        "application/gzip"
+        if gzip
+        else "text/csv"
+        if file_format == "csv"
+        else "application/jsonl"
+    )
+    return StreamingHttpResponse(
+        exporting.export_stream(request.user, kind, file_format, gzip=gzip),
+        content_type=content_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 def style_test(request):
     return render(request, "django_nutrition/style-test.html")
 
@@ -165,12 +516,32 @@ def style_test(request):
 class FoodsView(LoginRequiredMixin, generic.ListView):
     template_name = "django_nutrition/foods.html"
     context_object_name = "foods"
+    response_class = timing.TimedTemplateResponse
+
+    PAGE_SIZE = 100
 
     def get_queryset(self):
-        return models.Food.objects.filter(user=self.request.user).order_by("name")
+        foods, self.next_cursor = pagination.keyset_page(
+            models.Food.objects.filter(user=self.request.user),
+            ["name", "id"],
+            cursor=self.request.GET.get("after"),
+            size=FoodsView.PAGE_SIZE,
+        )
+        return foods
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["next_cursor"] = self.next_cursor
+        return context
 
 
 class FoodForm(forms.ModelForm):
+    # portions keep the calories they were logged with, unless re-priced
+    reprice = forms.BooleanField(
+        required=False,
+        widget=forms.CheckboxInput(attrs={"class": "checkbox"}),
+    )
+
     class Meta:
         model = models.Food
         fields = ["name", "calories"]
@@ -178,13 +549,15 @@ class FoodForm(forms.ModelForm):
 
 @login_required
 def add_or_edit_food(request, pk=None):
-    _food = get_object_or_404(models.Food, pk=pk) if pk else None
+    _food = get_object_or_404(models.Food, pk=pk, user=request.user) if pk else None
     if request.method == "POST":
         form = FoodForm(request.POST, instance=_food)
         if form.is_valid():
             _food = form.save(commit=False)
             _food.user = request.user
             _food.save()
+            if pk and form.cleaned_data["reprice"]:
+                pricing.reprice(_food)
             return redirect("foods")
     else:
         form = FoodForm(instance=_food)
@@ -17,6 +17,9 @@ DEBUG = True
 
 ALLOWED_HOSTS = []
 
+# (runserver and the tests) the LocMemCache is shared by everything
+NUTRITION_SINGLE_PROCESS = True
+
 
 # Application definition
 
@@ -53,6 +56,7 @@ TEMPLATES = [
                 "django.template.context_processors.request",
                 "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
+                "django_nutrition.utils.context_processors.preferences",
             ],
         },
     },
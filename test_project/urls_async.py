@@ -0,0 +1,12 @@
+"""
+test_project.urls with the async views of django_nutrition (for ASGI)
+"""
+
+from django.contrib import admin
+from django.urls import include, path
+
+urlpatterns = [
+    path("admin/", admin.site.urls),
+    path("accounts/", include("django.contrib.auth.urls")),
+    path("nutrition/", include("django_nutrition.urls_async")),
+]